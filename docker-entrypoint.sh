@@ -11,25 +11,39 @@ if [ "$ENV" = "development" ] ; then
     pip install -r requirements/dev.txt
 fi
 
-python src/manage.py migrate                  # Apply database migrations
-
 if [ "$ENV" = "development" ] ; then
+    python src/manage.py prepare_startup --skip-static  # Migrate and create the coming movement partitions
     python src/manage.py runserver 0.0.0.0:8000
 else
-    python src/manage.py collectstatic --noinput  # Collect static files
+    # Migrate, create the coming movement partitions and collect static files;
+    # migrate and collectstatic only run when migrations or static files changed
+    python src/manage.py prepare_startup
+
+    # Metrics of the previous container's processes
+    rm -rf "${METRICS_DIR:-/tmp/covidpipe-metrics}"
 
     # Prepare log files and start outputting logs to stdout
     mkdir -p /srv/logs/
     touch /srv/logs/gunicorn.log
     touch /srv/logs/access.log
+    touch /srv/logs/jobs.log
     tail -n 0 -f /srv/logs/*.log &
 
-    # Start Gunicorn processes
+    # Run the background job worker next to the web processes, unless it
+    # runs in its own container (RUN_JOB_WORKER=false)
+    if [ "${RUN_JOB_WORKER:-true}" = "true" ] ; then
+        python src/manage.py run_jobs >> /srv/logs/jobs.log 2>&1 &
+    fi
+
+    # Start Gunicorn processes; more than one thread per worker uses gthread.
+    # The application is loaded once and forked, not imported by each worker
     echo Starting Gunicorn
     exec gunicorn app.wsgi \
+        --preload \
         --bind 0.0.0.0:8000 \
         --chdir /usr/src/app/src \
-        --workers 3 \
+        --workers "${GUNICORN_WORKERS:-3}" \
+        --threads "${GUNICORN_THREADS:-1}" \
         --log-level=info \
         --log-file=/srv/logs/gunicorn.log \
         --access-logfile=/srv/logs/access.log
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from os.path import dirname, join, exists, abspath
 
 import environ
@@ -54,12 +55,24 @@ THIRD_PARTY_APPS = [
     "versatileimagefield",
 ]
 
+# Apps the service doesn't use yet. The slim profile leaves them out so
+# workers don't import them, e.g. Pillow for versatileimagefield.
+OPTIONAL_APPS = ['csp', "versatileimagefield"]
+
+APP_PROFILE = env.str(
+    "APP_PROFILE", default="full" if ENVIRONMENT == "development" else "slim"
+)
+if APP_PROFILE == "slim":
+    THIRD_PARTY_APPS = [app for app in THIRD_PARTY_APPS if app not in OPTIONAL_APPS]
+
 PROJECT_APPS = ["users", "entities"]
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + PROJECT_APPS
 
 MIDDLEWARE = [
+    "helpers.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "helpers.query_stats.QueryStatsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -105,6 +118,66 @@ if ENVIRONMENT == "development":
 
 DATABASES = {"default": env.db()}
 
+# Seconds a worker thread keeps its connection between requests; 0 closes
+# it after each request
+DATABASES["default"]["CONN_MAX_AGE"] = env.int("DB_CONN_MAX_AGE", default=60)
+
+# In-process connection pool, see helpers.db_pool. Connections go back to
+# the pool after each request, so the threads of a worker share them
+if env.bool("DB_POOL", default=False) and "postgresql" in DATABASES["default"]["ENGINE"]:
+    DATABASES["default"].update(
+        {
+            "ENGINE": "helpers.pooled_postgresql",
+            "CONN_MAX_AGE": 0,
+            "POOL": {
+                "MAX_SIZE": env.int("DB_POOL_MAX_SIZE", default=10),
+                "MAX_LIFETIME": env.int("DB_POOL_MAX_LIFETIME", default=1800),
+                "PING_AFTER": env.int("DB_POOL_PING_AFTER", default=30),
+                "TIMEOUT": env.float("DB_POOL_TIMEOUT", default=10.0),
+            },
+        }
+    )
+
+# Cache
+
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+
+# The per-process caches of entities.cache are invalidated through the
+# default cache, so they are only used when CACHE_URL is shared by every
+# process, e.g. redis or memcached. Startup fails if enabled on locmem.
+PROCESS_CACHES = env.bool("PROCESS_CACHES", default=bool(env.str("CACHE_URL", default="")))
+
+# Background jobs
+
+# Admin range operations over more pipes than this are queued for run_jobs
+JOB_THRESHOLD = env.int("JOB_THRESHOLD", default=5000)
+JOB_POLL_INTERVAL = env.float("JOB_POLL_INTERVAL", default=2.0)
+# Running jobs without progress for this many seconds belong to a worker
+# that died; they are queued again
+JOB_STALE_AFTER = env.int("JOB_STALE_AFTER", default=600)
+
+# Prometheus metrics, see helpers.metrics. Every process of the service
+# must share METRICS_DIR; METRICS_TOKEN, if set, is required to scrape
+
+METRICS_DIR = env.str(
+    "METRICS_DIR", default=os.path.join(tempfile.gettempdir(), "covidpipe-metrics"))
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=1.0)
+METRICS_TOKEN = env.str("METRICS_TOKEN", default="")
+
+# Per-request SQL stats, see helpers.query_stats
+
+QUERY_STATS_SAMPLE_RATE = env.float("QUERY_STATS_SAMPLE_RATE", default=0.05)
+QUERY_STATS_SLOWEST = env.int("QUERY_STATS_SLOWEST", default=3)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "query_stats": {"handlers": ["console"], "level": "INFO", "propagate": False}
+    },
+}
+
 # Password validation
 
 AUTH_PASSWORD_VALIDATORS = [
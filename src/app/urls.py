@@ -4,12 +4,14 @@ from entities.urls import urlpatterns
 from django.conf import settings
 
 from helpers.health_check import health_check
+from helpers.metrics import metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     # Enables the DRF browsable API page
     path("api-auth/", include("rest_framework.urls", namespace="rest_framework")),
     path("health_check/", health_check, name="health_check"),
+    path("metrics/", metrics, name="metrics"),
 ] + urlpatterns
 
 if settings.ENVIRONMENT == "development":
@@ -1,15 +1,39 @@
 from django.db.models import IntegerField
 from django.db.models.functions import Cast
+from django.utils.dateparse import parse_date
 from django.utils.translation import gettext_lazy as _
 from rangefilter.filter import DateRangeFilter
 from django.template.response import TemplateResponse
 from django.shortcuts import render
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.urls import path, reverse
+from django.utils.html import format_html
 from django.db.models import Q
-from entities.models import CovidPipe, Location, Movement 
+from entities.aliases import equivalent_pipes
+from entities.cache import get_location, location_choices, pipe_ids
+from entities.jobs import enqueue, is_large
+from entities.models import (
+    CovidPipe, Job, Location, LocationInventory, Movement, MovementDailyRollup)
+from entities.export import ExportChangeList, pipe_csv_response
 from entities.forms import CovidPipeForm
+from entities.pagination import KeysetPaginationMixin
+from entities.ranges import RangeExpressionError, parse_range
+from entities.rollups import day_range, movement_days
+from entities.services import move_pipes, update_last_movements
+from entities.timeline import conditional_timeline, pipe_timeline
 
-import re
+import json
+
+
+def _parse_optional_date(value):
+    """Return the date in ``value``, or None if empty; ValueError if invalid."""
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(value)
+    return day
 
 
 class DateListFilter(admin.SimpleListFilter):
@@ -18,13 +42,13 @@ class DateListFilter(admin.SimpleListFilter):
     parameter_name = 'date'
 
     def lookups(self, request, model_admin):
-        movements = Movement.objects.all().values_list('date__date').distinct()
-
-        return [[ date[0], date[0] ] for date in movements]
+        return [[day, day] for day in movement_days()]
 
     def queryset(self, request, queryset):
-        if self.value():
-            movements = queryset.filter(Q(date__date=self.value()))
+        day = parse_date(self.value() or '')
+        if day:
+            start, end = day_range(day)
+            movements = queryset.filter(date__gte=start, date__lt=end)
             return movements
 
 
@@ -32,11 +56,17 @@ class PipeListFilter(admin.SimpleListFilter):
     title = _('pipe')
 
     parameter_name = 'pipe'
+    template = 'admin/entities/pipe_filter.html'
 
     def lookups(self, request, model_admin):
-        pipes = CovidPipe.objects.all().distinct()
+        # Only the selected pipe is listed, the rest are found through pipe-search
+        if self.value() and self.value().isdigit():
+            return list(CovidPipe.objects.filter(
+                pk=self.value()).values_list('id', 'name'))
+        return []
 
-        return [[pipe.id, pipe.name] for pipe in pipes]
+    def has_output(self):
+        return True
 
     def queryset(self, request, queryset):
         if self.value():
@@ -49,18 +79,16 @@ class LocationFilter(admin.SimpleListFilter):
     parameter_name = 'last_movement'
 
     def lookups(self, request, model_admin):
-        locations = Location.objects.all().distinct()
-
         result = []
         result.append(['empty', 'Empty'])
-        result.extend([[location.id, location.name] for location in locations])
+        result.extend(location_choices())
         return result
 
     def queryset(self, request, queryset):
         if self.value() == 'empty':
-            return queryset.filter(Q(last_movement__isnull=True))
+            return queryset.filter(Q(current_location__isnull=True))
         if self.value():
-            pipes = queryset.filter(Q(last_movement__destination=self.value()))
+            pipes = queryset.filter(Q(current_location=self.value()))
             return pipes
 
 class OriginListFilter(admin.SimpleListFilter):
@@ -69,9 +97,7 @@ class OriginListFilter(admin.SimpleListFilter):
     parameter_name = 'origin'
 
     def lookups(self, request, model_admin):
-        locations = Location.objects.all().distinct()
-
-        return [[location.id, location.name] for location in locations]
+        return location_choices()
 
     def queryset(self, request, queryset):
         if self.value():
@@ -84,8 +110,7 @@ class DestinationListFilter(admin.SimpleListFilter):
     parameter_name = 'destination'
 
     def lookups(self, request, model_admin):
-        locations = Location.objects.all().distinct()
-        return [[location.id, location.name] for location in locations]
+        return location_choices()
 
     def queryset(self, request, queryset):
         if self.value():
@@ -100,125 +125,119 @@ class MovementInlineAdmin(admin.TabularInline):
     extra = 1
 
 
-class PipeAdmin(admin.ModelAdmin):
-    class Meta:
-        ordering = ('name', '-myinteger',)
-
+class PipeAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     inlines = (MovementInlineAdmin, )
     autocomplete_fields = ('last_movement', 'alias')
     list_per_page = 1000
-    actions = ['move', 'update_dates',]
+    keyset_ordering = ('name_prefix', 'name_number', 'name')
+    change_list_template = 'admin/entities/pipe_change_list.html'
+    change_form_template = 'admin/entities/pipe_change_form.html'
+    actions = ['move', 'update_dates', 'export_csv',]
     search_fields = ['name']
     form = CovidPipeForm
-    list_filter = (( 'last_movement__date_created', DateRangeFilter), ('last_movement__date_sent', DateRangeFilter), 'con_muestra', LocationFilter, )
+    list_filter = (( 'current_date_created', DateRangeFilter), ('current_date_sent', DateRangeFilter), 'con_muestra', LocationFilter, )
     list_display = ('name', 'con_muestra', 'get_date_prepared', 'get_date_sent', 'get_from_location', 'get_location')
-
-    # def get_ordering(self, request):
-    #     return ['mystring', 'myinteger']
-
-    def get_queryset(self, request):
-        qs = super(PipeAdmin, self).get_queryset(request)
-        qs = qs.extra(
-            select={'myinteger': "NULLIF(regexp_replace(name, '\D','','g'), '')::numeric",
-                    'mystring': "translate(name,'0123456789','')"
-            }
-        ).order_by('myinteger')
-        return qs
-
-    def ordernamiento(self, obj):
-        return obj.myinteger
-
-    ordernamiento.admin_order_field = 'myinteger'
-    ordernamiento.short_name_description = 'Name Sort'
+    list_select_related = ('current_location', 'current_origin')
 
     def get_location(self, obj):
-        return obj.last_movement.destination if obj.last_movement else 'No tiene ubicación'
+        return obj.current_location or 'No tiene ubicación'
 
     get_location.short_description = 'Destino'
 
     def get_from_location(self, obj):
-        return obj.last_movement.origin if obj.last_movement else 'No tiene ubicación'
+        return obj.current_origin or 'No tiene ubicación'
 
     get_from_location.short_description = 'Origen'
 
     def get_date_created(self, obj):
-        return (obj.last_movement and obj.last_movement.date_created) or ''
+        return obj.current_date_created or ''
 
     get_date_created.short_description = 'Fecha de creación'
-    get_date_created.admin_order_field = 'last_movement__date_created'
+    get_date_created.admin_order_field = 'current_date_created'
 
     def get_date_sent(self, obj):
-        return (obj.last_movement and obj.last_movement.date_sent) or ''
+        return obj.current_date_sent or ''
 
     get_date_sent.short_description = 'Fecha de envío'
-    get_date_sent.admin_order_field = 'last_movement__date_sent'
+    get_date_sent.admin_order_field = 'current_date_sent'
 
     def get_date_prepared(self, obj):
-        return (obj.last_movement and obj.last_movement.date_created) or ''
+        return obj.current_date_created or ''
 
     get_date_prepared.short_description = 'Fecha de preparación'
-    get_date_prepared.admin_order_field = 'last_movement__date_created'
+    get_date_prepared.admin_order_field = 'current_date_created'
     
+    def get_search_results(self, request, queryset, search_term):
+        results, use_distinct = super(PipeAdmin, self).get_search_results(
+            request, queryset, search_term)
+        # A pipe name also finds the pipes it is an alias of, and its
+        # aliases; other terms don't pay for the walk
+        found = pipe_ids(search_term.split())
+        if found:
+            results |= queryset.filter(pk__in=list(
+                equivalent_pipes(ids=found.values()).values_list('pk', flat=True)))
+        return results, use_distinct
+
+    def get_range(self, request):
+        """Return the range posted to an action, if any, as a RangeExpression."""
+        rango = request.POST.get('rango', '').strip()
+        inicio = request.POST.get('inicio', None)
+        fin = request.POST.get('fin', None)
+        if not rango and inicio and fin:
+            rango = '{}-{}'.format(inicio, fin)
+        return parse_range(rango) if rango else None
+
+    def queue_job(self, request, kind, payload, queryset, names):
+        """Queue the action as a job if it covers too many pipes to run now."""
+        total = len(names) if names is not None else queryset.count()
+        if not is_large(total):
+            return None
+        if names is not None:
+            payload['names'] = names
+        else:
+            payload['ids'] = list(queryset.values_list('id', flat=True))
+        job = enqueue(kind, payload, total, user=request.user)
+        self.message_user(request, format_html(
+            '{} pipes: se procesarán en segundo plano como el <a href="{}">trabajo #{}</a>',
+            total, reverse('admin:entities_job_change', args=[job.pk]), job.pk))
+        return job
+
     def move(self, request, queryset):
         locations = Location.objects.all()
         if 'apply' in request.POST:
-            location = request.POST.get('location')
-            description = request.POST.get('description')
-            has_muestra = request.POST.get('con_muestra', None)
-            con_muestra = False
-            if has_muestra is not None:
-                con_muestra = True
-
-            inicio = request.POST.get('inicio', None)
-            fin = request.POST.get('fin', None)
-
-            if inicio and fin:
-                try:
-                    match_0 = re.match(r"([a-z]+)([0-9]+)", inicio, re.I)
-                    match_1 = re.match(r"([a-z]+)([0-9]+)", fin, re.I)
-                    items_0 = None
-                    if match_0:
-                        items_0 = match_0.groups()
-
-                    items_1 = None
-                    if match_1:
-                        items_1 = match_1.groups()
-                    
-                    if match_0 and match_1:
-                        for i in range(int(items_0[1]), int(items_1[1])+1):
-                            try:
-                                pipe = CovidPipe.objects.get(name="{}{}".format(items_0[0], str(i)))
-                                pipe.con_muestra = con_muestra
-                                pipe.save()
-                                Movement.objects.create(
-                                    description=description,
-                                    origin=pipe.last_movement.destination if pipe.last_movement else None,
-                                    destination=Location.objects.get(id=location), pipe=pipe)
-                            except Exception:
-                                pass
-                    else:
-                        for i in range(int(inicio), int(fin)+1):
-                            try:
-                                pipe = CovidPipe.objects.get(name=str(i))
-                                pipe.con_muestra = con_muestra
-                                pipe.save()
-                                Movement.objects.create(
-                                    description=description,
-                                    origin=pipe.last_movement.destination if pipe.last_movement else None,
-                                    destination=Location.objects.get(id=location), pipe=pipe)
-                                
-                            except Exception:
-                                pass
-                                    
-                except Exception as e:
-                    print(e)
+            description = request.POST.get('description', '').strip()
+            con_muestra = request.POST.get('con_muestra', None) is not None
+
+            location = get_location(request.POST.get('location'))
+            if location is None:
+                self.message_user(request, 'Ubicación inválida', messages.ERROR)
+                return
 
+            try:
+                expression = self.get_range(request)
+            except RangeExpressionError as e:
+                self.message_user(request, str(e), messages.ERROR)
                 return
-               
-            for pipe in queryset:
-                pipe.con_muestra = con_muestra
-                pipe.save()
-                Movement.objects.create(description=description, origin=pipe.last_movement.destination if pipe.last_movement else None, destination=Location.objects.get(id=location), pipe=pipe)
+
+            names = None
+            if expression is not None:
+                queryset = expression.filter()
+                names = expression.names()
+
+            payload = {
+                'location': location.pk, 'description': description,
+                'con_muestra': con_muestra,
+            }
+            if self.queue_job(request, Job.MOVE, payload, queryset, names):
+                return
+
+            result = move_pipes(
+                queryset, location, description=description,
+                con_muestra=con_muestra, names=names)
+            self.message_user(
+                request,
+                'Pipes movidos: {}, omitidos: {}, no encontrados: {}'.format(
+                    result.moved, result.skipped, len(result.missing)))
 
         else:
             return render(request, 'admin/move.html', context={'pipes':queryset, 'locations': locations})
@@ -226,89 +245,112 @@ class PipeAdmin(admin.ModelAdmin):
     def update_dates(self, request, queryset):
         locations = Location.objects.all()
         if 'apply' in request.POST:
-            location = request.POST.get('location')
-            description = request.POST.get('description')
-            has_muestra = request.POST.get('con_muestra', None)
-
-            inicio = request.POST.get('inicio', None)
-            fin = request.POST.get('fin', None)
-
-            created = request.POST.get('created', None)
-            moved = request.POST.get('moved', None)
+            try:
+                created, moved = (
+                    _parse_optional_date(request.POST.get(field))
+                    for field in ('created', 'moved'))
+            except ValueError:
+                self.message_user(request, 'Fecha inválida, use AAAA-MM-DD', messages.ERROR)
+                return render(request, 'admin/update_dates.html',
+                              context={'pipes': queryset, 'locations': locations})
 
             estado = request.POST.get('estado', None)
-
-            if inicio and fin:
-                try:
-                    match_0 = re.match(r"([a-z]+)([0-9]+)", inicio, re.I)
-                    match_1 = re.match(r"([a-z]+)([0-9]+)", fin, re.I)
-                    items_0 = None
-                    if match_0:
-                        items_0 = match_0.groups()
-
-                    items_1 = None
-                    if match_1:
-                        items_1 = match_1.groups()
-                    
-                    if match_0 and match_1:
-                        for i in range(int(items_0[1]), int(items_1[1])+1):
-                            try:
-                                pipe = CovidPipe.objects.get(name="{}{}".format(items_0[0], str(i)))
-                                if estado == 'creado':
-                                    pipe.last_movement.state = Movement.CREATED
-                                elif estado == 'enviado':
-                                    pipe.last_movement.state = Movement.SENT
-
-                                if created:
-                                    pipe.last_movement.date_created = created
-
-                                if moved:
-                                    pipe.last_movement.date_sent = moved
-
-                                pipe.last_movement.save()
-                            except Exception as e:
-                                print(e)
-                    else:
-                        for i in range(int(inicio), int(fin)+1):
-                            try:
-                                pipe = CovidPipe.objects.get(name=str(i))
-                                if estado == 'creado':
-                                    pipe.last_movement.state = Movement.CREATED
-                                elif estado == 'enviado':
-                                    pipe.last_movement.state = Movement.SENT
-
-                                if created:
-                                    pipe.last_movement.date_created = created
-
-                                if moved:
-                                    pipe.last_movement.date_sent = moved
-
-                                pipe.last_movement.save()
-                                
-                            except Exception:
-                                pass
-                                    
-                except Exception as e:
-                    print(e)
-
+            state = {
+                'creado': Movement.CREATED,
+                'enviado': Movement.SENT,
+            }.get(estado)
+
+            try:
+                expression = self.get_range(request)
+            except RangeExpressionError as e:
+                self.message_user(request, str(e), messages.ERROR)
                 return
-            for pipe in queryset:
-                if estado == 'creado':
-                    pipe.last_movement.state = Movement.CREATED
-                elif estado == 'enviado':
-                    pipe.last_movement.state = Movement.SENT
 
-                if created:
-                    pipe.last_movement.date_created = created
+            names = None
+            if expression is not None:
+                queryset = expression.filter()
+                names = expression.names()
 
-                if moved:
-                    pipe.last_movement.date_sent = moved
+            payload = {'state': state, 'date_created': created, 'date_sent': moved}
+            if self.queue_job(request, Job.UPDATE_DATES, payload, queryset, names):
+                return
 
-                pipe.last_movement.save()
+            result = update_last_movements(
+                queryset, state=state, date_created=created, date_sent=moved,
+                names=names)
+            self.message_user(
+                request,
+                'Movimientos actualizados: {}, no encontrados: {}'.format(
+                    result.affected, len(result.missing)))
 
         else:
             return render(request, 'admin/update_dates.html', context={'pipes':queryset, 'locations': locations})
 
+    def get_urls(self):
+        return [
+            path('export/', self.admin_site.admin_view(self.export_view),
+                 name='entities_covidpipe_export'),
+            path('<path:object_id>/timeline/',
+                 self.admin_site.admin_view(self.timeline_view),
+                 name='entities_covidpipe_timeline'),
+        ] + super(PipeAdmin, self).get_urls()
+
+    def timeline_view(self, request, object_id):
+        """Read-only movement history of one pipe."""
+        pipe = self.get_object(request, object_id)
+        if pipe is None:
+            return self._get_obj_does_not_exist_redirect(request, self.opts, object_id)
+        if not self.has_view_or_change_permission(request, pipe):
+            raise PermissionDenied
+
+        def render():
+            return TemplateResponse(request, 'admin/entities/pipe_timeline.html', {
+                **self.admin_site.each_context(request),
+                'opts': self.opts,
+                'original': pipe,
+                'title': 'Historial de {}'.format(pipe),
+                'timeline': pipe_timeline(pipe),
+                'states': dict(Movement.STATES),
+            })
+
+        return conditional_timeline(request, pipe, render)
+
+    def export_view(self, request):
+        """Stream the changelist, with its current filters, as CSV."""
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        list_display = self.get_list_display(request)
+        cl = ExportChangeList(
+            request, self.model, list_display,
+            self.get_list_display_links(request, list_display),
+            self.get_list_filter(request), self.date_hierarchy,
+            self.get_search_fields(request), self.get_list_select_related(request),
+            self.list_per_page, self.list_max_show_all, self.list_editable,
+            self, self.get_sortable_by(request))
+        return pipe_csv_response(cl.get_queryset(request))
+
+    def export_csv(self, request, queryset):
+        return pipe_csv_response(queryset)
+
+    export_csv.short_description = "Exportar CSV"
+
+    def save_model(self, request, obj, form, change):
+        super(PipeAdmin, self).save_model(request, obj, form, change)
+        job = form.range_job
+        if job is not None:
+            job.user = request.user
+            job.save(update_fields=['user'])
+            self.message_user(request, format_html(
+                '{} pipes: se crearán en segundo plano con el <a href="{}">trabajo #{}</a>',
+                job.total, reverse('admin:entities_job_change', args=[job.pk]), job.pk))
+        result = form.range_result
+        if result is not None:
+            self.message_user(
+                request,
+                'Pipes creados: {}, ya existentes: {}{}'.format(
+                    len(result.created), len(result.existing),
+                    ' ({})'.format(', '.join(result.existing[:20])) if result.existing else ''))
+
     fieldsets = (
         (None, {
             'fields': ('name', 'range_pipes', 'last_movement', 'con_muestra', 'alias'),
@@ -322,18 +364,90 @@ class PipeAdmin(admin.ModelAdmin):
     update_dates.short_description = "Actualizar fechas / estado"
 
 
-class MovementAdmin(admin.ModelAdmin):
+class MovementAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     search_fields = ('destination__name', )
     autocomplete_fields = ('pipe', 'destination', 'origin', )
     list_filter = (DateListFilter,
         OriginListFilter, DestinationListFilter, PipeListFilter, )
     list_display = ('id', 'origin', 'destination', 'created')
+    list_select_related = ('origin', 'destination')
+    keyset_ordering = ('-id', )
 
 
 class LocationAdmin(admin.ModelAdmin):
     search_fields = ['name', ]
 
 
+class MovementDailyRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'origin', 'destination', 'movements', 'with_sample')
+    list_filter = (('day', DateRangeFilter), )
+    list_select_related = ('origin', 'destination')
+    ordering = ('-day', )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class LocationInventoryAdmin(admin.ModelAdmin):
+    list_display = ('location', 'con_muestra', 'count')
+    list_filter = ('con_muestra', )
+    list_select_related = ('location', )
+    ordering = ('location__name', 'con_muestra')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'get_progress', 'user', 'created', 'finished')
+    list_filter = ('status', 'kind')
+    fields = readonly_fields = (
+        'kind', 'status', 'get_progress', 'user', 'created', 'started', 'finished',
+        'get_result', 'error')
+    list_select_related = ('user', )
+    change_form_template = 'admin/entities/job_change_form.html'
+    change_list_template = 'admin/entities/job_change_list.html'
+
+    def get_progress(self, obj):
+        return '{} / {}'.format(obj.progress, obj.total)
+
+    get_progress.short_description = 'Progreso'
+
+    def get_result(self, obj):
+        if not obj.result:
+            return ''
+        return format_html('<pre>{}</pre>', json.dumps(json.loads(obj.result), indent=2))
+
+    get_result.short_description = 'Resultado'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        # The list reloads itself while any job is pending
+        extra_context = dict(extra_context or {}, refresh=Job.objects.filter(
+            status__in=(Job.QUEUED, Job.RUNNING)).exists())
+        return super(JobAdmin, self).changelist_view(request, extra_context)
+
+
 admin.site.register(Movement, MovementAdmin)
+admin.site.register(MovementDailyRollup, MovementDailyRollupAdmin)
+admin.site.register(LocationInventory, LocationInventoryAdmin)
+admin.site.register(Job, JobAdmin)
 admin.site.register(Location, LocationAdmin)
 admin.site.register(CovidPipe, PipeAdmin)
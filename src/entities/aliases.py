@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from entities.models import CovidPipe
+
+AliasResolution = namedtuple('AliasResolution', ['canonical', 'chain', 'equivalent'])
+
+# ``up`` climbs from the seed pipes to the root of their chains, ``down``
+# collects everything hanging from those pipes. UNION drops rows already
+# seen, so a cycle of aliases ends the recursion instead of looping.
+ALIAS_TREE_SQL = """
+WITH RECURSIVE up(id, alias_id) AS (
+    SELECT id, alias_id FROM {table} WHERE {seed} IN ({values})
+    UNION
+    SELECT p.id, p.alias_id FROM {table} p JOIN up ON p.id = up.alias_id
+), down(id) AS (
+    SELECT id FROM up
+    UNION
+    SELECT p.id FROM {table} p JOIN down ON p.alias_id = down.id
+)
+SELECT id FROM down
+"""
+
+
+class SubquerySQL(RawSQL):
+    """Raw SQL for the right-hand side of an ``__in`` lookup.
+
+    ``RawSQL`` adds parentheses of its own, and ``IN ((WITH ...))`` is read
+    as a scalar subquery.
+    """
+
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+def _alias_tree(seed, values):
+    values = list(values)
+    if not values:
+        return CovidPipe.objects.none()
+    sql = ALIAS_TREE_SQL.format(
+        table=connection.ops.quote_name(CovidPipe._meta.db_table),
+        seed=connection.ops.quote_name(seed),
+        values=', '.join(['%s'] * len(values)))
+    return CovidPipe.objects.filter(pk__in=SubquerySQL(sql, values))
+
+
+def equivalent_pipes(names=None, ids=None):
+    """Return every pipe sharing an alias chain with the given names or ids.
+
+    The chains are walked by one recursive query, whatever their length.
+    Evaluate it rather than nesting it in another query: inside a subquery
+    its table reference points at the outer query, and the walk would run
+    once per outer row.
+    """
+    if names is not None:
+        return _alias_tree('name', names)
+    return _alias_tree('id', ids or [])
+
+
+def resolve_alias(pipe):
+    """Return the canonical pipe of ``pipe``, the chain leading to it and
+    every equivalent pipe, with one query.
+
+    The canonical pipe is the end of the ``alias`` chain; ``chain`` lists
+    the pipes on the way, nearest first, as ``(id, name)``.
+    """
+    rows = {
+        row[0]: row for row in
+        equivalent_pipes(ids=[pipe.pk]).values_list('id', 'name', 'alias_id')}
+
+    chain = []
+    seen = {pipe.pk}
+    alias_id = pipe.alias_id
+    while alias_id in rows and alias_id not in seen:
+        seen.add(alias_id)
+        chain.append(rows[alias_id][:2])
+        alias_id = rows[alias_id][2]
+
+    canonical = chain[-1] if chain else (pipe.pk, pipe.name)
+    return AliasResolution(
+        canonical, chain, [row[:2] for row in rows.values()])
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class EntitiesConfig(AppConfig):
     name = 'entities'
+
+    def ready(self):
+        import entities.signals  # noqa: F401
+        from entities.cache import check_shared_cache
+        check_shared_cache()
@@ -0,0 +1,191 @@
+"""Timings and query counts of the admin and service paths that scale with
+the data, run against whatever is in the database, e.g. ``seed_lab_data``.
+
+Every measurement runs in a transaction that is rolled back, and the whole
+run in an outer one, so the data is the same for every benchmark and every
+run. Commits are therefore not part of the timings. Admin actions run
+inline whatever their size, as the job worker would run them.
+"""
+import statistics
+import sys
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from entities.forms import CovidPipeForm
+from entities.models import CovidPipe, Location, Movement, split_name
+from entities.rollups import movement_day
+
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_REPEAT = 3
+
+# Prefix of the pipes created by the range creation benchmarks
+RANGE_PREFIX = 'BENCH'
+
+Benchmark = namedtuple('Benchmark', ['name', 'run'])
+Regression = namedtuple('Regression', ['name', 'baseline', 'current'])
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Sample:
+    """Values of the data the benchmarks filter and act on."""
+
+    def __init__(self):
+        first = CovidPipe.objects.order_by('name_prefix', 'name_number', 'name').first()
+        if first is None:
+            raise BenchmarkError('No hay pipes, ejecute seed_lab_data')
+        self.pipe = first
+        self.prefix, self.number = split_name(first.name)
+        self.width = len(first.name) - len(self.prefix)
+        self.location = (
+            CovidPipe.objects.exclude(current_location=None).values_list(
+                'current_location_id', flat=True).first() or
+            Location.objects.values_list('id', flat=True).first())
+        latest = Movement.objects.order_by('-id').values_list('date', flat=True).first()
+        self.today = timezone.localdate()
+        self.day = movement_day(latest) if latest else self.today
+
+    def range(self, size):
+        last = '{}{}'.format(self.prefix, str(self.number + size - 1).zfill(self.width))
+        return '{}-{}'.format(self.pipe.name, last)
+
+
+def _get(client, url, params=None):
+    def run():
+        response = client.get(url, params or {})
+        if response.status_code != 200:
+            raise BenchmarkError('{} respondió {}'.format(url, response.status_code))
+    return run
+
+
+def _action(client, data):
+    def run():
+        response = client.post(reverse('admin:entities_covidpipe_changelist'), data)
+        if response.status_code != 302:
+            raise BenchmarkError('La acción {} respondió {}'.format(
+                data['action'], response.status_code))
+    return run
+
+
+def _range_creation(size):
+    def run():
+        form = CovidPipeForm(data={
+            'name': '', 'range_pipes': '{0}{1}-{0}{2}'.format(RANGE_PREFIX, 1, size)})
+        if not form.is_valid():
+            raise BenchmarkError(form.errors.as_text())
+        form.save(commit=False)
+    return run
+
+
+def benchmarks(client, sample, sizes=DEFAULT_SIZES):
+    pipes = reverse('admin:entities_covidpipe_changelist')
+    movements = reverse('admin:entities_movement_changelist')
+    month_ago = (sample.today - timedelta(days=30)).isoformat()
+    today = sample.today.isoformat()
+    cases = [
+        Benchmark('pipe_changelist', _get(client, pipes)),
+        Benchmark('pipe_changelist:search', _get(client, pipes, {'q': sample.pipe.name})),
+        Benchmark('pipe_changelist:con_muestra', _get(client, pipes, {'con_muestra__exact': 1})),
+        Benchmark('pipe_changelist:location', _get(client, pipes, {'last_movement': sample.location})),
+        Benchmark('pipe_changelist:location_empty', _get(client, pipes, {'last_movement': 'empty'})),
+        Benchmark('pipe_changelist:date_created', _get(client, pipes, {
+            'current_date_created__range__gte': month_ago,
+            'current_date_created__range__lte': today})),
+        Benchmark('pipe_changelist:date_sent', _get(client, pipes, {
+            'current_date_sent__range__gte': month_ago,
+            'current_date_sent__range__lte': today})),
+        Benchmark('movement_changelist', _get(client, movements)),
+        Benchmark('movement_changelist:date', _get(client, movements, {'date': sample.day.isoformat()})),
+        Benchmark('movement_changelist:origin', _get(client, movements, {'origin': sample.location})),
+        Benchmark('movement_changelist:destination', _get(client, movements, {'destination': sample.location})),
+        Benchmark('movement_changelist:pipe', _get(client, movements, {'pipe': sample.pipe.pk})),
+    ]
+    for size in sizes:
+        cases += [
+            Benchmark('move:{}'.format(size), _action(client, {
+                'action': 'move', 'apply': 'move', '_selected_action': [sample.pipe.pk],
+                'location': sample.location, 'rango': sample.range(size),
+                'con_muestra': 'on', 'description': 'benchmark'})),
+            Benchmark('update_dates:{}'.format(size), _action(client, {
+                'action': 'update_dates', 'apply': 'update_dates',
+                '_selected_action': [sample.pipe.pk], 'rango': sample.range(size),
+                'estado': 'enviado', 'created': month_ago, 'moved': today})),
+            Benchmark('range_create:{}'.format(size), _range_creation(size)),
+        ]
+    return cases
+
+
+def measure(run, repeat=DEFAULT_REPEAT):
+    """Run ``run`` ``repeat`` times, rolling back each time.
+
+    Returns the median and best wall time in seconds and the queries of
+    the last run, savepoints included.
+    """
+    timings = []
+    for _ in range(repeat):
+        with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+            transaction.set_rollback(True)
+    return {
+        'seconds': round(statistics.median(timings), 6),
+        'best': round(min(timings), 6),
+        'queries': len(queries.captured_queries),
+    }
+
+
+def run_benchmarks(only=None, sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, progress=None):
+    """Measure every benchmark, or those named, or grouped, in ``only``.
+
+    The group of ``move:1000`` is ``move``.
+
+    Returns a report ready to be dumped as JSON; ``progress`` is called with
+    each benchmark name and result.
+    """
+    report = {
+        'created': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'pipes': CovidPipe.objects.count(),
+        'movements': Movement.objects.count(),
+        'repeat': repeat,
+        'results': {},
+    }
+    with transaction.atomic(), override_settings(
+            ALLOWED_HOSTS=['*'], JOB_THRESHOLD=sys.maxsize):
+        user = get_user_model().objects.create_superuser('benchmark@example.com', None)
+        client = Client()
+        client.force_login(user)
+        for benchmark in benchmarks(client, Sample(), sizes):
+            if only and not {benchmark.name, benchmark.name.split(':')[0]} & set(only):
+                continue
+            result = report['results'][benchmark.name] = measure(benchmark.run, repeat)
+            if progress is not None:
+                progress(benchmark.name, result)
+        transaction.set_rollback(True)
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Return the benchmarks slower than the baseline by more than
+    ``tolerance``, or running more queries.
+    """
+    regressions = []
+    for name, current in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            continue
+        if (current['seconds'] > previous['seconds'] * (1 + tolerance) or
+                current['queries'] > previous['queries']):
+            regressions.append(Regression(name, previous, current))
+    return regressions
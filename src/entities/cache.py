@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+
+from helpers.metrics import register_collector
+
+from entities.models import CovidPipe, Location
+
+# Safety net for workers whose local cache missed an invalidation
+CHOICES_TIMEOUT = 300
+
+CHOICES_KEY = 'entities:choices:{}'
+
+VERSION_KEY = 'entities:version:{}'
+
+# Entries kept by each worker process
+PIPE_CACHE_SIZE = 50000
+LOCATION_CACHE_SIZE = 1000
+
+
+def _cached_choices(name, build):
+    key = CHOICES_KEY.format(name)
+    choices = cache.get(key)
+    if choices is None:
+        choices = build()
+        cache.set(key, choices, CHOICES_TIMEOUT)
+    return choices
+
+
+def location_choices():
+    """Return ``(id, name)`` for every location, served from the cache."""
+    return _cached_choices('locations', lambda: list(
+        Location.objects.order_by('name').values_list('id', 'name')))
+
+
+def invalidate_choices(*names):
+    """Drop the cached choices now and again once the transaction commits.
+
+    The second delete discards entries rebuilt by another request from data
+    read before the commit.
+    """
+    keys = [CHOICES_KEY.format(name) for name in names]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class LocalCache:
+    """A bounded LRU kept by each worker process, with shared invalidation.
+
+    Writers bump a version counter in the Django cache; a worker that sees
+    a new version drops all its entries before answering, so renames and
+    deletes are never served stale. Without ``PROCESS_CACHES``, which
+    requires that cache to be shared, every lookup goes to ``load``.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.version_key = VERSION_KEY.format(name)
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _sync(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            # Time based, so a counter lost by the shared cache never repeats
+            cache.add(self.version_key, int(time.time() * 1000), None)
+            version = cache.get(self.version_key)
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def get_many(self, keys, load):
+        """Return ``{key: value}`` for the ``keys`` found.
+
+        Misses are passed to ``load``, which returns a mapping of the ones
+        that exist.
+        """
+        if not settings.PROCESS_CACHES:
+            with self.lock:
+                self.misses += len(keys)
+            return load(keys)
+
+        with self.lock:
+            self._sync()
+            version = self.version
+            found = {}
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+            missing = [key for key in keys if key not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = load(missing)
+            with self.lock:
+                # Loaded under an older version: serve it but don't keep it
+                if self.version == version:
+                    self.entries.update(loaded)
+                    while len(self.entries) > self.maxsize:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+            found.update(loaded)
+        return found
+
+    def invalidate(self):
+        """Start a new version now and again once the transaction commits."""
+        def bump():
+            try:
+                cache.incr(self.version_key)
+            except ValueError:
+                cache.set(self.version_key, int(time.time() * 1000), None)
+        bump()
+        transaction.on_commit(bump)
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'invalidations': self.invalidations, 'size': len(self.entries),
+            'maxsize': self.maxsize,
+        }
+
+
+def check_shared_cache():
+    """Refuse to start with process caches the other workers can't invalidate."""
+    if settings.PROCESS_CACHES and isinstance(caches['default'], (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            "PROCESS_CACHES needs a CACHE_URL shared by every process, "
+            "not {}".format(type(caches['default']).__name__))
+
+
+PIPE_IDS = LocalCache('pipe-ids', PIPE_CACHE_SIZE)
+LOCATIONS = LocalCache('locations', LOCATION_CACHE_SIZE)
+
+
+def pipe_ids(names):
+    """Return a ``{name: id}`` mapping for the existing pipes among ``names``.
+
+    Names are served from the worker's cache, with one query for the misses.
+    """
+    return PIPE_IDS.get_many(list(names), lambda missing: dict(
+        CovidPipe.objects.filter(name__in=missing).values_list('name', 'id')))
+
+
+def invalidate_pipe_ids():
+    PIPE_IDS.invalidate()
+
+
+def _load_locations(keys):
+    ids = [value for field, value in keys if field == 'id']
+    names = [value for field, value in keys if field == 'name']
+    loaded = {}
+    for location in Location.objects.filter(Q(id__in=ids) | Q(name__in=names)):
+        loaded['id', location.pk] = loaded['name', location.name] = location
+    return loaded
+
+
+def get_location(value):
+    """Return the location with the id, or else the name, ``value``, or None."""
+    value = str(value or '').strip()
+    key = ('id', int(value)) if value.isdigit() else ('name', value)
+    return LOCATIONS.get_many([key], _load_locations).get(key)
+
+
+def invalidate_locations():
+    LOCATIONS.invalidate()
+
+
+def cache_stats():
+    return {local.name: local.stats() for local in (PIPE_IDS, LOCATIONS)}
+
+
+def _cache_metrics():
+    for local in (PIPE_IDS, LOCATIONS):
+        yield 'cache_hits_total', {'cache': local.name}, local.hits
+        yield 'cache_misses_total', {'cache': local.name}, local.misses
+
+
+register_collector(_cache_metrics)
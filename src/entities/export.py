@@ -0,0 +1,56 @@
+import csv
+
+from django.contrib.admin.views.main import ChangeList
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from entities.models import Movement
+
+EXPORT_CHUNK_SIZE = 2000
+
+PIPE_COLUMNS = (
+    ('name', 'Pipe'),
+    ('con_muestra', 'Con muestra'),
+    ('current_origin__name', 'Origen'),
+    ('current_location__name', 'Destino'),
+    ('current_state', 'Estado'),
+    ('current_date_created', 'Fecha de preparación'),
+    ('current_date_sent', 'Fecha de envío'),
+    ('last_moved_at', 'Último movimiento'),
+)
+
+
+class Echo:
+    """File-like object whose write returns the value, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+class ExportChangeList(ChangeList):
+    """Applies the changelist filters, search and ordering without paging."""
+
+    def get_results(self, request):
+        pass
+
+
+def pipe_rows(queryset):
+    """Yield the inventory header and one row per pipe, in server-side chunks."""
+    states = dict(Movement.STATES)
+    fields = [field for field, _ in PIPE_COLUMNS]
+    yield [title for _, title in PIPE_COLUMNS]
+    for row in queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        row = list(row)
+        row[4] = states.get(row[4], '')
+        if row[7]:
+            row[7] = timezone.localtime(row[7]).strftime('%Y-%m-%d %H:%M')
+        yield ['' if value is None else value for value in row]
+
+
+def pipe_csv_response(queryset, filename='pipes.csv'):
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in pipe_rows(queryset)),
+        content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -1,11 +1,28 @@
-import re
 from django import forms
-from entities.models import CovidPipe
+from entities.jobs import enqueue, is_large
+from entities.models import CovidPipe, Job
+from entities.ranges import RangeExpressionError, parse_range
+from entities.services import create_pipes
 
 
 class CovidPipeForm(forms.ModelForm):
     range_pipes = forms.CharField(required=False)
 
+    range_result = None
+    range_job = None
+
+    def clean_range_pipes(self):
+        range_pipes = self.cleaned_data.get('range_pipes', None)
+        if not range_pipes:
+            return range_pipes
+
+        try:
+            self.pipe_names = parse_range(range_pipes).names()
+        except RangeExpressionError as e:
+            raise forms.ValidationError(str(e))
+
+        return range_pipes
+
     def save(self, commit=True):
         range_pipes = self.cleaned_data.get('range_pipes', None)
         if not range_pipes:
@@ -14,32 +31,15 @@ class CovidPipeForm(forms.ModelForm):
         last_movement = self.cleaned_data.get('last_movement', None)
         instance = super(CovidPipeForm, self).save(commit=False)
 
-        try:
-            numbers = range_pipes.split('-')
-            match_0 = re.match(r"([a-z]+)([0-9]+)", numbers[0], re.I)
-            match_1 = re.match(r"([a-z]+)([0-9]+)", numbers[1], re.I)
-            items_0 = None
-            if match_0:
-                items_0 = match_0.groups()
-
-            items_1 = None
-            if match_1:
-                items_1 = match_1.groups()
-            
-            if match_0 and match_1:
-                for i in range(int(items_0[1]), int(items_1[1])+1):
-                    CovidPipe.objects.create(
-                        name="{}{}".format(items_0[0], str(i)),
-                        last_movement=last_movement)
-                
-            else:
-                for i in range(int(numbers[0]), int(numbers[1])+1):
-                    CovidPipe.objects.create(
-                        name=str(i),
-                        last_movement=last_movement)
-
-        except Exception as e:
-            raise(e)
+        if is_large(len(self.pipe_names)):
+            self.range_job = enqueue(Job.CREATE_PIPES, {
+                'names': self.pipe_names,
+                'last_movement': last_movement.pk if last_movement else None,
+            }, len(self.pipe_names))
+            return instance
+
+        self.range_result = create_pipes(
+            self.pipe_names, last_movement=last_movement)
 
         return instance
 
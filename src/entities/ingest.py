@@ -0,0 +1,167 @@
+import csv
+import json
+from collections import namedtuple
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from entities.models import CovidPipe, Location, Movement
+from entities.rollups import record_movements
+from entities.services import BULK_BATCH_SIZE, sync_current_state
+
+INGEST_BATCH_SIZE = 2000
+MAX_REJECTS = 1000
+
+Scan = namedtuple('Scan', ['line', 'pipe', 'destination', 'date', 'description'])
+IngestResult = namedtuple('IngestResult', ['accepted', 'rejected', 'rejected_count'])
+
+
+class ScanError(ValueError):
+    pass
+
+
+def _lines(stream):
+    for line in stream:
+        yield line.decode('utf-8') if isinstance(line, bytes) else line
+
+
+def parse_csv(stream):
+    """Yield ``(line, record)`` from CSV with a pipe,destination,date,description header."""
+    reader = csv.DictReader(_lines(stream))
+    for record in reader:
+        yield reader.line_num, record
+
+
+def parse_ndjson(stream):
+    """Yield ``(line, record)`` from one JSON object per line."""
+    for number, line in enumerate(_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else ScanError('JSON inválido')
+
+
+def _scan(line, record):
+    if isinstance(record, ScanError):
+        raise record
+    pipe = str(record.get('pipe') or '').strip()
+    destination = str(record.get('destination') or '').strip()
+    if not pipe or not destination:
+        raise ScanError('Faltan pipe o destination')
+
+    date = record.get('date') or None
+    if date:
+        try:
+            date = parse_datetime(str(date))
+        except ValueError:
+            date = None
+        if date is None:
+            raise ScanError('Fecha inválida')
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+
+    return Scan(line, pipe, destination, date, str(record.get('description') or '')[:200])
+
+
+class Ingestion:
+    """Load scan records as movements, a batch at a time.
+
+    Each batch resolves its pipes with one query, is inserted with batched
+    INSERTs and re-points the pipes' current movement with one UPDATE, all
+    in its own transaction. Locations are resolved by name or id with one
+    query per batch.
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = []
+        self.rejected_count = 0
+
+    def resolve_destinations(self, keys):
+        """Map the destination ``keys`` of a batch to location ids, by name or else by id.
+
+        Looked up with one query per batch rather than from the cached
+        choices, which can miss new locations and keep deleted ones.
+        """
+        rows = Location.objects.filter(
+            Q(pk__in={int(key) for key in keys if key.isdigit()}) | Q(name__in=keys)
+        ).values_list('id', 'name')
+        ids = {str(pk): pk for pk, _ in rows}
+        names = {name: pk for pk, name in rows}
+        return {key: names.get(key, ids.get(key)) for key in keys if key in names or key in ids}
+
+    def reject(self, line, error):
+        self.rejected_count += 1
+        if len(self.rejected) < MAX_REJECTS:
+            self.rejected.append({'line': line, 'error': str(error)})
+
+    def load(self, records):
+        records = iter(records)
+        batch = list(islice(records, INGEST_BATCH_SIZE))
+        while batch:
+            self.load_batch(batch)
+            batch = list(islice(records, INGEST_BATCH_SIZE))
+        self.rejected.sort(key=lambda reject: reject['line'])
+        return IngestResult(self.accepted, self.rejected, self.rejected_count)
+
+    def load_batch(self, records):
+        scans = []
+        for line, record in records:
+            try:
+                scans.append(_scan(line, record))
+            except ScanError as e:
+                self.reject(line, e)
+
+        now = timezone.now()
+        scans.sort(key=lambda scan: (scan.date or now, scan.line))
+
+        with transaction.atomic():
+            destinations = self.resolve_destinations({scan.destination for scan in scans})
+            pipes = {
+                name: [pk, location, con_muestra]
+                for name, pk, location, con_muestra in CovidPipe.objects.filter(
+                    name__in={scan.pipe for scan in scans}
+                ).values_list('name', 'id', 'current_location_id', 'con_muestra')
+            }
+
+            movements = []
+            for scan in scans:
+                pipe = pipes.get(scan.pipe)
+                destination = destinations.get(scan.destination)
+                if pipe is None:
+                    self.reject(scan.line, 'Pipe no existe: {}'.format(scan.pipe))
+                    continue
+                if destination is None:
+                    self.reject(scan.line, 'Destino no existe: {}'.format(scan.destination))
+                    continue
+                movements.append(Movement(
+                    pipe_id=pipe[0], origin_id=pipe[1], destination_id=destination,
+                    date=scan.date or now, description=scan.description))
+                # Later scans of the same pipe in the batch start from here
+                pipe[1] = destination
+
+            if movements:
+                Movement.objects.bulk_create(movements, batch_size=BULK_BATCH_SIZE)
+                sync_current_state({movement.pipe_id for movement in movements})
+                con_muestra = {pk: flag for pk, _, flag in pipes.values()}
+                record_movements(
+                    (movement.date, movement.origin_id, movement.destination_id,
+                     con_muestra[movement.pipe_id])
+                    for movement in movements)
+
+        self.accepted += len(movements)
+
+
+def ingest(stream, content_type='text/csv'):
+    """Ingest a CSV or NDJSON stream of scans, see ``Ingestion``."""
+    if 'json' in content_type:
+        records = parse_ndjson(stream)
+    else:
+        records = parse_csv(stream)
+    return Ingestion().load(records)
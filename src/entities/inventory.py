@@ -0,0 +1,92 @@
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from entities.models import CovidPipe, Location, LocationInventory
+
+
+def inventory_deltas(before, after):
+    """Return the counter changes for pipes going from ``before`` to ``after``.
+
+    Both are iterables of ``(location_id, con_muestra)`` keys, one per pipe.
+    """
+    deltas = Counter(after)
+    deltas.subtract(before)
+    return deltas
+
+
+def _keys_q(keys):
+    return reduce(or_, (
+        Q(location_id=location_id, con_muestra=con_muestra)
+        for location_id, con_muestra in keys))
+
+
+def _add(keys, deltas):
+    return LocationInventory.objects.filter(_keys_q(keys)).update(count=F('count') + Case(
+        *(When(location_id=key[0], con_muestra=key[1], then=Value(deltas[key]))
+          for key in keys),
+        default=Value(0), output_field=IntegerField()))
+
+
+def apply_inventory(deltas):
+    """Add ``deltas``, a mapping of ``(location_id, con_muestra)`` to a change
+    in pipes, to the location counters.
+
+    Pipes without a location are not counted. Every key is updated by one
+    UPDATE; counter rows that don't exist yet are inserted first.
+    """
+    keys = sorted(key for key, delta in deltas.items() if key[0] is not None and delta)
+    if not keys:
+        return
+
+    with transaction.atomic(savepoint=False):
+        if _add(keys, deltas) == len(keys):
+            return
+        existing = set(LocationInventory.objects.filter(
+            _keys_q(keys)).values_list('location_id', 'con_muestra'))
+        missing = [key for key in keys if key not in existing]
+        LocationInventory.objects.bulk_create([
+            LocationInventory(location_id=location_id, con_muestra=con_muestra)
+            for location_id, con_muestra in missing], ignore_conflicts=True)
+        _add(missing, deltas)
+
+
+def create_inventory(location_ids):
+    """Insert the empty counters of new locations."""
+    LocationInventory.objects.bulk_create([
+        LocationInventory(location_id=location_id, con_muestra=con_muestra)
+        for location_id in location_ids for con_muestra in (False, True)
+    ], ignore_conflicts=True)
+
+
+def rebuild_inventory():
+    """Recompute every counter from the pipes' current location."""
+    counts = {
+        (row['current_location_id'], row['con_muestra']): row['total']
+        for row in CovidPipe.objects.filter(current_location__isnull=False).values(
+            'current_location_id', 'con_muestra').annotate(total=Count('id')).order_by()
+    }
+    with transaction.atomic():
+        LocationInventory.objects.all().delete()
+        LocationInventory.objects.bulk_create((
+            LocationInventory(
+                location_id=location_id, con_muestra=con_muestra,
+                count=counts.get((location_id, con_muestra), 0))
+            for location_id in Location.objects.values_list('id', flat=True).iterator()
+            for con_muestra in (False, True)), batch_size=1000)
+        return sum(counts.values())
+
+
+def inventory_report():
+    """Return the pipes at each location, with and without sample."""
+    return list(LocationInventory.objects.values(
+        'location_id', 'location__name',
+    ).annotate(
+        with_sample=Coalesce(Sum('count', filter=Q(con_muestra=True)), 0),
+        without_sample=Coalesce(Sum('count', filter=Q(con_muestra=False)), 0),
+        total=Sum('count'),
+    ).order_by('location__name'))
@@ -0,0 +1,142 @@
+import json
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from entities.models import CovidPipe, Job, Location, Movement
+from entities.services import create_pipes, move_pipes, update_last_movements
+
+# Pipes handled per transaction; progress is reported after each chunk
+JOB_CHUNK_SIZE = 1000
+
+# Missing names kept in a job's result
+MAX_REPORTED_MISSING = 100
+
+
+def is_large(total):
+    return total > settings.JOB_THRESHOLD
+
+
+def enqueue(kind, payload, total, user=None):
+    return Job.objects.create(
+        kind=kind, payload=json.dumps(payload, cls=DjangoJSONEncoder),
+        total=total, user=user)
+
+
+def requeue_stale_jobs():
+    """Queue again the running jobs that reported no progress for
+    ``JOB_STALE_AFTER`` seconds, left behind by a worker that was killed.
+
+    They start over; every job kind skips the pipes it already handled.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER)
+    return Job.objects.filter(status=Job.RUNNING, updated__lt=stale).update(
+        status=Job.QUEUED, progress=0, started=None, updated=timezone.now())
+
+
+def claim_job():
+    """Mark the oldest queued job as running and return it, or None.
+
+    Rows locked by another worker are skipped, so several workers can
+    poll the same table. Stale running jobs are queued again first.
+    """
+    requeue_stale_jobs()
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            status=Job.QUEUED).order_by('id').first()
+        if job is None:
+            return None
+        job.status = Job.RUNNING
+        job.started = timezone.now()
+        job.save(update_fields=['status', 'started', 'updated'])
+    return job
+
+
+def _batches(payload):
+    """Yield the pipes of a job in chunks, with the names they were asked by."""
+    if 'names' in payload:
+        items, lookup = payload['names'], 'name__in'
+    else:
+        items, lookup = payload['ids'], 'id__in'
+    for i in range(0, len(items), JOB_CHUNK_SIZE):
+        chunk = items[i:i + JOB_CHUNK_SIZE]
+        yield (CovidPipe.objects.filter(**{lookup: chunk}), chunk,
+               chunk if 'names' in payload else None)
+
+
+def _missing(missing):
+    return {'missing': missing[:MAX_REPORTED_MISSING], 'missing_count': len(missing)}
+
+
+def _move(payload, report):
+    location = Location.objects.get(pk=payload['location'])
+    moved = skipped = 0
+    missing = []
+    for pipes, chunk, names in _batches(payload):
+        result = move_pipes(
+            pipes, location, description=payload['description'],
+            con_muestra=payload['con_muestra'], names=names)
+        moved += result.moved
+        skipped += result.skipped
+        missing.extend(result.missing)
+        report(len(chunk))
+    return dict(moved=moved, skipped=skipped, **_missing(missing))
+
+
+def _update_dates(payload, report):
+    affected = 0
+    missing = []
+    for pipes, chunk, names in _batches(payload):
+        result = update_last_movements(
+            pipes, state=payload['state'], date_created=payload['date_created'],
+            date_sent=payload['date_sent'], names=names)
+        affected += result.affected
+        missing.extend(result.missing)
+        report(len(chunk))
+    return dict(affected=affected, **_missing(missing))
+
+
+def _create_pipes(payload, report):
+    last_movement = None
+    if payload.get('last_movement'):
+        last_movement = Movement.objects.get(pk=payload['last_movement'])
+    created = existing = 0
+    names = payload['names']
+    for i in range(0, len(names), JOB_CHUNK_SIZE):
+        chunk = names[i:i + JOB_CHUNK_SIZE]
+        result = create_pipes(chunk, last_movement=last_movement)
+        created += len(result.created)
+        existing += len(result.existing)
+        report(len(chunk))
+    return {'created': created, 'existing': existing}
+
+
+HANDLERS = {
+    Job.MOVE: _move,
+    Job.UPDATE_DATES: _update_dates,
+    Job.CREATE_PIPES: _create_pipes,
+}
+
+
+def run_job(job):
+    """Run a claimed job, recording its progress, result or error."""
+    def report(count):
+        job.progress = min(job.progress + count, job.total)
+        Job.objects.filter(pk=job.pk).update(progress=job.progress, updated=timezone.now())
+
+    try:
+        result = HANDLERS[job.kind](json.loads(job.payload), report)
+    except Exception:
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = Job.DONE
+        job.progress = job.total
+        job.result = json.dumps(result, cls=DjangoJSONEncoder)
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'progress', 'result', 'error', 'finished', 'updated'])
+    return job
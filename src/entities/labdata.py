@@ -0,0 +1,137 @@
+"""Synthetic lab data for the benchmarks in ``entities.benchmarks``.
+
+Pipes are named ``<prefix><number>`` with seven zero padded digits, spread
+evenly over the prefixes; some of them are aliases of the pipe before
+them, so alias chains of several links appear. Each pipe gets its share of
+the movements, hopping between random locations over the last ``days``
+days, and ends up at the destination of its last one. Rows are written
+with ``bulk_create``, so signals don't fire: the current state snapshot,
+location inventory and daily rollup are computed afterwards.
+"""
+import random
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from entities.cache import invalidate_choices, invalidate_locations, invalidate_pipe_ids
+from entities.inventory import rebuild_inventory
+from entities.models import CovidPipe, Location, Movement
+from entities.rollups import rebuild_rollup
+from entities.services import BULK_BATCH_SIZE, sync_current_state
+
+DEFAULT_PREFIXES = ('HSJ', 'LAB', 'UCV', 'PRV')
+DEFAULT_LOCATIONS = 50
+DEFAULT_DAYS = 180
+NAME_WIDTH = 7
+
+# Pipes written per transaction, with their movements
+SEED_BATCH_SIZE = 2000
+
+SeedResult = namedtuple('SeedResult', ['pipes', 'movements', 'locations', 'aliases'])
+
+
+class LabDataExists(Exception):
+    pass
+
+
+def _batch_size(model, objs):
+    # Django 2.2 doesn't cap an explicit batch size to the backend's limit
+    return min(BULK_BATCH_SIZE, connection.ops.bulk_batch_size(
+        model._meta.concrete_fields, objs))
+
+
+def pipe_name(prefix, number):
+    return '{}{}'.format(prefix, str(number).zfill(NAME_WIDTH))
+
+
+def _pipe_names(pipes, prefixes):
+    per_prefix, remainder = divmod(pipes, len(prefixes))
+    for index, prefix in enumerate(prefixes):
+        for number in range(1, per_prefix + (index < remainder) + 1):
+            yield pipe_name(prefix, number)
+
+
+def _seed_locations(count):
+    names = ['Laboratorio {:03d}'.format(i) for i in range(1, count + 1)]
+    Location.objects.bulk_create(
+        [Location(name=name) for name in names], ignore_conflicts=True)
+    invalidate_choices('locations')
+    invalidate_locations()
+    return list(Location.objects.filter(name__in=names).values_list('id', flat=True))
+
+
+def _movements(rng, pipe_id, count, locations, start, span):
+    """Return ``count`` movements of one pipe, oldest first."""
+    offsets = sorted(rng.random() * span for _ in range(count))
+    origin = None
+    movements = []
+    for offset in offsets:
+        destination = rng.choice(locations)
+        date = start + timedelta(seconds=offset)
+        state = rng.choice((Movement.CREATED, Movement.SENT))
+        movements.append(Movement(
+            pipe_id=pipe_id, origin_id=origin, destination_id=destination,
+            date=date, state=state, date_created=date.date(),
+            date_sent=date.date() if state == Movement.SENT else None))
+        origin = destination
+    return movements
+
+
+def _seed_batch(rng, names, movement_counts, locations, alias_ratio, start, span):
+    with transaction.atomic():
+        pipes = [CovidPipe(name=name, con_muestra=rng.random() < 0.5) for name in names]
+        for pipe in pipes:
+            pipe.refresh_name_keys()
+        CovidPipe.objects.bulk_create(pipes, batch_size=_batch_size(CovidPipe, pipes))
+        ids = dict(CovidPipe.objects.filter(name__in=names).values_list('name', 'id'))
+
+        movements = []
+        for name, count in zip(names, movement_counts):
+            movements.extend(_movements(rng, ids[name], count, locations, start, span))
+        Movement.objects.bulk_create(movements, batch_size=_batch_size(Movement, movements))
+
+        aliases = [
+            CovidPipe(id=ids[name], alias_id=ids[previous])
+            for previous, name in zip(names, names[1:]) if rng.random() < alias_ratio]
+        CovidPipe.objects.bulk_update(aliases, ['alias'], batch_size=BULK_BATCH_SIZE)
+
+        sync_current_state(list(ids.values()))
+    return len(movements), len(aliases)
+
+
+def seed_lab_data(pipes, movements, locations=DEFAULT_LOCATIONS, prefixes=DEFAULT_PREFIXES,
+                  alias_ratio=0.02, days=DEFAULT_DAYS, batch_size=SEED_BATCH_SIZE,
+                  seed=0, progress=None):
+    """Generate ``pipes`` pipes with ``movements`` movements between them.
+
+    The same ``seed`` generates the same data. ``progress`` is called with
+    the pipes written so far after each batch. Raises ``LabDataExists`` if
+    pipes with any of the ``prefixes`` are already there.
+    """
+    if CovidPipe.objects.filter(name_prefix__in=prefixes).exists():
+        raise LabDataExists(
+            'Ya existen pipes con los prefijos {}'.format(', '.join(prefixes)))
+    rng = random.Random(seed)
+    location_ids = _seed_locations(locations)
+    span = timedelta(days=days).total_seconds()
+    start = timezone.now() - timedelta(days=days)
+    per_pipe, remainder = divmod(movements, pipes) if pipes else (0, 0)
+
+    names = list(_pipe_names(pipes, prefixes))
+    written = aliases = 0
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i + batch_size]
+        counts = [per_pipe + (i + j < remainder) for j in range(len(batch))]
+        batch_movements, batch_aliases = _seed_batch(
+            rng, batch, counts, location_ids, alias_ratio, start, span)
+        written += batch_movements
+        aliases += batch_aliases
+        if progress is not None:
+            progress(i + len(batch))
+
+    invalidate_pipe_ids()
+    rebuild_inventory()
+    rebuild_rollup()
+    return SeedResult(len(names), written, len(location_ids), aliases)
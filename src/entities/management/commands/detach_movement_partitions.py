@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from entities.partitions import PartitionInUse, detach_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = "Detach the monthly movement partitions older than a date"
+
+    def add_arguments(self, parser):
+        parser.add_argument('before', help="First month to keep, as YYYY-MM-DD")
+        parser.add_argument(
+            '--drop', action='store_true', help="Drop the detached tables too")
+
+    def handle(self, *args, **options):
+        before = parse_date(options['before'])
+        if before is None:
+            raise CommandError("Use el formato AAAA-MM-DD")
+        if not is_partitioned():
+            raise CommandError("The movement table is not partitioned")
+        try:
+            detached = detach_partitions(before, drop=options['drop'])
+        except PartitionInUse as e:
+            raise CommandError(str(e))
+        self.stdout.write("Detached partitions: {}".format(', '.join(detached) or '-'))
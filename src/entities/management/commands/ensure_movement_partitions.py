@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from entities.partitions import MONTHS_AHEAD, ensure_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = "Create the monthly movement partitions for the coming months"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=MONTHS_AHEAD,
+            help="Months to create ahead of the current one")
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write("The movement table is not partitioned")
+            return
+        created = ensure_partitions(options['months'])
+        self.stdout.write("Created partitions: {}".format(', '.join(created) or '-'))
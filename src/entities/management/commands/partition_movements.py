@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from entities.partitions import (
+    list_partitions, partition_movements, supports_partitioning, unpartition_movements)
+
+
+class Command(BaseCommand):
+    help = ("Convert the movement table to monthly partitions, or back with --undo. "
+            "Movements can't be read or written until the copy finishes")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--undo', action='store_true', help="Copy the rows back into a plain table")
+
+    def handle(self, *args, **options):
+        if not supports_partitioning():
+            raise CommandError("Partitioning needs PostgreSQL 11 or later")
+        if options['undo']:
+            if unpartition_movements():
+                self.stdout.write("The movement table is no longer partitioned")
+            else:
+                self.stdout.write("The movement table is not partitioned")
+            return
+        if not partition_movements():
+            self.stdout.write("The movement table is already partitioned")
+            return
+        self.stdout.write("Created partitions: {}".format(
+            ', '.join(partition.name for partition in list_partitions())))
@@ -0,0 +1,35 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from helpers.startup import (
+    pending_migrations, static_fingerprint, static_is_current, write_static_stamp)
+
+
+class Command(BaseCommand):
+    help = ("Migrate, create the coming movement partitions and collect static files, "
+            "skipping migrate and collectstatic when nothing changed since the last start")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--skip-static', action='store_true', help="Don't collect static files")
+        parser.add_argument(
+            '--force', action='store_true',
+            help="Run migrate and collectstatic even if nothing changed")
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+        if options['force'] or pending_migrations():
+            call_command('migrate', interactive=False, verbosity=verbosity, stdout=self.stdout)
+        else:
+            self.stdout.write("No migrations to apply")
+
+        call_command('ensure_movement_partitions', verbosity=verbosity, stdout=self.stdout)
+
+        if options['skip_static']:
+            return
+        fingerprint = static_fingerprint()
+        if options['force'] or not static_is_current(fingerprint):
+            call_command('collectstatic', interactive=False, verbosity=verbosity, stdout=self.stdout)
+            write_static_stamp(fingerprint)
+        else:
+            self.stdout.write("Static files are up to date")
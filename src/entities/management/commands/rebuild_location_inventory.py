@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from entities.inventory import rebuild_inventory
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-location pipe counters from the pipes' current location"
+
+    def handle(self, *args, **options):
+        pipes = rebuild_inventory()
+        self.stdout.write("Rebuilt location inventory: {} pipes".format(pipes))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from entities.rollups import rebuild_rollup
+
+
+class Command(BaseCommand):
+    help = "Recompute the daily movement rollup from the movement table"
+
+    def handle(self, *args, **options):
+        rows = rebuild_rollup()
+        self.stdout.write("Rebuilt daily movement rollup: {} rows".format(rows))
@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from entities.benchmarks import DEFAULT_REPEAT, DEFAULT_SIZES, compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Time the admin and bulk paths against the current data and write a JSON report"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='benchmarks.json')
+        parser.add_argument(
+            '--baseline', help="Report of an earlier run to compare against")
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help="Slowdown over the baseline reported as a regression")
+        parser.add_argument(
+            '--fail-on-regression', action='store_true',
+            help="Exit with an error when a benchmark regressed")
+        parser.add_argument(
+            '--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+            help="Comma separated range sizes for move, update_dates and range_create")
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+        parser.add_argument(
+            '--only', action='append',
+            help="Run only this benchmark, or group such as move; repeatable")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        def progress(name, result):
+            self.stdout.write("{:<40} {:>10.4f}s {:>6} queries".format(
+                name, result['seconds'], result['queries']))
+
+        report = run_benchmarks(
+            only=options['only'], repeat=options['repeat'], progress=progress,
+            sizes=[int(size) for size in options['sizes'].split(',') if size.strip()])
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        self.stdout.write("Report written to {}".format(options['output']))
+
+        if baseline is None:
+            return
+        regressions = compare(report, baseline, options['tolerance'])
+        for name, previous, current in regressions:
+            self.stdout.write("Regression {}: {:.4f}s -> {:.4f}s, {} -> {} queries".format(
+                name, previous['seconds'], current['seconds'],
+                previous['queries'], current['queries']))
+        if not regressions:
+            self.stdout.write("No regressions against {}".format(options['baseline']))
+        elif options['fail_on_regression']:
+            raise CommandError("{} benchmarks regressed".format(len(regressions)))
@@ -0,0 +1,41 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from entities.jobs import claim_job, run_job
+from helpers import metrics
+
+
+class Command(BaseCommand):
+    help = "Run queued admin jobs, polling the job table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', help="Exit when the queue is empty")
+        parser.add_argument(
+            '--interval', type=float, default=settings.JOB_POLL_INTERVAL,
+            help="Seconds to wait between polls of an empty queue")
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        # Finish the current job before exiting on a deploy
+        signal.signal(signal.SIGTERM, self.stop)
+
+        while not self.stopping:
+            close_old_connections()
+            job = claim_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+            self.stdout.write("Running job {}".format(job))
+            job = run_job(job)
+            metrics.flush()
+            self.stdout.write("Job {}: {}".format(job, job.get_status_display()))
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from entities.labdata import (
+    DEFAULT_DAYS, DEFAULT_LOCATIONS, DEFAULT_PREFIXES, SEED_BATCH_SIZE,
+    LabDataExists, seed_lab_data)
+
+
+class Command(BaseCommand):
+    help = "Generate synthetic pipes, aliases and movements for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pipes', type=int, default=100000)
+        parser.add_argument('--movements', type=int, default=1000000)
+        parser.add_argument('--locations', type=int, default=DEFAULT_LOCATIONS)
+        parser.add_argument(
+            '--prefixes', default=','.join(DEFAULT_PREFIXES),
+            help="Comma separated name prefixes the pipes are spread over")
+        parser.add_argument(
+            '--aliases', type=float, default=0.02,
+            help="Share of pipes that are an alias of the previous one")
+        parser.add_argument(
+            '--days', type=int, default=DEFAULT_DAYS,
+            help="Movements are dated over this many past days")
+        parser.add_argument('--batch-size', type=int, default=SEED_BATCH_SIZE)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        pipes = options['pipes']
+
+        def progress(written):
+            self.stdout.write("{}/{} pipes".format(written, pipes))
+
+        try:
+            result = seed_lab_data(
+                pipes, options['movements'], locations=options['locations'],
+                prefixes=[p.strip() for p in options['prefixes'].split(',') if p.strip()],
+                alias_ratio=options['aliases'], days=options['days'],
+                batch_size=options['batch_size'], seed=options['seed'],
+                progress=progress if options['verbosity'] > 1 else None)
+        except LabDataExists as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            "Seeded {} pipes ({} aliases), {} movements, {} locations".format(
+                result.pipes, result.aliases, result.movements, result.locations))
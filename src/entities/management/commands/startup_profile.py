@@ -0,0 +1,43 @@
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+from helpers.startup import profile_runs
+
+
+class Command(BaseCommand):
+    help = "Time a cold start of the service: settings, each app's import, models and ready, and the URLconf"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--runs', type=int, default=3,
+            help="Fresh interpreters to start; the fastest time of each phase is kept")
+        parser.add_argument(
+            '--profile', choices=['full', 'slim'],
+            help="APP_PROFILE to start with instead of the configured one")
+        parser.add_argument('--json', action='store_true', help="Print the timings as JSON")
+
+    def handle(self, *args, **options):
+        env = {'APP_PROFILE': options['profile']} if options['profile'] else None
+        try:
+            result = profile_runs(max(options['runs'], 1), env=env)
+        except subprocess.CalledProcessError as e:
+            raise CommandError("The service did not start: exit code {}".format(e.returncode))
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+
+        row = "{:<32} {:>9} {:>9} {:>9} {:>9}"
+        self.stdout.write(row.format('app', 'import', 'models', 'ready', 'total'))
+        apps = sorted(
+            result['apps'].items(), key=lambda item: sum(item[1].values()), reverse=True)
+        for entry, timings in apps:
+            self.stdout.write(row.format(
+                entry, *('{:.2f}'.format(timings[phase]) for phase in ('import', 'models', 'ready')),
+                '{:.2f}'.format(sum(timings.values()))))
+        self.stdout.write('')
+        for name, value in result['phases'].items():
+            self.stdout.write("{:<32} {:>9.2f} ms".format(name, value))
+        self.stdout.write("{:<32} {:>9}".format('modules loaded', result['modules']))
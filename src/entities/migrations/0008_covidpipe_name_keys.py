@@ -0,0 +1,54 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:48
+
+import re
+
+from django.db import migrations, models
+
+NAME_PATTERN = re.compile(r'^(.*?)([0-9]{0,18})$')
+
+
+def split_name(name):
+    # entities.models.split_name when this migration was written
+    prefix, digits = NAME_PATTERN.match(name).groups()
+    return prefix, int(digits) if digits else 0
+
+
+def backfill_name_keys(apps, schema_editor):
+    CovidPipe = apps.get_model('entities', 'CovidPipe')
+    batch = []
+    for pipe in CovidPipe.objects.only('id', 'name').iterator(chunk_size=2000):
+        pipe.name_prefix, pipe.name_number = split_name(pipe.name)
+        batch.append(pipe)
+        if len(batch) == 2000:
+            CovidPipe.objects.bulk_update(batch, ['name_prefix', 'name_number'])
+            batch = []
+    CovidPipe.objects.bulk_update(batch, ['name_prefix', 'name_number'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0007_auto_20200827_1219'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='covidpipe',
+            options={'ordering': ['name_prefix', 'name_number', 'name'], 'verbose_name_plural': 'pipes'},
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='name_number',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='name_prefix',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(backfill_name_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='covidpipe',
+            index=models.Index(fields=['name_prefix', 'name_number', 'name'], name='entities_pipe_natural_idx'),
+        ),
+    ]
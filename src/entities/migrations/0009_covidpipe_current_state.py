@@ -0,0 +1,63 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_current_state(apps, schema_editor):
+    CovidPipe = apps.get_model('entities', 'CovidPipe')
+    Movement = apps.get_model('entities', 'Movement')
+    current = Movement.objects.filter(pk=OuterRef('last_movement_id'))
+    CovidPipe.objects.filter(last_movement__isnull=False).update(**{
+        field: Subquery(current.values(column)[:1])
+        for field, column in (
+            ('current_location', 'destination_id'),
+            ('current_origin', 'origin_id'),
+            ('current_state', 'state'),
+            ('current_date_created', 'date_created'),
+            ('current_date_sent', 'date_sent'),
+            ('last_moved_at', 'date'),
+        )
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0008_covidpipe_name_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='covidpipe',
+            name='current_date_created',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='current_date_sent',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='current_location',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='current_pipes', to='entities.Location'),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='current_origin',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='current_origin_pipes', to='entities.Location'),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='current_state',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, 'A ENVIAR'), (2, 'ENVIADO')], db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='covidpipe',
+            name='last_moved_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_current_state, migrations.RunPython.noop),
+    ]
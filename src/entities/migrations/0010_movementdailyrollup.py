@@ -0,0 +1,48 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollup(apps, schema_editor):
+    Movement = apps.get_model('entities', 'Movement')
+    MovementDailyRollup = apps.get_model('entities', 'MovementDailyRollup')
+    rows = Movement.objects.annotate(
+        day=TruncDate('date')
+    ).values('day', 'origin_id', 'destination_id').annotate(
+        total=Count('id'),
+        samples=Count('id', filter=Q(pipe__con_muestra=True)),
+    ).order_by()
+    MovementDailyRollup.objects.bulk_create((
+        MovementDailyRollup(
+            day=row['day'], origin_id=row['origin_id'],
+            destination_id=row['destination_id'],
+            movements=row['total'], with_sample=row['samples'])
+        for row in rows.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0009_covidpipe_current_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovementDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('movements', models.PositiveIntegerField(default=0)),
+                ('with_sample', models.PositiveIntegerField(default=0)),
+                ('destination', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='entities.Location')),
+                ('origin', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='entities.Location')),
+            ],
+            options={
+                'verbose_name_plural': 'daily movement rollups',
+            },
+        ),
+        migrations.RunPython(backfill_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0010_movementdailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='covidpipe',
+            index=models.Index(fields=['name'], name='entities_pipe_name_like_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
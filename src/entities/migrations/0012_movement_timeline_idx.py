@@ -0,0 +1,17 @@
+# Generated by Django 2.2.15 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0011_covidpipe_name_like_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movement',
+            index=models.Index(fields=['pipe', 'date'], name='entities_movement_timeline_idx'),
+        ),
+    ]
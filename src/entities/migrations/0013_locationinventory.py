@@ -0,0 +1,46 @@
+# Generated by Django 2.2.15 on 2026-10-18 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def backfill_inventory(apps, schema_editor):
+    CovidPipe = apps.get_model('entities', 'CovidPipe')
+    Location = apps.get_model('entities', 'Location')
+    LocationInventory = apps.get_model('entities', 'LocationInventory')
+    counts = {
+        (row['current_location_id'], row['con_muestra']): row['total']
+        for row in CovidPipe.objects.filter(current_location__isnull=False).values(
+            'current_location_id', 'con_muestra').annotate(total=Count('id')).order_by()
+    }
+    LocationInventory.objects.bulk_create((
+        LocationInventory(
+            location_id=location_id, con_muestra=con_muestra,
+            count=counts.get((location_id, con_muestra), 0))
+        for location_id in Location.objects.values_list('id', flat=True)
+        for con_muestra in (False, True)), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0012_movement_timeline_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationInventory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('con_muestra', models.BooleanField(default=False)),
+                ('count', models.IntegerField(default=0)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='entities.Location')),
+            ],
+            options={
+                'verbose_name_plural': 'location inventory',
+                'unique_together': {('location', 'con_muestra')},
+            },
+        ),
+        migrations.RunPython(backfill_inventory, migrations.RunPython.noop),
+    ]
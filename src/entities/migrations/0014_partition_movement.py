@@ -0,0 +1,46 @@
+# Generated by Django 2.2.15 on 2026-10-18 11:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# A copy of the helpers of entities.partitions as they were when this
+# migration was written, so later changes there don't alter it
+
+MOVEMENT_TABLE = 'entities_movement'
+MIN_SERVER_VERSION = 110000
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql' or connection.pg_version < MIN_SERVER_VERSION:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [MOVEMENT_TABLE])
+        return cursor.fetchone() is not None
+
+
+def refuse_partitioned(apps, schema_editor):
+    # Unapplying the AlterField restores a foreign key to the movement id,
+    # which isn't unique on its own in a partitioned table. Copying the
+    # table is left to the partition_movements command, run by hand.
+    if is_partitioned(schema_editor.connection):
+        raise RuntimeError(
+            'The movement table is partitioned, run '
+            '"python src/manage.py partition_movements --undo" first')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entities', '0013_locationinventory'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='covidpipe',
+            name='last_movement',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='last_movement', to='entities.Movement'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, refuse_partitioned),
+    ]
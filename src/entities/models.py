@@ -1,6 +1,17 @@
+import re
+
+from django.conf import settings
 from django.db import models
 from datetime import datetime
 
+NAME_PATTERN = re.compile(r'^(.*?)([0-9]{0,18})$')
+
+
+def split_name(name):
+    """Split a pipe name into its natural sort key, e.g. A012 -> ('A', 12)."""
+    prefix, digits = NAME_PATTERN.match(name).groups()
+    return prefix, int(digits) if digits else 0
+
 
 class TimeStampedModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -46,15 +57,26 @@ class Movement(TimeStampedModel):
         related_name="movement")
     date = models.DateTimeField(default=datetime.now, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['pipe', 'date'], name='entities_movement_timeline_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         super(Movement, self).save(*args, **kwargs)
         self.pipe.last_movement = self
-        self.pipe.save()
+        self.pipe.save(update_fields=['last_movement', 'updated'])
 
     def __str__(self):
         return "Origen: {}, Destino: {} CovidPipe: {}, fecha: {}".format(self.origin, self.destination, self.pipe, self.date)
 
 
+CURRENT_STATE_FIELDS = (
+    'current_location_id', 'current_origin_id', 'current_state',
+    'current_date_created', 'current_date_sent', 'last_moved_at',
+)
+
+
 class CovidPipe(TimeStampedModel):
     con_muestra = models.BooleanField(default=False)
     name = models.CharField(
@@ -65,13 +87,163 @@ class CovidPipe(TimeStampedModel):
         'CovidPipe', on_delete=models.PROTECT,
         related_name="last_pipe", blank=True, null=True)
 
+    # No database constraint: a partitioned movement table has no unique
+    # key on ``id`` alone for it to reference, see ``entities.partitions``
     last_movement = models.ForeignKey(
         'Movement', on_delete=models.SET_NULL,
-        related_name="last_movement", blank=True, null=True)
+        related_name="last_movement", blank=True, null=True, db_constraint=False)
+
+    # Snapshot of ``last_movement``, kept in sync by ``refresh_current_state``
+    # so listings and filters don't have to join through the movement table
+    current_location = models.ForeignKey(
+        Location, on_delete=models.SET_NULL, related_name="current_pipes",
+        null=True, blank=True, editable=False)
+    current_origin = models.ForeignKey(
+        Location, on_delete=models.SET_NULL, related_name="current_origin_pipes",
+        null=True, blank=True, editable=False)
+    current_state = models.PositiveSmallIntegerField(
+        choices=Movement.STATES, null=True, blank=True, editable=False,
+        db_index=True)
+    current_date_created = models.DateField(
+        null=True, blank=True, editable=False, db_index=True)
+    current_date_sent = models.DateField(
+        null=True, blank=True, editable=False, db_index=True)
+    last_moved_at = models.DateTimeField(
+        null=True, blank=True, editable=False, db_index=True)
+
+    # Natural sort key of ``name``, kept in sync by ``refresh_name_keys``
+    name_prefix = models.CharField(
+        max_length=50, default='', blank=True, editable=False)
+    name_number = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name_plural = 'pipes'
-        ordering = ['-name']
+        ordering = ['name_prefix', 'name_number', 'name']
+        indexes = [
+            models.Index(
+                fields=['name_prefix', 'name_number', 'name'],
+                name='entities_pipe_natural_idx'),
+            # Lets name__startswith use an index whatever the collation
+            models.Index(
+                fields=['name'], name='entities_pipe_name_like_idx',
+                opclasses=['varchar_pattern_ops']),
+        ]
+
+    @staticmethod
+    def current_state_of(movement):
+        """Return the snapshot field values describing ``movement``."""
+        if movement is None:
+            return dict.fromkeys(CURRENT_STATE_FIELDS)
+        return {
+            'current_location_id': movement.destination_id,
+            'current_origin_id': movement.origin_id,
+            'current_state': movement.state,
+            'current_date_created': movement.date_created,
+            'current_date_sent': movement.date_sent,
+            'last_moved_at': movement.date,
+        }
+
+    def refresh_current_state(self):
+        for field, value in self.current_state_of(self.last_movement).items():
+            setattr(self, field, value)
+
+    def refresh_name_keys(self):
+        self.name_prefix, self.name_number = split_name(self.name)
+
+    def save(self, *args, **kwargs):
+        self.refresh_name_keys()
+        self.refresh_current_state()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'name' in update_fields:
+                update_fields |= {'name_prefix', 'name_number'}
+            if 'last_movement' in update_fields:
+                update_fields |= set(CURRENT_STATE_FIELDS)
+            kwargs['update_fields'] = update_fields
+        super(CovidPipe, self).save(*args, **kwargs)
 
     def __str__(self):
         return self.name
+
+
+class MovementDailyRollup(models.Model):
+    """Movements per day, origin and destination, kept by ``entities.rollups``.
+
+    A key may be split over several rows; always aggregate when reading.
+    """
+    day = models.DateField(db_index=True)
+    origin = models.ForeignKey(
+        Location, on_delete=models.CASCADE, related_name="+", null=True)
+    destination = models.ForeignKey(
+        Location, on_delete=models.CASCADE, related_name="+", null=True)
+    movements = models.PositiveIntegerField(default=0)
+    with_sample = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily movement rollups'
+
+    def __str__(self):
+        return "{}: {} -> {}".format(self.day, self.origin, self.destination)
+
+
+class LocationInventory(models.Model):
+    """Pipes currently at a location, kept by ``entities.inventory``."""
+    location = models.ForeignKey(
+        Location, on_delete=models.CASCADE, related_name="inventory")
+    con_muestra = models.BooleanField(default=False)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'location inventory'
+        unique_together = (('location', 'con_muestra'), )
+
+    def __str__(self):
+        return "{} ({}): {}".format(
+            self.location, 'con muestra' if self.con_muestra else 'sin muestra', self.count)
+
+
+class Job(TimeStampedModel):
+    """A large admin operation, run by the ``run_jobs`` worker."""
+    MOVE = 'move'
+    UPDATE_DATES = 'update_dates'
+    CREATE_PIPES = 'create_pipes'
+    KINDS = (
+        (MOVE, 'Mover pipes'),
+        (UPDATE_DATES, 'Actualizar fechas / estado'),
+        (CREATE_PIPES, 'Crear pipes'),
+    )
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'En cola'),
+        (RUNNING, 'En proceso'),
+        (DONE, 'Terminado'),
+        (FAILED, 'Fallido'),
+    )
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    status = models.CharField(
+        max_length=10, choices=STATUSES, default=QUEUED, db_index=True)
+    # JSON, as text so the table works on every database
+    payload = models.TextField(default='{}')
+    result = models.TextField(default='', blank=True)
+    error = models.TextField(default='', blank=True)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    @property
+    def active(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def __str__(self):
+        return "#{} {}".format(self.pk, self.get_kind_display())
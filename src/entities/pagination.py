@@ -0,0 +1,157 @@
+import base64
+import json
+from functools import reduce
+from operator import or_
+
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+CURSOR_VAR = 'cursor'
+
+# Below this many estimated rows an exact COUNT(*) is cheap enough
+EXACT_COUNT_THRESHOLD = 10000
+
+
+def estimate_count(queryset):
+    """Return the planner's row estimate for ``queryset`` on PostgreSQL.
+
+    Small results, and other databases, are counted exactly.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.get_compiler(using=queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+
+    if estimate < EXACT_COUNT_THRESHOLD:
+        return queryset.count()
+    return estimate
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeError):
+        return None
+
+
+def keyset_filter(ordering, values):
+    """Return a Q selecting the rows after ``values`` in ``ordering``.
+
+    ``ordering`` is a list of field names, optionally prefixed with ``-``,
+    whose combination is unique and non-null.
+    """
+    clauses = []
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = '{}__{}'.format(name, 'lt' if field.startswith('-') else 'gt')
+        clauses.append(Q(**equal) & Q(**{lookup: value}))
+        equal[name] = value
+    return reduce(or_, clauses)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that trusts ``estimate_count`` instead of COUNT(*)."""
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+    def validate_number(self, number):
+        # The count is an estimate, so pages past its end are not rejected
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+
+class KeysetChangeList(ChangeList):
+    """ChangeList that pages with a cursor on ``keyset_ordering``.
+
+    Used while the list is in its default order; sorting by a column falls
+    back to numbered pages over an estimated count.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR)
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(KeysetChangeList, self).get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Any other navigation starts again from the first page
+        remove = list(remove or []) + [CURSOR_VAR]
+        return super(KeysetChangeList, self).get_query_string(new_params, remove)
+
+    def get_results(self, request):
+        ordering = self.model_admin.keyset_ordering
+        self.keyset = ORDER_VAR not in self.params
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+
+        queryset = self.queryset.order_by(*ordering)
+        values = decode_cursor(self.cursor) if self.cursor else None
+        try:
+            if not isinstance(values, list) or len(values) != len(ordering):
+                raise ValueError
+            queryset = queryset.filter(keyset_filter(ordering, values))
+        except (ValueError, TypeError, ValidationError):
+            # A cursor we didn't write; start from the first page
+            self.cursor = None
+
+        rows = list(queryset[:self.list_per_page + 1])
+        result_list = rows[:self.list_per_page]
+        self.next_page_url = None
+        if len(rows) > self.list_per_page:
+            last = result_list[-1]
+            self.next_page_url = self.get_query_string({CURSOR_VAR: encode_cursor([
+                getattr(last, field.lstrip('-')) for field in ordering])})
+        self.first_page_url = self.get_query_string()
+
+        self.paginator = self.model_admin.get_paginator(
+            request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_page_url)
+
+
+class KeysetPaginationMixin:
+    """ModelAdmin mixin for keyset pagination and estimated counts."""
+
+    keyset_ordering = ('-pk', )
+    show_full_result_count = False
+    change_list_template = 'admin/entities/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        return EstimatedCountPaginator(
+            queryset, per_page, orphans, allow_empty_first_page)
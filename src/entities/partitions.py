@@ -0,0 +1,231 @@
+"""Monthly range partitioning of the movement table on PostgreSQL.
+
+``entities_movement`` is partitioned by ``date`` into one table per UTC
+month, plus a default partition for dates no month covers. The ORM keeps
+using the parent table; filters on ``date`` are pruned to the months they
+touch. On other databases, and PostgreSQL before 11, the table is a plain
+table and every function here is a no-op.
+
+Migrations leave the table plain. ``partition_movements`` converts it,
+copying every row under a lock, and ``unpartition_movements`` reverts it;
+both are run by hand with the ``partition_movements`` command.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timezone
+
+from django.db import connection as default_connection, transaction
+
+from entities.models import CovidPipe
+
+MOVEMENT_TABLE = 'entities_movement'
+DEFAULT_PARTITION = MOVEMENT_TABLE + '_default'
+
+# Months created ahead of the current one
+MONTHS_AHEAD = 3
+
+# Foreign keys and indexes on partitioned tables need PostgreSQL 11
+MIN_SERVER_VERSION = 110000
+
+Partition = namedtuple('Partition', ['name', 'month', 'rows'])
+
+
+class PartitionInUse(Exception):
+    pass
+
+
+def supports_partitioning(connection=default_connection):
+    return (connection.vendor == 'postgresql' and
+            connection.pg_version >= MIN_SERVER_VERSION)
+
+
+def is_partitioned(connection=default_connection):
+    if not supports_partitioning(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [MOVEMENT_TABLE])
+        return cursor.fetchone() is not None
+
+
+def add_months(month, months):
+    year, index = divmod(month.month - 1 + months, 12)
+    return date(month.year + year, index + 1, 1)
+
+
+def month_of(value):
+    if isinstance(value, datetime):
+        value = value.astimezone(timezone.utc) if value.tzinfo else value
+    return date(value.year, value.month, 1)
+
+
+def partition_name(month):
+    return '{}_y{:04d}m{:02d}'.format(MOVEMENT_TABLE, month.year, month.month)
+
+
+def _bound(month):
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def list_partitions(connection=default_connection):
+    """Return the monthly partitions attached to the movement table, oldest first."""
+    if not is_partitioned(connection):
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, c.reltuples::bigint FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass "
+            "AND c.relname <> %s ORDER BY c.relname", [MOVEMENT_TABLE, DEFAULT_PARTITION])
+        rows = cursor.fetchall()
+    return [
+        Partition(name, date(int(name[-7:-3]), int(name[-2:]), 1), max(tuples, 0))
+        for name, tuples in rows]
+
+
+def ensure_partitions(months_ahead=MONTHS_AHEAD, today=None, connection=default_connection):
+    """Create the partitions from the current month to ``months_ahead`` later.
+
+    Rows of a new month already sitting in the default partition are moved
+    into it. Returns the names of the partitions created.
+    """
+    if not is_partitioned(connection):
+        return []
+    qn = connection.ops.quote_name
+    existing = {partition.month for partition in list_partitions(connection)}
+    current = month_of(today or datetime.now(timezone.utc))
+    created = []
+
+    for month in (add_months(current, i) for i in range(months_ahead + 1)):
+        if month in existing:
+            continue
+        name = partition_name(month)
+        bounds = [_bound(month), _bound(add_months(month, 1))]
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(
+                qn(name), qn(MOVEMENT_TABLE)))
+            cursor.execute(
+                "WITH moved AS (DELETE FROM {} WHERE date >= %s AND date < %s RETURNING *) "
+                "INSERT INTO {} SELECT * FROM moved".format(qn(DEFAULT_PARTITION), qn(name)),
+                bounds)
+            cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(
+                qn(MOVEMENT_TABLE), qn(name)), bounds)
+        created.append(name)
+    return created
+
+
+def detach_partitions(before, drop=False, connection=default_connection):
+    """Detach, and optionally drop, the monthly partitions older than ``before``.
+
+    A month holding the current movement of some pipe is refused, as the
+    pipe would be left pointing at a row the ORM can no longer see.
+    """
+    qn = connection.ops.quote_name
+    detached = []
+    for partition in list_partitions(connection):
+        if partition.month >= month_of(before):
+            break
+        if CovidPipe.objects.filter(
+                last_moved_at__gte=_bound(partition.month),
+                last_moved_at__lt=_bound(add_months(partition.month, 1))).exists():
+            raise PartitionInUse(
+                '{} tiene el último movimiento de algunos pipes'.format(partition.name))
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(
+                qn(MOVEMENT_TABLE), qn(partition.name)))
+            if drop:
+                cursor.execute("DROP TABLE {}".format(qn(partition.name)))
+        detached.append(partition.name)
+    return detached
+
+
+def _table_ddl(cursor, table):
+    """Return the index and constraint definitions of ``table``, minus its key."""
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'p')", [table, table])
+    indexes = cursor.fetchall()
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype IN ('c', 'f')", [table])
+    return indexes, cursor.fetchall()
+
+
+def _rebuild_table(connection, partitioned):
+    """Copy the movement table into a new, (un)partitioned, table of the same name.
+
+    Runs in one transaction holding an exclusive lock on the table, so
+    movements can't be read or written until the copy commits. Index,
+    constraint and sequence names are kept, so migrations find what they
+    expect.
+    """
+    qn = connection.ops.quote_name
+    old = MOVEMENT_TABLE + '_old'
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(qn(MOVEMENT_TABLE)))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [MOVEMENT_TABLE])
+        sequence = cursor.fetchone()[0]
+        cursor.execute("SELECT min(date) FROM {}".format(qn(MOVEMENT_TABLE)))
+        first = cursor.fetchone()[0]
+        indexes, constraints = _table_ddl(cursor, MOVEMENT_TABLE)
+
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(qn(MOVEMENT_TABLE), qn(old)))
+        cursor.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(
+            qn(old), qn(MOVEMENT_TABLE + '_pkey')))
+        for name, _ in indexes:
+            cursor.execute("DROP INDEX {}".format(qn(name)))
+
+        if partitioned:
+            cursor.execute(
+                "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (date)".format(
+                    qn(MOVEMENT_TABLE), qn(old)))
+            # The partition key has to be part of the primary key
+            cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (id, date)".format(
+                qn(MOVEMENT_TABLE), qn(MOVEMENT_TABLE + '_pkey')))
+            cursor.execute("CREATE TABLE {} PARTITION OF {} DEFAULT".format(
+                qn(DEFAULT_PARTITION), qn(MOVEMENT_TABLE)))
+            month = month_of(first or datetime.now(timezone.utc))
+            last = add_months(month_of(datetime.now(timezone.utc)), MONTHS_AHEAD)
+            while month <= last:
+                cursor.execute(
+                    "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(
+                        qn(partition_name(month)), qn(MOVEMENT_TABLE)),
+                    [_bound(month), _bound(add_months(month, 1))])
+                month = add_months(month, 1)
+        else:
+            cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(
+                qn(MOVEMENT_TABLE), qn(old)))
+            cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (id)".format(
+                qn(MOVEMENT_TABLE), qn(MOVEMENT_TABLE + '_pkey')))
+
+        cursor.execute("INSERT INTO {} SELECT * FROM {}".format(qn(MOVEMENT_TABLE), qn(old)))
+        for name, definition in indexes:
+            cursor.execute(definition.replace(' ON ONLY ', ' ON '))
+        # Added after the copy, so they are checked in one pass instead of by
+        # deferred row triggers, which would block the index builds above
+        for name, definition in constraints:
+            cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} {}".format(
+                qn(MOVEMENT_TABLE), qn(name), definition))
+        cursor.execute("ALTER SEQUENCE {} OWNED BY {}.id".format(sequence, qn(MOVEMENT_TABLE)))
+        cursor.execute("DROP TABLE {} CASCADE".format(qn(old)))
+        cursor.execute("ANALYZE {}".format(qn(MOVEMENT_TABLE)))
+
+
+def partition_movements(connection=default_connection):
+    """Convert the movement table to a partitioned table, copying its rows.
+
+    Partitions are created from the month of the oldest movement to
+    ``MONTHS_AHEAD`` months from now. Returns whether the table changed.
+    """
+    if not supports_partitioning(connection) or is_partitioned(connection):
+        return False
+    _rebuild_table(connection, partitioned=True)
+    return True
+
+
+def unpartition_movements(connection=default_connection):
+    """Copy a partitioned movement table back into a plain table."""
+    if not is_partitioned(connection):
+        return False
+    _rebuild_table(connection, partitioned=False)
+    return True
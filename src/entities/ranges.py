@@ -0,0 +1,117 @@
+import re
+from collections import namedtuple
+
+from django.db.models import Q
+from django.db.models.functions import Length
+
+from entities.models import CovidPipe
+
+# Upper bound on the number of names a single expression may expand to
+MAX_RANGE_SIZE = 100000
+
+DASH = re.compile(r'\s*-\s*')
+SEPARATOR = re.compile(r'[,;\s]+')
+NUMBERED = re.compile(r'^(.*?)([0-9]{1,18})$')
+
+PipeRange = namedtuple('PipeRange', ['prefix', 'start', 'end', 'width'])
+Resolution = namedtuple('Resolution', ['pipes', 'missing'])
+
+
+class RangeExpressionError(ValueError):
+    pass
+
+
+def _split(bound):
+    match = NUMBERED.match(bound)
+    if not match:
+        raise RangeExpressionError('"{}" no termina en un número'.format(bound))
+    return match.groups()
+
+
+class RangeExpression:
+    """A list of pipe names and ranges, e.g. ``A001-A500, B7, C10-C90``.
+
+    Terms are separated by commas, semicolons or whitespace. A range keeps
+    the zero padding of its bounds, so ``A001-A500`` means A001, A002, ...
+    and never A1. The whole expression compiles to a single query through
+    the ``name_prefix``/``name_number`` index of ``CovidPipe``.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.singles = []
+        self.ranges = []
+
+        for term in SEPARATOR.split(DASH.sub('-', expression.strip())):
+            if not term:
+                continue
+            if '-' not in term:
+                self.singles.append(term)
+                continue
+
+            bounds = term.split('-')
+            if len(bounds) != 2:
+                raise RangeExpressionError('Rango inválido: "{}"'.format(term))
+            (prefix, start), (end_prefix, end) = _split(bounds[0]), _split(bounds[1])
+            if prefix != end_prefix:
+                raise RangeExpressionError(
+                    'Los prefijos de "{}" no coinciden'.format(term))
+            if int(start) > int(end):
+                raise RangeExpressionError('Rango invertido: "{}"'.format(term))
+
+            padded = [digits for digits in (start, end) if digits.startswith('0')]
+            width = len(padded[0]) if padded and len(padded[0]) > 1 else 1
+            self.ranges.append(PipeRange(prefix, int(start), int(end), width))
+
+        if not self.singles and not self.ranges:
+            raise RangeExpressionError('Rango vacío')
+        size = len(self.singles) + sum(r.end - r.start + 1 for r in self.ranges)
+        if size > MAX_RANGE_SIZE:
+            raise RangeExpressionError(
+                'El rango supera el máximo de {} pipes'.format(MAX_RANGE_SIZE))
+
+    def names(self):
+        """Return every name the expression refers to, in expression order."""
+        names = list(self.singles)
+        for prefix, start, end, width in self.ranges:
+            names.extend(
+                '{}{}'.format(prefix, str(i).zfill(width))
+                for i in range(start, end + 1))
+        return list(dict.fromkeys(names))
+
+    def q(self):
+        """Return a Q object matching exactly the names of the expression.
+
+        Range terms need the ``name_length`` annotation added by ``filter``.
+        """
+        q = Q(name__in=self.singles) if self.singles else Q(pk__in=[])
+        for prefix, start, end, width in self.ranges:
+            length = len(prefix) + width
+            q |= (
+                Q(name_prefix=prefix, name_number__range=(start, end)) &
+                (Q(name_length=length) |
+                 Q(name_length__gt=length) & ~Q(name__startswith=prefix + '0')))
+        return q
+
+    def filter(self, queryset=None):
+        if queryset is None:
+            queryset = CovidPipe.objects.all()
+        return queryset.annotate(name_length=Length('name')).filter(self.q())
+
+
+def parse_range(expression):
+    return RangeExpression(expression)
+
+
+def resolve_range(expression, queryset=None):
+    """Resolve ``expression`` with one query.
+
+    Returns the matched pipes and the names of the expression that do not
+    exist.
+    """
+    expression = parse_range(expression)
+    pipes = list(expression.filter(queryset))
+    found = {pipe.name for pipe in pipes}
+    return Resolution(
+        pipes=pipes,
+        missing=[name for name in expression.names() if name not in found])
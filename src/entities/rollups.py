@@ -0,0 +1,122 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Subquery, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from entities.models import Movement, MovementDailyRollup
+
+
+def movement_day(date):
+    """Return the local day a movement date falls on, as ``date__date`` does."""
+    if timezone.is_aware(date):
+        date = timezone.localtime(date)
+    return date.date()
+
+
+def day_range(day):
+    """Return the aware ``[start, end)`` datetimes of a local day.
+
+    Filtering on this range can use an index on the column, while a
+    ``__date`` lookup has to cast every row.
+    """
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def record_movements(movements):
+    """Add written movements to the daily rollup.
+
+    ``movements`` is an iterable of ``(date, origin_id, destination_id,
+    con_muestra)`` tuples. One update, or insert, is issued per distinct
+    day/origin/destination, not per movement.
+    """
+    totals = Counter()
+    samples = Counter()
+    for date, origin_id, destination_id, con_muestra in movements:
+        key = (movement_day(date), origin_id, destination_id)
+        totals[key] += 1
+        samples[key] += int(bool(con_muestra))
+
+    with transaction.atomic(savepoint=False):
+        for (day, origin_id, destination_id), total in totals.items():
+            rows = MovementDailyRollup.objects.filter(
+                day=day, origin_id=origin_id, destination_id=destination_id)
+            # Only bump one row, in case concurrent writers split the key
+            updated = MovementDailyRollup.objects.filter(
+                pk=Subquery(rows.order_by('pk').values('pk')[:1])
+            ).update(
+                movements=F('movements') + total,
+                with_sample=F('with_sample') + samples[day, origin_id, destination_id])
+            if not updated:
+                MovementDailyRollup.objects.create(
+                    day=day, origin_id=origin_id, destination_id=destination_id,
+                    movements=total, with_sample=samples[day, origin_id, destination_id])
+
+
+def refresh_rollup(keys):
+    """Recompute the rollup of ``(day, origin_id, destination_id)`` keys.
+
+    For movements that were deleted or moved to another key, which can't
+    be undone by an increment: ``with_sample`` is taken from the pipes'
+    current ``con_muestra``, as ``rebuild_rollup`` does.
+    """
+    with transaction.atomic(savepoint=False):
+        for day, origin_id, destination_id in set(keys):
+            start, end = day_range(day)
+            totals = Movement.objects.filter(
+                date__gte=start, date__lt=end,
+                origin_id=origin_id, destination_id=destination_id,
+            ).aggregate(
+                total=Count('id'),
+                samples=Count('id', filter=Q(pipe__con_muestra=True)))
+            MovementDailyRollup.objects.filter(
+                day=day, origin_id=origin_id, destination_id=destination_id).delete()
+            if totals['total']:
+                MovementDailyRollup.objects.create(
+                    day=day, origin_id=origin_id, destination_id=destination_id,
+                    movements=totals['total'], with_sample=totals['samples'])
+
+
+def rebuild_rollup():
+    """Recompute the whole rollup from the movement table.
+
+    ``with_sample`` is rebuilt from each pipe's current ``con_muestra``, as
+    movements don't record the flag they were written with.
+    """
+    rows = Movement.objects.annotate(
+        day=TruncDate('date')
+    ).values('day', 'origin_id', 'destination_id').annotate(
+        total=Count('id'),
+        samples=Count('id', filter=Q(pipe__con_muestra=True)),
+    ).order_by()
+
+    with transaction.atomic():
+        MovementDailyRollup.objects.all().delete()
+        MovementDailyRollup.objects.bulk_create((
+            MovementDailyRollup(
+                day=row['day'], origin_id=row['origin_id'],
+                destination_id=row['destination_id'],
+                movements=row['total'], with_sample=row['samples'])
+            for row in rows.iterator()), batch_size=1000)
+        return MovementDailyRollup.objects.count()
+
+
+def movement_days():
+    """Return the days with movements, most recent first."""
+    return list(MovementDailyRollup.objects.filter(
+        movements__gt=0).values_list('day', flat=True).distinct().order_by('-day'))
+
+
+def daily_report(start=None, end=None):
+    """Return movement and with-sample totals per day between two dates."""
+    rows = MovementDailyRollup.objects.all()
+    if start:
+        rows = rows.filter(day__gte=start)
+    if end:
+        rows = rows.filter(day__lte=end)
+    return list(rows.values('day').annotate(
+        movements=Sum('movements'), with_sample=Sum('with_sample')
+    ).order_by('day'))
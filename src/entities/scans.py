@@ -0,0 +1,44 @@
+from entities.cache import get_location, invalidate_pipe_ids, pipe_ids
+from entities.models import CovidPipe
+from entities.services import MoveResult, move_pipes
+
+
+class InvalidDestination(ValueError):
+    pass
+
+
+def resolve_destination(destination):
+    """Return the location named, or with the id, ``destination`` from the cache."""
+    location = get_location(destination)
+    if location is None:
+        raise InvalidDestination('Destino inválido: "{}"'.format(destination))
+    return location
+
+
+def record_scans(names, destination, description='', con_muestra=None):
+    """Move the scanned pipes to ``destination`` in one short transaction.
+
+    Names are resolved to ids through the cache and the write is the one of
+    ``move_pipes``, so the pipes' current pointer and counters change with
+    the movement. Pipes keep their ``con_muestra`` unless one is given.
+    """
+    names = list(dict.fromkeys(names))
+    location = resolve_destination(destination)
+    ids = pipe_ids(names)
+
+    # Filtering on the name too turns an entry renamed behind the signals'
+    # back, e.g. by a queryset update, into a miss
+    result = move_pipes(
+        CovidPipe.objects.filter(pk__in=ids.values(), name__in=list(ids)),
+        location, description=description, con_muestra=con_muestra, names=names)
+
+    stale = [name for name in result.missing if name in ids]
+    if stale:
+        invalidate_pipe_ids()
+        retry = move_pipes(
+            CovidPipe.objects.filter(name__in=stale), location,
+            description=description, con_muestra=con_muestra, names=stale)
+        result = MoveResult(
+            moved=result.moved + retry.moved, skipped=result.skipped + retry.skipped,
+            missing=[name for name in result.missing if name not in stale] + retry.missing)
+    return location, result
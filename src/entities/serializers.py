@@ -0,0 +1,49 @@
+from rest_framework import serializers
+
+from entities.models import CovidPipe, Location, Movement
+
+
+class SparseFieldsMixin:
+    """Serialize only the fields listed in the ``fields`` query parameter."""
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get('request')
+        fields = request and request.query_params.get('fields')
+        if fields:
+            allowed = set(fields.split(','))
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
+class LocationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Location
+        fields = ('id', 'name')
+
+
+class PipeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    current_location_name = serializers.CharField(
+        source='current_location.name', default=None, read_only=True)
+    current_origin_name = serializers.CharField(
+        source='current_origin.name', default=None, read_only=True)
+
+    class Meta:
+        model = CovidPipe
+        fields = (
+            'id', 'name', 'con_muestra', 'alias', 'last_movement',
+            'current_location', 'current_location_name',
+            'current_origin', 'current_origin_name', 'current_state',
+            'current_date_created', 'current_date_sent', 'last_moved_at',
+        )
+
+
+class MovementSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    pipe_name = serializers.CharField(source='pipe.name', default=None, read_only=True)
+
+    class Meta:
+        model = Movement
+        fields = (
+            'id', 'pipe', 'pipe_name', 'origin', 'destination', 'state',
+            'date_created', 'date_sent', 'description', 'date',
+        )
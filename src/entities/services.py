@@ -0,0 +1,195 @@
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from helpers.metrics import track_action
+
+from entities.inventory import apply_inventory, inventory_deltas
+from entities.models import CovidPipe, Movement
+from entities.rollups import record_movements
+
+BULK_BATCH_SIZE = 1000
+
+MoveResult = namedtuple('MoveResult', ['moved', 'skipped', 'missing'])
+UpdateResult = namedtuple('UpdateResult', ['affected', 'missing'])
+CreateResult = namedtuple('CreateResult', ['created', 'existing'])
+
+
+# What makes a movement a pipe's current one, for every bulk path. The
+# movements written by move_pipes are dated now, so they come first.
+LATEST_MOVEMENT_ORDER = ('-date', '-id')
+
+
+def _latest_movements():
+    return Movement.objects.filter(pipe=OuterRef('pk')).order_by(*LATEST_MOVEMENT_ORDER)
+
+
+def _latest_movement_id():
+    return Subquery(_latest_movements().values('id')[:1])
+
+
+def sync_current_state(pipe_ids):
+    """Point each pipe at its most recent movement and refresh its snapshot.
+
+    One UPDATE with correlated subqueries, for writes where each pipe ends
+    up somewhere different, e.g. ingested scans. The location inventory is
+    adjusted from the pipes' locations before and after the update.
+    """
+    latest = _latest_movements()
+    pipes = CovidPipe.objects.filter(id__in=pipe_ids)
+    with transaction.atomic(savepoint=False):
+        before = list(pipes.select_for_update().values_list(
+            'current_location_id', 'con_muestra'))
+        updated = pipes.update(
+            updated=timezone.now(),
+            last_movement=_latest_movement_id(),
+            **{
+                field: Subquery(latest.values(column)[:1])
+                for field, column in (
+                    ('current_location', 'destination_id'),
+                    ('current_origin', 'origin_id'),
+                    ('current_state', 'state'),
+                    ('current_date_created', 'date_created'),
+                    ('current_date_sent', 'date_sent'),
+                    ('last_moved_at', 'date'),
+                )
+            })
+        apply_inventory(inventory_deltas(
+            before, pipes.values_list('current_location_id', 'con_muestra')))
+    return updated
+
+
+@track_action('move', lambda result: result.moved)
+def move_pipes(pipes, location, description='', con_muestra=False, names=None):
+    """Move every pipe of the ``pipes`` queryset to ``location``.
+
+    Runs in one transaction and a fixed number of statements: one select to
+    resolve and lock the pipes, one ``bulk_create`` of movements and one
+    update of ``last_movement``/``con_muestra`` and the current state
+    snapshot, plus one daily rollup upsert per distinct origin and one
+    update of the location inventory. Pipes already at ``location`` with the
+    same ``con_muestra`` are skipped; with ``con_muestra=None`` every pipe
+    keeps its own flag. When ``names`` is given, the names that did not
+    resolve to a pipe are returned as missing.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        rows = list(pipes.select_for_update(of=('self', )).values_list(
+            'id', 'name', 'con_muestra', 'current_location_id'))
+
+        movements = []
+        moved_from = []
+        moved_to = []
+        skipped = 0
+        for pipe_id, name, has_muestra, current in rows:
+            flag = has_muestra if con_muestra is None else con_muestra
+            if current == location.id and has_muestra == flag:
+                skipped += 1
+                continue
+            moved_from.append((current, has_muestra))
+            moved_to.append((location.id, flag))
+            movements.append(Movement(
+                description=description, origin_id=current,
+                destination=location, pipe_id=pipe_id, date=now))
+
+        if movements:
+            Movement.objects.bulk_create(movements, batch_size=BULK_BATCH_SIZE)
+            record_movements(
+                (now, movement.origin_id, location.id, flag)
+                for movement, (_, flag) in zip(movements, moved_to))
+            values = {} if con_muestra is None else {'con_muestra': con_muestra}
+            CovidPipe.objects.filter(
+                id__in=[movement.pipe_id for movement in movements]
+            ).update(
+                last_movement=_latest_movement_id(),
+                # SET sees the old row, so the previous location becomes the origin
+                current_origin=F('current_location'),
+                current_location=location,
+                current_state=Movement.CREATED,
+                current_date_created=None,
+                current_date_sent=None,
+                last_moved_at=now,
+                updated=now,
+                **values)
+            apply_inventory(inventory_deltas(moved_from, moved_to))
+
+    missing = []
+    if names is not None:
+        found = {row[1] for row in rows}
+        missing = [name for name in names if name not in found]
+
+    return MoveResult(moved=len(movements), skipped=skipped, missing=missing)
+
+
+@track_action('update_dates', lambda result: result.affected)
+def update_last_movements(pipes, state=None, date_created=None, date_sent=None,
+                          names=None):
+    """Set ``state`` and dates on the current movement of every pipe in ``pipes``.
+
+    The movements are updated with a single UPDATE whose rows are selected
+    through ``CovidPipe.last_movement_id``, followed by one UPDATE of the
+    pipes' current state snapshot. Arguments left as ``None`` are not
+    touched. When ``names`` is given, the names that did not resolve to a
+    pipe are returned as missing.
+    """
+    values = {}
+    if state is not None:
+        values['state'] = state
+    if date_created:
+        values['date_created'] = date_created
+    if date_sent:
+        values['date_sent'] = date_sent
+
+    with transaction.atomic():
+        affected = 0
+        if values:
+            now = timezone.now()
+            affected = Movement.objects.filter(
+                id__in=pipes.values('last_movement_id')
+            ).update(updated=now, **values)
+            CovidPipe.objects.filter(
+                id__in=pipes.filter(last_movement__isnull=False).values('id')
+            ).update(updated=now, **{
+                'current_' + field: value for field, value in values.items()})
+
+        missing = []
+        if names is not None:
+            found = set(pipes.values_list('name', flat=True))
+            missing = [name for name in names if name not in found]
+
+    return UpdateResult(affected=affected, missing=missing)
+
+
+@track_action('create_pipes', lambda result: len(result.created))
+def create_pipes(names, last_movement=None):
+    """Create a pipe for every name in ``names`` that does not exist yet.
+
+    The pipes are inserted in batches inside one transaction. If another
+    transaction inserts some of the names first, the insert is rolled back
+    and retried without them, so only the pipes inserted here are reported
+    as created and added to ``last_movement``'s destination inventory.
+    """
+    while True:
+        existing = set(CovidPipe.objects.filter(
+            name__in=names).values_list('name', flat=True))
+        created = [name for name in dict.fromkeys(names) if name not in existing]
+
+        pipes = [CovidPipe(name=name, last_movement=last_movement) for name in created]
+        for pipe in pipes:
+            pipe.refresh_name_keys()
+            pipe.refresh_current_state()
+        try:
+            with transaction.atomic():
+                CovidPipe.objects.bulk_create(pipes, batch_size=BULK_BATCH_SIZE)
+                apply_inventory(inventory_deltas(
+                    [], ((pipe.current_location_id, pipe.con_muestra) for pipe in pipes)))
+        except IntegrityError:
+            # Anything but a name inserted since the check would fail again
+            if CovidPipe.objects.filter(name__in=names).count() == len(existing):
+                raise
+            continue
+
+        return CreateResult(
+            created=created, existing=[name for name in names if name in existing])
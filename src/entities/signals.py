@@ -0,0 +1,116 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from entities.cache import invalidate_choices, invalidate_locations, invalidate_pipe_ids
+from entities.inventory import apply_inventory, create_inventory, inventory_deltas
+from entities.models import CovidPipe, Location, Movement
+from entities.rollups import movement_day, record_movements, refresh_rollup
+
+
+def rollup_key(date, origin_id, destination_id):
+    return movement_day(date), origin_id, destination_id
+
+
+@receiver(pre_save, sender=Movement)
+def read_stored_rollup_key(sender, instance, raw, **kwargs):
+    instance._stored_rollup_key = None
+    if raw or instance._state.adding:
+        return
+    stored = Movement.objects.filter(pk=instance.pk).values_list(
+        'date', 'origin_id', 'destination_id').first()
+    if stored:
+        instance._stored_rollup_key = rollup_key(*stored)
+
+
+@receiver(post_save, sender=Movement)
+def record_created_movement(sender, instance, created, **kwargs):
+    if created:
+        record_movements([(
+            instance.date, instance.origin_id, instance.destination_id,
+            instance.pipe.con_muestra)])
+        return
+    stored = getattr(instance, '_stored_rollup_key', None)
+    key = rollup_key(instance.date, instance.origin_id, instance.destination_id)
+    if stored and stored != key:
+        refresh_rollup([stored, key])
+
+
+@receiver(post_delete, sender=Movement)
+def remove_deleted_movement(sender, instance, **kwargs):
+    refresh_rollup([rollup_key(instance.date, instance.origin_id, instance.destination_id)])
+
+
+@receiver(post_delete, sender=Movement)
+def clear_current_state(sender, instance, **kwargs):
+    # Deleting the current movement nulls last_movement without saving the pipe
+    cleared = CovidPipe.objects.filter(
+        pk=instance.pipe_id, last_movement__isnull=True, current_location__isnull=False)
+    before = list(cleared.values_list('current_location_id', 'con_muestra'))
+    if before:
+        cleared.update(**CovidPipe.current_state_of(None))
+        apply_inventory(inventory_deltas(before, []))
+    # Any deletion changes the pipe's history, so its timeline validators too
+    CovidPipe.objects.filter(pk=instance.pipe_id).update(updated=timezone.now())
+
+
+# Saving a pipe can change its location, sample flag or name; the row as
+# stored before the save tells which counters it leaves and if it was renamed
+STORED_FIELDS = {'con_muestra', 'last_movement', 'name'}
+
+
+@receiver(pre_save, sender=CovidPipe)
+def read_stored_row(sender, instance, raw, update_fields, **kwargs):
+    instance._stored_row = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not STORED_FIELDS & set(update_fields):
+        return
+    instance._stored_row = CovidPipe.objects.filter(pk=instance.pk).values_list(
+        'current_location_id', 'con_muestra', 'name').first()
+
+
+@receiver(post_save, sender=CovidPipe)
+def forget_renamed_pipe(sender, instance, created, raw, **kwargs):
+    stored = getattr(instance, '_stored_row', None)
+    if not raw and stored and stored[2] != instance.name:
+        invalidate_pipe_ids()
+
+
+@receiver(post_save, sender=CovidPipe)
+def update_inventory(sender, instance, created, raw, update_fields, **kwargs):
+    stored = getattr(instance, '_stored_row', None)
+    before = stored[:2] if stored else None
+    if raw or (before is None and not created):
+        return
+    location_id, con_muestra = before or (None, None)
+    if update_fields is None or 'last_movement' in update_fields:
+        location_id = instance.current_location_id
+    if update_fields is None or 'con_muestra' in update_fields:
+        con_muestra = instance.con_muestra
+    apply_inventory(inventory_deltas(
+        [before] if before else [], [(location_id, con_muestra)]))
+
+
+@receiver(post_delete, sender=CovidPipe)
+def remove_from_inventory(sender, instance, **kwargs):
+    apply_inventory(inventory_deltas(
+        [(instance.current_location_id, instance.con_muestra)], []))
+
+
+@receiver(post_delete, sender=CovidPipe)
+def forget_deleted_pipe(sender, instance, **kwargs):
+    invalidate_pipe_ids()
+
+
+@receiver(post_save, sender=Location)
+def create_location_inventory(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        create_inventory([instance.pk])
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def invalidate_location_choices(sender, **kwargs):
+    invalidate_choices('locations')
+    invalidate_locations()
@@ -1,3 +1,1291 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission, PermissionsMixin
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from helpers import metrics
+from helpers.db_pool import ConnectionPool, PoolExhausted
+from helpers.query_stats import query_budget
+from helpers.startup import profile_runs
+from entities.models import (
+    CovidPipe, Job, Location, LocationInventory, Movement, MovementDailyRollup, split_name)
+from entities.aliases import resolve_alias
+from entities.benchmarks import compare
+from entities.cache import (
+    LocalCache, check_shared_cache, get_location, location_choices, pipe_ids)
+from entities.forms import CovidPipeForm
+from entities.inventory import inventory_report, rebuild_inventory
+from entities.jobs import claim_job, enqueue, run_job
+from entities.labdata import LabDataExists, seed_lab_data
+from entities.pagination import encode_cursor
+from entities.partitions import (
+    DEFAULT_PARTITION, MONTHS_AHEAD, MOVEMENT_TABLE, add_months, detach_partitions,
+    ensure_partitions, is_partitioned, list_partitions, month_of, partition_name,
+    supports_partitioning, unpartition_movements)
+from entities.ranges import RangeExpressionError, parse_range, resolve_range
+from entities.rollups import daily_report, movement_days, rebuild_rollup
+from entities.services import create_pipes, move_pipes, sync_current_state, update_last_movements
+
+
+class MovePipesTestCase(TestCase):
+    def setUp(self):
+        self.lab = Location.objects.create(name='Laboratorio')
+        self.freezer = Location.objects.create(name='Congelador')
+        for i in range(1, 6):
+            CovidPipe.objects.create(name='A{}'.format(i))
+
+    def test_moves_range_in_fixed_queries(self):
+        names = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6']
+        with self.assertNumQueries(8):
+            result = move_pipes(
+                CovidPipe.objects.filter(name__in=names), self.lab,
+                description='ingreso', con_muestra=True, names=names)
+
+        self.assertEqual(result.moved, 5)
+        self.assertEqual(result.skipped, 0)
+        self.assertEqual(result.missing, ['A6'])
+        pipe = CovidPipe.objects.get(name='A3')
+        self.assertTrue(pipe.con_muestra)
+        self.assertEqual(pipe.last_movement.destination, self.lab)
+        self.assertIsNone(pipe.last_movement.origin)
+
+    def test_chains_origin_and_skips_unchanged(self):
+        move_pipes(CovidPipe.objects.filter(name__in=['A1', 'A2']), self.lab)
+        result = move_pipes(CovidPipe.objects.all(), self.lab)
+
+        self.assertEqual(result.moved, 3)
+        self.assertEqual(result.skipped, 2)
+
+        move_pipes(CovidPipe.objects.filter(name='A1'), self.freezer)
+        pipe = CovidPipe.objects.get(name='A1')
+        self.assertEqual(pipe.last_movement.origin, self.lab)
+        self.assertEqual(pipe.last_movement.destination, self.freezer)
+        self.assertEqual(Movement.objects.filter(pipe=pipe).count(), 2)
+
+
+class UpdateLastMovementsTestCase(TestCase):
+    def setUp(self):
+        lab = Location.objects.create(name='Laboratorio')
+        for i in range(1, 4):
+            CovidPipe.objects.create(name='B{}'.format(i))
+        move_pipes(CovidPipe.objects.all(), lab)
+
+    def test_updates_current_movements_in_one_statement(self):
+        pipes = CovidPipe.objects.filter(name__in=['B1', 'B2'])
+        with self.assertNumQueries(4):
+            result = update_last_movements(
+                pipes, state=Movement.SENT, date_sent='2020-09-01')
+
+        self.assertEqual(result.affected, 2)
+        sent = Movement.objects.filter(state=Movement.SENT)
+        self.assertEqual(
+            sorted(sent.values_list('pipe__name', flat=True)), ['B1', 'B2'])
+        self.assertEqual(str(sent.first().date_sent), '2020-09-01')
+
+    def test_reports_missing_names(self):
+        names = ['B3', 'B9']
+        result = update_last_movements(
+            CovidPipe.objects.filter(name__in=names), date_created='2020-09-01',
+            names=names)
+
+        self.assertEqual(result.affected, 1)
+        self.assertEqual(result.missing, ['B9'])
+
+
+class CovidPipeFormTestCase(TestCase):
+    def test_range_creation_skips_existing_names(self):
+        CovidPipe.objects.create(name='C3')
+        form = CovidPipeForm(data={'name': 'C0', 'range_pipes': 'C1-C5'})
+        self.assertTrue(form.is_valid(), form.errors)
+
+        form.save(commit=False)
+
+        self.assertEqual(form.range_result.created, ['C1', 'C2', 'C4', 'C5'])
+        self.assertEqual(form.range_result.existing, ['C3'])
+        self.assertEqual(CovidPipe.objects.filter(name__startswith='C').count(), 5)
+
+    def test_range_result_reports_rows_inserted_meanwhile_as_existing(self):
+        refresh_name_keys = CovidPipe.refresh_name_keys
+
+        def racing_refresh_name_keys(pipe):
+            # Another request creates C2 between the existence check and the insert
+            if pipe.name == 'C3' and not CovidPipe.objects.filter(name='C2').exists():
+                CovidPipe.objects.create(name='C2')
+            refresh_name_keys(pipe)
+
+        form = CovidPipeForm(data={'name': 'C0', 'range_pipes': 'C1-C3'})
+        self.assertTrue(form.is_valid(), form.errors)
+        with mock.patch.object(CovidPipe, 'refresh_name_keys', racing_refresh_name_keys):
+            form.save(commit=False)
+
+        self.assertEqual(form.range_result.created, ['C1', 'C3'])
+        self.assertEqual(form.range_result.existing, ['C2'])
+        self.assertEqual(CovidPipe.objects.filter(name__startswith='C').count(), 3)
+
+    def test_rejects_malformed_range(self):
+        form = CovidPipeForm(data={'name': 'C0', 'range_pipes': 'C1-C5-C9'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('range_pipes', form.errors)
+
+
+class NaturalSortTestCase(TestCase):
+    def test_split_name(self):
+        self.assertEqual(split_name('A012'), ('A', 12))
+        self.assertEqual(split_name('123'), ('', 123))
+        self.assertEqual(split_name('AB'), ('AB', 0))
+
+    def test_default_ordering_is_natural(self):
+        for name in ['A10', 'B1', 'A9', 'A100']:
+            CovidPipe.objects.create(name=name)
+        create_pipes(['A2', 'A11'])
+
+        self.assertEqual(
+            list(CovidPipe.objects.values_list('name', flat=True)),
+            ['A2', 'A9', 'A10', 'A11', 'A100', 'B1'])
+
+
+class RangeExpressionTestCase(TestCase):
+    def test_expands_lists_and_padded_ranges(self):
+        expression = parse_range('A008-A011, B7;C1 - C3')
+        self.assertEqual(
+            expression.names(),
+            ['B7', 'A008', 'A009', 'A010', 'A011', 'C1', 'C2', 'C3'])
+
+    def test_rejects_malformed_expressions(self):
+        for expression in ['', 'A1-B5', 'A5-A1', 'A1-A2-A3', 'A-B']:
+            with self.assertRaises(RangeExpressionError):
+                parse_range(expression)
+
+    def test_resolves_in_one_query(self):
+        create_pipes(['A1', 'A2', 'A02', 'A003', 'A10', 'B7', 'A0011'])
+
+        with self.assertNumQueries(1):
+            resolution = resolve_range('A1-A10, B7, B8')
+
+        self.assertEqual(
+            [pipe.name for pipe in resolution.pipes], ['A1', 'A2', 'A10', 'B7'])
+        self.assertEqual(resolution.missing[:2], ['B8', 'A3'])
+        self.assertEqual(len(resolution.missing), 8)
+
+        resolution = resolve_range('A001-A011')
+        self.assertEqual([pipe.name for pipe in resolution.pipes], ['A003'])
+
+
+class CurrentStateTestCase(TestCase):
+    def setUp(self):
+        self.lab = Location.objects.create(name='Laboratorio')
+        self.freezer = Location.objects.create(name='Congelador')
+        self.pipe = CovidPipe.objects.create(name='D1')
+
+    def test_movement_save_updates_snapshot(self):
+        movement = Movement.objects.create(
+            pipe=self.pipe, origin=self.lab, destination=self.freezer,
+            date_created='2020-09-01')
+
+        pipe = CovidPipe.objects.get(pk=self.pipe.pk)
+        self.assertEqual(pipe.current_location, self.freezer)
+        self.assertEqual(pipe.current_origin, self.lab)
+        self.assertEqual(pipe.current_state, Movement.CREATED)
+        self.assertEqual(str(pipe.current_date_created), '2020-09-01')
+
+        movement.delete()
+        pipe = CovidPipe.objects.get(pk=self.pipe.pk)
+        self.assertIsNone(pipe.current_location)
+        self.assertIsNone(pipe.current_state)
+
+    def test_bulk_paths_update_snapshot(self):
+        pipes = parse_range('D1').filter()
+        move_pipes(pipes, self.lab)
+        move_pipes(pipes, self.freezer)
+        update_last_movements(pipes, state=Movement.SENT, date_sent='2020-09-02')
+
+        pipe = CovidPipe.objects.get(pk=self.pipe.pk)
+        self.assertEqual(pipe.current_origin, self.lab)
+        self.assertEqual(pipe.current_location, self.freezer)
+        self.assertEqual(pipe.current_state, Movement.SENT)
+        self.assertEqual(str(pipe.current_date_sent), '2020-09-02')
+        self.assertEqual(pipe.last_moved_at, pipe.last_movement.date)
+
+    def test_backdated_movement_is_not_current(self):
+        move_pipes(parse_range('D1').filter(), self.lab)
+        # A late scan, recorded after the move but dated before it
+        Movement.objects.bulk_create([Movement(
+            pipe=self.pipe, destination=self.freezer,
+            date=timezone.now() - timedelta(days=2))])
+        sync_current_state([self.pipe.pk])
+        pipe = CovidPipe.objects.get(pk=self.pipe.pk)
+        self.assertEqual(pipe.current_location, self.lab)
+        self.assertEqual(pipe.last_movement.destination, self.lab)
+
+        move_pipes(parse_range('D1').filter(), self.freezer)
+        pipe = CovidPipe.objects.get(pk=self.pipe.pk)
+        self.assertEqual(pipe.last_movement.destination, self.freezer)
+        self.assertEqual(pipe.last_movement.origin, self.lab)
+        sync_current_state([self.pipe.pk])
+        self.assertEqual(CovidPipe.objects.get(pk=self.pipe.pk).last_movement, pipe.last_movement)
+
+    def test_range_create_sets_snapshot(self):
+        movement = Movement.objects.create(
+            pipe=self.pipe, origin=self.lab, destination=self.freezer)
+        create_pipes(['R1', 'R2'], last_movement=movement)
+
+        for pipe in CovidPipe.objects.filter(name__in=['R1', 'R2']):
+            self.assertEqual(pipe.current_location, self.freezer)
+            self.assertEqual(pipe.current_origin, self.lab)
+            self.assertEqual(pipe.current_state, Movement.CREATED)
+            self.assertEqual(pipe.last_movement_id, movement.pk)
+
+
+class LocationInventoryTestCase(TestCase):
+    def setUp(self):
+        self.lab = Location.objects.create(name='Laboratorio')
+        self.freezer = Location.objects.create(name='Congelador')
+        create_pipes(['F1', 'F2', 'F3'])
+        self.client.force_login(
+            get_user_model().objects.create_superuser('admin@example.com', 'secret'))
+
+    def counts(self):
+        return {
+            (row['location__name'], row['with_sample'], row['without_sample'])
+            for row in inventory_report()}
+
+    def test_counters_follow_every_write_path(self):
+        move_pipes(parse_range('F1-F3').filter(), self.lab, con_muestra=True)
+        move_pipes(parse_range('F1').filter(), self.freezer)
+        self.assertEqual(self.counts(), {('Laboratorio', 2, 0), ('Congelador', 0, 1)})
+
+        pipe = CovidPipe.objects.get(name='F2')
+        movement = Movement.objects.create(pipe=pipe, origin=self.lab, destination=self.freezer)
+        pipe = CovidPipe.objects.get(name='F2')
+        pipe.con_muestra = False
+        pipe.save()
+        self.assertEqual(self.counts(), {('Laboratorio', 1, 0), ('Congelador', 0, 2)})
+
+        movement.delete()
+        CovidPipe.objects.get(name='F1').delete()
+        self.assertEqual(self.counts(), {('Laboratorio', 1, 0), ('Congelador', 0, 0)})
+
+        Movement.objects.bulk_create([Movement(
+            pipe=CovidPipe.objects.get(name='F3'), origin=self.lab, destination=self.freezer)])
+        sync_current_state(CovidPipe.objects.filter(name='F3').values('id'))
+        self.assertEqual(self.counts(), {('Laboratorio', 0, 0), ('Congelador', 1, 0)})
+
+        LocationInventory.objects.update(count=0)
+        self.assertEqual(rebuild_inventory(), 1)
+        self.assertEqual(self.counts(), {('Laboratorio', 0, 0), ('Congelador', 1, 0)})
+
+    def test_range_create_counts_pipes(self):
+        movement = Movement.objects.create(
+            pipe=CovidPipe.objects.get(name='F1'), destination=self.lab)
+        create_pipes(['F4', 'F5'], last_movement=movement)
+        self.assertEqual(self.counts(), {('Laboratorio', 0, 3), ('Congelador', 0, 0)})
+
+        self.assertEqual(rebuild_inventory(), 3)
+        self.assertEqual(self.counts(), {('Laboratorio', 0, 3), ('Congelador', 0, 0)})
+
+    def test_range_create_counts_only_inserted_pipes(self):
+        movement = Movement.objects.create(
+            pipe=CovidPipe.objects.get(name='F1'), destination=self.lab)
+        refresh_name_keys = CovidPipe.refresh_name_keys
+
+        def racing_refresh_name_keys(pipe):
+            # Another request creates F5 between the existence check and the insert
+            if pipe.name == 'F6' and not CovidPipe.objects.filter(name='F5').exists():
+                CovidPipe.objects.create(name='F5', last_movement=movement)
+            refresh_name_keys(pipe)
+
+        with mock.patch.object(CovidPipe, 'refresh_name_keys', racing_refresh_name_keys):
+            create_pipes(['F4', 'F5', 'F6'], last_movement=movement)
+        self.assertEqual(self.counts(), {('Laboratorio', 0, 4), ('Congelador', 0, 0)})
+        self.assertEqual(rebuild_inventory(), 4)
+
+    def test_inventory_api(self):
+        move_pipes(parse_range('F1-F2').filter(), self.lab)
+        response = self.client.get(reverse('location-inventory'))
+        self.assertEqual(response.json(), [
+            {'location_id': self.freezer.pk, 'location__name': 'Congelador',
+             'with_sample': 0, 'without_sample': 0, 'total': 0},
+            {'location_id': self.lab.pk, 'location__name': 'Laboratorio',
+             'with_sample': 0, 'without_sample': 2, 'total': 2},
+        ])
+
+
+class AliasResolutionTestCase(TestCase):
+    def setUp(self):
+        create_pipes(['G1', 'G2', 'G3', 'G4', 'G5'])
+        pipes = {pipe.name: pipe for pipe in CovidPipe.objects.all()}
+        # G3 relabels G2, which relabels G1; G4 is another alias of G1
+        CovidPipe.objects.filter(name='G2').update(alias=pipes['G1'])
+        CovidPipe.objects.filter(name='G3').update(alias=pipes['G2'])
+        CovidPipe.objects.filter(name='G4').update(alias=pipes['G1'])
+
+    def test_resolves_chain_in_one_query(self):
+        pipe = CovidPipe.objects.get(name='G3')
+        with self.assertNumQueries(1):
+            resolution = resolve_alias(pipe)
+
+        self.assertEqual(resolution.canonical[1], 'G1')
+        self.assertEqual([name for _, name in resolution.chain], ['G2', 'G1'])
+        self.assertEqual(
+            sorted(name for _, name in resolution.equivalent), ['G1', 'G2', 'G3', 'G4'])
+
+        CovidPipe.objects.filter(name='G1').update(alias=pipe)
+        resolution = resolve_alias(CovidPipe.objects.get(name='G4'))
+        self.assertEqual(len(resolution.equivalent), 4)
+
+    def test_search_and_api_find_aliases(self):
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        response = self.client.get(
+            reverse('admin:entities_covidpipe_changelist'), {'q': 'G3', 'con_muestra__exact': '0'})
+        self.assertEqual(
+            sorted(pipe.name for pipe in response.context['cl'].result_list),
+            ['G1', 'G2', 'G3', 'G4'])
+
+        # Terms that aren't pipe names don't walk the alias chains
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('admin:entities_covidpipe_changelist'), {'q': 'G'})
+        self.assertFalse([q for q in queries if 'RECURSIVE' in q['sql']])
+
+        response = self.client.get(reverse('covidpipe-list'), {'alias': 'G4', 'fields': 'name'})
+        self.assertEqual(
+            [row['name'] for row in response.json()['results']], ['G1', 'G2', 'G3', 'G4'])
+
+        pipe = CovidPipe.objects.get(name='G4')
+        data = self.client.get(reverse('covidpipe-aliases', args=[pipe.pk])).json()
+        self.assertEqual(data['canonical']['name'], 'G1')
+
+
+@override_settings(JOB_THRESHOLD=2)
+class JobTestCase(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        self.lab = Location.objects.create(name='Laboratorio')
+        create_pipes(['J1', 'J2', 'J3'])
+
+    def test_large_move_runs_in_worker(self):
+        url = reverse('admin:entities_covidpipe_changelist')
+        response = self.client.post(url, {
+            'action': 'move', 'apply': 'move',
+            '_selected_action': [CovidPipe.objects.get(name='J1').pk],
+            'location': self.lab.pk, 'rango': 'J1-J4', 'con_muestra': 'on',
+        }, follow=True)
+
+        job = Job.objects.get()
+        self.assertContains(response, 'trabajo #{}'.format(job.pk))
+        self.assertEqual((job.kind, job.status, job.total), (Job.MOVE, Job.QUEUED, 4))
+        self.assertFalse(Movement.objects.exists())
+        response = self.client.get(reverse('admin:entities_job_change', args=[job.pk]))
+        self.assertContains(response, 'http-equiv="refresh"')
+
+        # The worker's close_old_connections would close the test transaction
+        with mock.patch('entities.management.commands.run_jobs.close_old_connections'):
+            call_command('run_jobs', once=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (Job.DONE, 4))
+        self.assertEqual(json.loads(job.result), {
+            'moved': 3, 'skipped': 0, 'missing': ['J4'], 'missing_count': 1})
+        self.assertEqual(CovidPipe.objects.filter(
+            current_location=self.lab, con_muestra=True).count(), 3)
+        response = self.client.get(reverse('admin:entities_job_change', args=[job.pk]))
+        self.assertNotContains(response, 'http-equiv="refresh"')
+
+    def test_failed_job_keeps_error(self):
+        job = enqueue(Job.MOVE, {'location': 0, 'names': ['J1'],
+                                 'description': '', 'con_muestra': False}, 1)
+        self.assertEqual(claim_job(), job)
+        self.assertIsNone(claim_job())
+
+        job = run_job(job)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('DoesNotExist', job.error)
+
+    def test_stale_running_job_is_requeued(self):
+        job = enqueue(Job.MOVE, {'location': self.lab.pk, 'names': ['J1'],
+                                 'description': '', 'con_muestra': False}, 1)
+        self.assertEqual(claim_job(), job)
+        self.assertIsNone(claim_job())
+
+        Job.objects.filter(pk=job.pk).update(
+            updated=timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER + 1))
+        self.assertEqual(claim_job(), job)
+        self.assertEqual(run_job(Job.objects.get(pk=job.pk)).status, Job.DONE)
+
+
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        self.result = seed_lab_data(
+            40, 100, locations=3, prefixes=['HSJ', 'LAB'], alias_ratio=0.5,
+            batch_size=15, seed=1)
+
+    def test_seeded_data(self):
+        self.assertEqual(self.result.pipes, 40)
+        self.assertEqual(Movement.objects.count(), 100)
+        self.assertTrue(CovidPipe.objects.filter(name='LAB0000020').exists())
+        self.assertEqual(
+            CovidPipe.objects.exclude(alias=None).count(), self.result.aliases)
+        self.assertEqual(
+            sum(row['total'] for row in inventory_report()),
+            CovidPipe.objects.exclude(current_location=None).count())
+        pipe = CovidPipe.objects.exclude(last_movement=None).first()
+        self.assertEqual(pipe.current_location_id, pipe.last_movement.destination_id)
+        with self.assertRaises(LabDataExists):
+            seed_lab_data(1, 1, prefixes=['HSJ'])
+
+    def test_run_and_compare(self):
+        path = os.path.join(self.tmpdir(), 'report.json')
+        call_command(
+            'run_benchmarks', output=path, sizes='5', repeat=1, stdout=StringIO())
+        with open(path) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['pipes'], 40)
+        self.assertLessEqual(
+            {'pipe_changelist:location', 'move:5', 'range_create:5'}, set(report['results']))
+        # Everything was rolled back
+        self.assertEqual(Movement.objects.count(), 100)
+        self.assertFalse(CovidPipe.objects.filter(name_prefix='BENCH').exists())
+
+        baseline = json.loads(json.dumps(report))
+        baseline['results']['move:5']['queries'] -= 1
+        baseline['results']['range_create:5']['seconds'] = 0
+        self.assertEqual(
+            sorted(r.name for r in compare(report, baseline)), ['move:5', 'range_create:5'])
+
+    def tmpdir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+
+class MovementPartitionsTestCase(TestCase):
+    def test_month_arithmetic(self):
+        self.assertEqual(add_months(date(2020, 11, 1), 3), date(2021, 2, 1))
+        self.assertEqual(add_months(date(2020, 1, 1), -1), date(2019, 12, 1))
+        self.assertEqual(partition_name(date(2020, 9, 1)), 'entities_movement_y2020m09')
+
+    def test_noop_without_partitioning(self):
+        self.assertFalse(is_partitioned())
+        self.assertEqual(ensure_partitions(), [])
+        self.assertEqual(detach_partitions(date(2030, 1, 1)), [])
+
+
+class MovementPartitioningTestCase(TransactionTestCase):
+    """Converts the movement table for real, on PostgreSQL 11 or later."""
+
+    def setUp(self):
+        if not supports_partitioning():
+            self.skipTest('needs PostgreSQL 11 or later')
+        seed_lab_data(30, 90, locations=3, prefixes=['T'], alias_ratio=0)
+        self.rows = self.movement_rows()
+
+    def tearDown(self):
+        unpartition_movements()
+
+    def movement_rows(self):
+        return list(Movement.objects.order_by('pk').values_list('pk', 'date', 'pipe_id'))
+
+    def table_state(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = %s ORDER BY indexname",
+                [MOVEMENT_TABLE])
+            indexes = [name for name, in cursor.fetchall()]
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass ORDER BY conname", [MOVEMENT_TABLE])
+            constraints = dict(cursor.fetchall())
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [MOVEMENT_TABLE])
+            sequence = cursor.fetchone()[0]
+        return indexes, constraints, sequence
+
+    def test_partition_and_undo(self):
+        indexes, constraints, sequence = self.table_state()
+        self.assertEqual(constraints.pop(MOVEMENT_TABLE + '_pkey'), 'PRIMARY KEY (id)')
+
+        call_command('partition_movements', stdout=StringIO())
+        self.assertTrue(is_partitioned())
+        self.assertEqual(self.movement_rows(), self.rows)
+        partitioned = self.table_state()
+        self.assertEqual(partitioned[0], indexes)
+        self.assertEqual(partitioned[1].pop(MOVEMENT_TABLE + '_pkey'), 'PRIMARY KEY (id, date)')
+        self.assertEqual(partitioned[1:], (constraints, sequence))
+
+        current = month_of(timezone.now())
+        months = [partition.month for partition in list_partitions()]
+        self.assertEqual(months[0], month_of(min(date for _, date, _ in self.rows)))
+        self.assertEqual(months[-1], add_months(current, MONTHS_AHEAD))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM {}'.format(DEFAULT_PARTITION))
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        # A row of a month without partition waits in the default one
+        later = add_months(current, MONTHS_AHEAD + 1)
+        moved = self.rows[0][0]
+        Movement.objects.filter(pk=moved).update(
+            date=datetime(later.year, later.month, 2, tzinfo=timezone.utc))
+        out = StringIO()
+        call_command('ensure_movement_partitions', months=MONTHS_AHEAD + 1, stdout=out)
+        self.assertIn(partition_name(later), out.getvalue())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id FROM {}'.format(partition_name(later)))
+            self.assertEqual(cursor.fetchall(), [(moved,)])
+
+        # New rows keep drawing ids from the same sequence
+        pipe = CovidPipe.objects.first()
+        move_pipes(CovidPipe.objects.filter(pk=pipe.pk), Location.objects.first())
+        self.assertGreater(Movement.objects.latest('pk').pk, self.rows[-1][0])
+
+        call_command('partition_movements', undo=True, stdout=StringIO())
+        self.assertFalse(is_partitioned())
+        plain = self.table_state()
+        self.assertEqual(plain[1].pop(MOVEMENT_TABLE + '_pkey'), 'PRIMARY KEY (id)')
+        self.assertEqual(plain, (indexes, constraints, sequence))
+        self.assertEqual(Movement.objects.count(), len(self.rows) + 1)
+
+    def test_migrations_require_undo(self):
+        self.addCleanup(call_command, 'migrate', 'entities', verbosity=0)
+        call_command('partition_movements', stdout=StringIO())
+        with self.assertRaisesRegex(RuntimeError, 'partition_movements --undo'):
+            call_command('migrate', 'entities', '0013', verbosity=0)
+
+        call_command('partition_movements', undo=True, stdout=StringIO())
+        call_command('migrate', 'entities', '0013', verbosity=0)
+        call_command('migrate', 'entities', verbosity=0)
+        self.assertEqual(self.movement_rows(), self.rows)
+        call_command('partition_movements', stdout=StringIO())
+        self.assertEqual(self.movement_rows(), self.rows)
+
+
+class PipeAdminTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        self.lab = Location.objects.create(name='Laboratorio')
+        create_pipes(['E1', 'E2', 'E3'])
+
+    def test_changelist_filters_on_snapshot(self):
+        move_pipes(parse_range('E1-E2').filter(), self.lab)
+        url = reverse('admin:entities_covidpipe_changelist')
+
+        response = self.client.get(url, {'last_movement': self.lab.pk})
+        self.assertEqual(
+            [pipe.name for pipe in response.context['cl'].result_list], ['E1', 'E2'])
+
+    def test_move_action_with_range(self):
+        url = reverse('admin:entities_covidpipe_changelist')
+        response = self.client.post(url, {
+            'action': 'move', 'apply': 'move',
+            '_selected_action': [CovidPipe.objects.get(name='E1').pk],
+            'location': self.lab.pk, 'rango': 'E2-E4',
+        }, follow=True)
+
+        self.assertContains(response, 'Pipes movidos: 2, omitidos: 0, no encontrados: 1')
+        self.assertEqual(CovidPipe.objects.filter(current_location=self.lab).count(), 2)
+
+    def test_update_dates_rejects_invalid_dates(self):
+        move_pipes(parse_range('E1').filter(), self.lab)
+        url = reverse('admin:entities_covidpipe_changelist')
+        data = {
+            'action': 'update_dates', 'apply': 'update_dates',
+            '_selected_action': [CovidPipe.objects.get(name='E1').pk],
+            'estado': 'enviado', 'created': '2020-13-45', 'moved': '',
+        }
+        response = self.client.post(url, data)
+        self.assertContains(response, 'Fecha inválida')
+        self.assertTemplateUsed(response, 'admin/update_dates.html')
+        self.assertEqual(CovidPipe.objects.get(name='E1').current_state, Movement.CREATED)
+
+        data['created'] = '2020-09-01'
+        response = self.client.post(url, data, follow=True)
+        self.assertContains(response, 'Movimientos actualizados: 1')
+        self.assertEqual(str(CovidPipe.objects.get(name='E1').current_date_created), '2020-09-01')
+
+    def test_export_honors_changelist_filters(self):
+        move_pipes(parse_range('E2').filter(), self.lab, con_muestra=True)
+        url = reverse('admin:entities_covidpipe_export')
+
+        response = self.client.get(url, {'con_muestra__exact': '1'})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[0].split(',')[:4], ['Pipe', 'Con muestra', 'Origen', 'Destino'])
+        self.assertEqual(rows[1].split(',')[:5], ['E2', 'True', '', 'Laboratorio', 'A ENVIAR'])
+        self.assertEqual(len(rows), 2)
+
+        response = self.client.get(reverse('covidpipe-export'), {'location': 'empty'})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([row.split(',')[0] for row in rows[1:]], ['E1', 'E3'])
+
+    def test_timeline_view(self):
+        move_pipes(parse_range('E1').filter(), self.lab)
+        pipe = CovidPipe.objects.get(name='E1')
+
+        response = self.client.get(reverse('admin:entities_covidpipe_change', args=[pipe.pk]))
+        self.assertContains(response, reverse('admin:entities_covidpipe_timeline', args=[pipe.pk]))
+
+        response = self.client.get(reverse('admin:entities_covidpipe_timeline', args=[pipe.pk]))
+        self.assertContains(response, 'Laboratorio')
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_changelist_pages_with_cursor(self):
+        create_pipes(['E10', 'E20'])
+        url = reverse('admin:entities_covidpipe_changelist')
+
+        with mock.patch.object(admin.site._registry[CovidPipe], 'list_per_page', 2):
+            response = self.client.get(url)
+            names = [pipe.name for pipe in response.context['cl'].result_list]
+            self.assertEqual(names, ['E1', 'E2'])
+            self.assertContains(response, '~5 pipes')
+
+            response = self.client.get(url + response.context['cl'].next_page_url)
+            names = [pipe.name for pipe in response.context['cl'].result_list]
+            self.assertEqual(names, ['E3', 'E10'])
+
+            response = self.client.get(url + response.context['cl'].next_page_url)
+            names = [pipe.name for pipe in response.context['cl'].result_list]
+            self.assertEqual(names, ['E20'])
+            self.assertIsNone(response.context['cl'].next_page_url)
+
+            response = self.client.get(url, {'o': '-1', 'p': '1'})
+            names = [pipe.name for pipe in response.context['cl'].result_list]
+            self.assertEqual(names, ['E2', 'E10'])
+
+            for values in (['E', 'x', 'E1'], ['E', {'a': 1}, 'E1'], {'a': 1}, ['E'], 7):
+                response = self.client.get(url, {'cursor': encode_cursor(values)})
+                names = [pipe.name for pipe in response.context['cl'].result_list]
+                self.assertEqual(names, ['E1', 'E2'])
+
+
+class QueryBudgetTestCase(TestCase):
+    """Admin pages and actions run the same statements whatever their size."""
+
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        seed_lab_data(4, 12, locations=3, prefixes=['Q'], alias_ratio=0.5)
+
+    def assertBudget(self, budget, request):
+        # Each measure follows a warm up, as seeding empties the choices cache
+        request()
+        with query_budget(budget) as small:
+            request()
+        seed_lab_data(40, 120, locations=3, prefixes=['R'], alias_ratio=0.5)
+        request()
+        with query_budget(budget) as large:
+            request()
+        self.assertEqual(small.count, large.count)
+
+    def test_pipe_changelist(self):
+        url = reverse('admin:entities_covidpipe_changelist')
+        self.assertBudget(5, lambda: self.client.get(url))
+
+    def test_pipe_changelist_filtered(self):
+        url = reverse('admin:entities_covidpipe_changelist')
+        location = Location.objects.first()
+        self.assertBudget(5, lambda: self.client.get(url, {'last_movement': location.pk}))
+
+    def test_movement_changelist(self):
+        url = reverse('admin:entities_movement_changelist')
+        self.assertBudget(6, lambda: self.client.get(url))
+
+    def test_move_action(self):
+        seed_lab_data(40, 120, locations=3, prefixes=['R'], alias_ratio=0.5)
+        url = reverse('admin:entities_covidpipe_changelist')
+        # Statements grow with the locations the pipes leave, not the pipes.
+        # On PostgreSQL the changelist also asks the planner for its count.
+        with query_budget(21):
+            self.client.post(url, {
+                'action': 'move', 'apply': 'move',
+                '_selected_action': [CovidPipe.objects.first().pk],
+                'location': Location.objects.first().pk,
+                'rango': 'Q0000001-Q0000004 R0000001-R0000040',
+            })
+
+    def test_budget_failure_lists_statements(self):
+        with self.assertRaisesRegex(AssertionError, r'2 queries over a budget of 1:\n1\. SELECT'):
+            with query_budget(1):
+                list(Location.objects.all())
+                list(CovidPipe.objects.all())
+
+
+@override_settings(QUERY_STATS_SLOWEST=2)
+class QueryStatsTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(
+            get_user_model().objects.create_superuser('admin@example.com', 'secret'))
+
+    def test_sampled_request(self):
+        create_pipes(['S1', 'S2'])
+        with override_settings(QUERY_STATS_SAMPLE_RATE=1), \
+                self.assertLogs('query_stats', 'INFO') as logs:
+            response = self.client.get(reverse('covidpipe-list'))
+
+        stats = json.loads(logs.records[0].getMessage())
+        self.assertEqual(stats['view'], 'covidpipe-list')
+        self.assertEqual(response['X-DB-Queries'], str(stats['queries']))
+        self.assertEqual(len(stats['slowest']), min(stats['queries'], 2))
+        self.assertIn('SELECT', stats['slowest'][0][1])
+
+    def test_unsampled_request(self):
+        with override_settings(QUERY_STATS_SAMPLE_RATE=0):
+            response = self.client.get(reverse('covidpipe-list'))
+        self.assertFalse(response.has_header('X-DB-Queries'))
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(METRICS_DIR=directory, METRICS_FLUSH_INTERVAL=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.directory = directory
+        self.client.force_login(
+            get_user_model().objects.create_superuser('admin@example.com', 'secret'))
+
+    def scrape(self, **headers):
+        response = self.client.get(reverse('metrics'), **headers)
+        self.assertEqual(response.status_code, 200)
+        return {
+            line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in response.content.decode().splitlines() if not line.startswith('#')}
+
+    def test_requests_and_actions_across_processes(self):
+        before = self.scrape()
+        lab = Location.objects.create(name='Laboratorio')
+        create_pipes(['M1', 'M2'])
+        move_pipes(CovidPipe.objects.all(), lab)
+        self.client.get(reverse('covidpipe-list'))
+        # A worker that exited, leaving its counters and a stale gauge
+        with open(os.path.join(self.directory, '999999999.json'), 'w') as f:
+            json.dump({'pid': 999999999, 'histograms': [], 'values': [
+                ['pipes_processed_total', [['action', 'move']], 5],
+                ['http_requests_in_flight', [], 3]]}, f)
+
+        after = self.scrape()
+
+        def delta(sample):
+            return after.get(sample, 0) - before.get(sample, 0)
+
+        self.assertEqual(delta('pipes_processed_total{action="move"}'), 7)
+        self.assertEqual(delta('pipes_processed_total{action="create_pipes"}'), 2)
+        self.assertEqual(delta(
+            'http_request_duration_seconds_count{method="GET",view="covidpipe-list"}'), 1)
+        self.assertEqual(delta(
+            'http_request_duration_seconds_bucket{method="GET",view="covidpipe-list",le="+Inf"}'), 1)
+        self.assertIn('http_request_db_seconds_sum{view="covidpipe-list"}', after)
+        self.assertEqual(after['http_requests_in_flight{pid="%d"}' % os.getpid()], 1)
+        self.assertNotIn('http_requests_in_flight{pid="999999999"}', after)
+        self.assertIn('cache_hits_total{cache="pipe-ids"}', after)
+
+    def test_token(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            self.scrape(HTTP_AUTHORIZATION='Bearer secret')
+
+    def test_deep_health_check(self):
+        self.assertEqual(self.client.get(reverse('health_check')).status_code, 200)
+        response = self.client.get(reverse('health_check'), {'deep': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('round_trip_ms', response.json()['database'])
+        self.assertEqual(response.json()['pools'], {})
+
+
+class StartupTestCase(TestCase):
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.assets = tempfile.mkdtemp()
+        for directory in (self.static_root, self.assets):
+            self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(self.assets, 'app.css'), 'w') as f:
+            f.write('body {}')
+        settings = override_settings(
+            STATIC_ROOT=self.static_root, STATICFILES_DIRS=[self.assets],
+            STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def prepare(self):
+        command = 'entities.management.commands.prepare_startup.call_command'
+        with mock.patch(command, wraps=call_command) as called:
+            call_command('prepare_startup', stdout=StringIO())
+        return [call[0][0] for call in called.call_args_list]
+
+    def test_prepare_startup_skips_unchanged_steps(self):
+        self.assertEqual(self.prepare(), ['ensure_movement_partitions', 'collectstatic'])
+        self.assertTrue(os.path.exists(os.path.join(self.static_root, 'app.css')))
+        self.assertEqual(self.prepare(), ['ensure_movement_partitions'])
+
+        with open(os.path.join(self.assets, 'app.css'), 'w') as f:
+            f.write('body { margin: 0 }')
+        self.assertEqual(self.prepare(), ['ensure_movement_partitions', 'collectstatic'])
+
+    def test_startup_profile(self):
+        result = profile_runs()
+        self.assertIn('entities', result['apps'])
+        self.assertEqual(set(result['apps']['entities']), {'import', 'models', 'ready'})
+        self.assertEqual(set(result['phases']), {'settings', 'setup', 'wsgi'})
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        return FakeConnection()
+
+    def test_reuses_released_connections(self):
+        pool = ConnectionPool(max_size=2)
+        first = pool.acquire(self.connect, ping=None)
+        pool.release(first, reset=lambda c: True)
+        self.assertIs(pool.acquire(self.connect, ping=None), first)
+        self.assertEqual(self.connects, 1)
+        self.assertEqual(pool.stats()['reused'], 1)
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+    def test_checkout_checks(self):
+        pool = ConnectionPool(max_lifetime=100, ping_after=10)
+        with mock.patch('helpers.db_pool.time.monotonic', return_value=0):
+            stale = pool.acquire(self.connect, ping=None)
+            pool.release(stale, reset=lambda c: True)
+        with mock.patch('helpers.db_pool.time.monotonic', return_value=50):
+            fresh = pool.acquire(self.connect, ping=lambda c: False)
+            self.assertTrue(stale.closed)
+            pool.release(fresh, reset=lambda c: True)
+        with mock.patch('helpers.db_pool.time.monotonic', return_value=200):
+            newest = pool.acquire(self.connect, ping=lambda c: True)
+        self.assertTrue(fresh.closed)
+        self.assertFalse(newest.closed)
+        stats = pool.stats()
+        self.assertEqual(
+            (stats['discarded_unhealthy'], stats['discarded_lifetime'], stats['connects']),
+            (1, 1, 3))
+
+    def test_broken_connections_are_closed(self):
+        pool = ConnectionPool()
+        connection = pool.acquire(self.connect, ping=None)
+        pool.release(connection, reset=lambda c: False)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_waits_for_a_release(self):
+        pool = ConnectionPool(max_size=1, timeout=0)
+        connection = pool.acquire(self.connect, ping=None)
+        with self.assertRaises(PoolExhausted):
+            pool.acquire(self.connect, ping=None)
+
+        pool.timeout = 10
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(pool.acquire(self.connect, ping=None)))
+        waiter.start()
+        pool.release(connection, reset=lambda c: True)
+        waiter.join(10)
+        self.assertEqual(acquired, [connection])
+        self.assertEqual(self.connects, 1)
+
+
+class ChoicesCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_choices_are_cached_until_invalidated(self):
+        lab = Location.objects.create(name='Laboratorio')
+        self.assertEqual(location_choices(), [(lab.pk, 'Laboratorio')])
+        with self.assertNumQueries(0):
+            location_choices()
+
+        lab.name = 'Lab central'
+        lab.save()
+        self.assertEqual(location_choices(), [(lab.pk, 'Lab central')])
+
+
+@override_settings(PROCESS_CACHES=True)
+class LocalCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        create_pipes(['L1', 'L2'])
+
+    def test_hits_misses_and_eviction(self):
+        local = LocalCache('test', 2)
+        load = mock.Mock(side_effect=lambda keys: {key: key.lower() for key in keys})
+
+        self.assertEqual(local.get_many(['A', 'B'], load), {'A': 'a', 'B': 'b'})
+        self.assertEqual(local.get_many(['A', 'C'], load), {'A': 'a', 'C': 'c'})
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(local.stats(), {
+            'hits': 1, 'misses': 3, 'evictions': 1, 'invalidations': 0,
+            'size': 2, 'maxsize': 2})
+        self.assertNotIn('B', local.entries)
+
+    def test_other_workers_drop_entries_on_invalidation(self):
+        worker = LocalCache('pipe-ids', 10)
+        load = lambda missing: dict(
+            CovidPipe.objects.filter(name__in=missing).values_list('name', 'id'))
+        pipe = CovidPipe.objects.get(name='L1')
+        self.assertEqual(worker.get_many(['L1'], load), {'L1': pipe.pk})
+
+        pipe.name = 'L10'
+        pipe.save()
+        self.assertEqual(worker.get_many(['L1', 'L10'], load), {'L10': pipe.pk})
+        self.assertEqual(worker.invalidations, 1)
+
+        # Saves that don't rename keep the entries
+        pipe.con_muestra = True
+        pipe.save()
+        worker.get_many(['L10'], load)
+        self.assertEqual(worker.stats()['hits'], 1)
+
+    def test_location_lookup(self):
+        lab = Location.objects.create(name='Laboratorio')
+        self.assertEqual(get_location(lab.pk), lab)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_location('Laboratorio'), lab)
+            self.assertEqual(get_location(str(lab.pk)), lab)
+        lab.delete()
+        self.assertIsNone(get_location(lab.pk))
+
+    def test_disabled_without_shared_cache(self):
+        local = LocalCache('test', 2)
+        load = mock.Mock(side_effect=lambda keys: {key: key.lower() for key in keys})
+        with override_settings(PROCESS_CACHES=False):
+            local.get_many(['A'], load)
+            local.get_many(['A'], load)
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(local.stats()['size'], 0)
+
+        with self.assertRaises(ImproperlyConfigured):
+            check_shared_cache()
+
+
+class MovementRollupTestCase(TestCase):
+    def setUp(self):
+        self.lab = Location.objects.create(name='Laboratorio')
+        self.freezer = Location.objects.create(name='Congelador')
+        create_pipes(['G1', 'G2', 'G3'])
+
+    def test_rollup_follows_writes_and_rebuild(self):
+        move_pipes(parse_range('G1-G3').filter(), self.lab, con_muestra=True)
+        Movement.objects.create(
+            pipe=CovidPipe.objects.get(name='G1'), origin=self.lab,
+            destination=self.freezer)
+
+        report = daily_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['movements'], 4)
+        self.assertEqual(report[0]['with_sample'], 4)
+        self.assertEqual(movement_days(), [report[0]['day']])
+
+        self.assertEqual(rebuild_rollup(), 2)
+        self.assertEqual(daily_report(), report)
+        self.assertEqual(
+            MovementDailyRollup.objects.get(destination=self.freezer).movements, 1)
+
+    def test_rollup_follows_edits_and_deletions(self):
+        move_pipes(parse_range('G1-G2').filter(), self.lab)
+        today = movement_days()[0]
+        movement = Movement.objects.get(pipe__name='G1')
+        movement.date = movement.date - timedelta(days=3)
+        movement.save()
+        earlier = today - timedelta(days=3)
+        self.assertEqual(movement_days(), [today, earlier])
+
+        movement.destination = self.freezer
+        movement.save()
+        self.assertEqual(
+            MovementDailyRollup.objects.get(day=earlier).destination, self.freezer)
+
+        movement.delete()
+        Movement.objects.get(pipe__name='G2').delete()
+        self.assertEqual(movement_days(), [])
+        self.assertFalse(MovementDailyRollup.objects.exists())
+
+    def test_movement_changelist_date_filter(self):
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        move_pipes(parse_range('G1-G2').filter(), self.lab)
+        day = movement_days()[0]
+
+        response = self.client.get(
+            reverse('admin:entities_movement_changelist'), {'date': str(day)})
+        self.assertContains(response, '2 movements')
+
+    def test_pipe_filter_renders_only_selected_pipe(self):
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        pipe = CovidPipe.objects.get(name='G2')
+        url = reverse('admin:entities_movement_changelist')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'pipe-filter')
+        self.assertFalse([q for q in queries if 'entities_covidpipe' in q['sql']])
+
+        response = self.client.get(url, {'pipe': pipe.pk})
+        self.assertContains(response, 'title="G2"')
+        self.assertNotContains(response, 'title="G1"')
+
+        response = self.client.get(reverse('pipe-search'), {'q': 'G', 'limit': 2})
+        self.assertEqual(
+            [row['name'] for row in response.json()['results']], ['G1', 'G2'])
+        response = self.client.get(
+            reverse('pipe-search'), {'q': 'G', 'after': response.json()['next']})
+        self.assertEqual(response.json(), {
+            'results': [{'id': CovidPipe.objects.get(name='G3').pk, 'name': 'G3'}],
+            'next': None})
+
+        for limit in ('-5', '0', 'x'):
+            response = self.client.get(reverse('pipe-search'), {'q': 'G', 'limit': limit})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()['results'])
+        response = self.client.get(reverse('pipe-search'), {'q': 'G', 'limit': 0})
+        self.assertEqual(
+            [row['name'] for row in response.json()['results']], ['G1'])
+        self.assertEqual(response.json()['next'], 'G1')
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(
+            get_user_model().objects.create_superuser('admin@example.com', 'secret'))
+        self.lab = Location.objects.create(name='Laboratorio')
+        create_pipes(['H1', 'H2', 'H3'])
+        move_pipes(parse_range('H1-H2').filter(), self.lab, con_muestra=True)
+
+    def test_pipes_filters_and_sparse_fields(self):
+        url = reverse('covidpipe-list')
+        response = self.client.get(url, {'location': self.lab.pk, 'fields': 'name,current_location_name'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'name': 'H1', 'current_location_name': 'Laboratorio'},
+            {'name': 'H2', 'current_location_name': 'Laboratorio'},
+        ])
+
+        response = self.client.get(url, {'location': 'empty', 'fields': 'name'})
+        self.assertEqual(response.json()['results'], [{'name': 'H3'}])
+
+        response = self.client.get(url, {'location': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_pipe_timeline_conditional_get(self):
+        pipe = CovidPipe.objects.get(name='H1')
+        freezer = Location.objects.create(name='Congelador')
+        move_pipes(parse_range('H1').filter(), freezer, con_muestra=True)
+        update_last_movements(parse_range('H1').filter(), state=Movement.SENT)
+        CovidPipe.objects.filter(name='H2').update(alias=pipe)
+        url = reverse('covidpipe-timeline', args=[CovidPipe.objects.get(name='H2').pk])
+
+        # Session and user, then the pipe, its movements and its aliases
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        data = response.json()
+        self.assertEqual(data['aliases'], [{'id': pipe.pk, 'name': 'H1'}])
+        self.assertEqual(len(data['movements']), 1)
+
+        response = self.client.get(reverse('covidpipe-timeline', args=[pipe.pk]))
+        data = response.json()
+        destination = data['columns'].index('destination')
+        self.assertEqual([row[destination] for row in data['movements']], ['Laboratorio', 'Congelador'])
+        self.assertEqual(
+            [(t['from_state'], t['to_state']) for t in data['transitions']],
+            [(None, Movement.CREATED), (Movement.CREATED, Movement.SENT)])
+
+        etag = response['ETag']
+        response = self.client.get(
+            reverse('covidpipe-timeline', args=[pipe.pk]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        move_pipes(parse_range('H1').filter(), self.lab)
+        response = self.client.get(
+            reverse('covidpipe-timeline', args=[pipe.pk]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['movements']), 3)
+
+    def test_movements_cursor_pagination(self):
+        url = reverse('movement-list')
+        response = self.client.get(url, {'page_size': 1, 'destination': self.lab.pk})
+        data = response.json()
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['pipe_name'], 'H2')
+
+        data = self.client.get(data['next']).json()
+        self.assertEqual(data['results'][0]['pipe_name'], 'H1')
+        self.assertIsNone(data['next'])
+
+    def test_requires_authentication(self):
+        self.client.logout()
+        pipe = CovidPipe.objects.get(name='H1')
+        for url in (reverse('covidpipe-list'), reverse('movement-list'),
+                    reverse('location-inventory'), reverse('covidpipe-timeline', args=[pipe.pk])):
+            self.assertIn(self.client.get(url).status_code, (401, 403))
+
+    def test_export_requires_view_permission(self):
+        url = reverse('covidpipe-export')
+        self.client.logout()
+        self.assertIn(self.client.get(url).status_code, (401, 403))
+
+        user = get_user_model().objects.create_user('staff@example.com', 'secret')
+        self.client.force_login(user)
+        # users.User grants every permission; check them as Django does
+        has_perm = mock.patch.object(get_user_model(), 'has_perm', PermissionsMixin.has_perm)
+        with has_perm:
+            self.assertEqual(self.client.get(url).status_code, 403)
+            user.user_permissions.add(Permission.objects.get(codename='view_covidpipe'))
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 4)
+
+
+@override_settings(PROCESS_CACHES=True)
+class ScanTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        self.lab = Location.objects.create(name='Laboratorio')
+        create_pipes(['K1', 'K2', 'K3'])
+        CovidPipe.objects.filter(name='K1').update(con_muestra=True)
+
+    def test_single_scan(self):
+        url = reverse('scan')
+        response = self.client.post(url, {'pipe': 'K1', 'destination': 'Laboratorio'})
+        self.assertEqual(response.status_code, 201)
+
+        pipe = CovidPipe.objects.get(name='K1')
+        self.assertEqual(pipe.current_location, self.lab)
+        self.assertEqual(pipe.last_movement.destination, self.lab)
+        self.assertTrue(pipe.con_muestra)
+
+        # Warm cache: session and user, then the move's transaction
+        pipe_ids(['K2'])
+        with self.assertNumQueries(9):
+            response = self.client.post(url, {'pipe': 'K2', 'destination': self.lab.pk})
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.post(url, {'pipe': 'K2', 'destination': self.lab.pk})
+        self.assertEqual((response.status_code, response.json()['skipped']), (200, 1))
+        response = self.client.post(url, {'pipe': 'K9', 'destination': self.lab.pk})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(url, {'pipe': 'K3', 'destination': 'Nada'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_scan_and_stale_cache(self):
+        url = reverse('scan-batch')
+        self.client.post(url, {'pipes': ['K1', 'K2'], 'destination': self.lab.pk})
+        CovidPipe.objects.filter(name='K2').update(name='K20')
+
+        freezer = Location.objects.create(name='Congelador')
+        response = self.client.post(url, {
+            'pipes': ['K1', 'K2', 'K20', 'K3'], 'destination': freezer.pk, 'con_muestra': 'false',
+        }, content_type='application/json')
+        self.assertEqual(response.json(), {
+            'destination': 'Congelador', 'moved': 3, 'skipped': 0, 'missing': ['K2']})
+        self.assertEqual(CovidPipe.objects.filter(
+            current_location=freezer, con_muestra=False).count(), 3)
+
+
+class MovementIngestTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_superuser('admin@example.com', 'secret')
+        self.client.force_login(user)
+        self.lab = Location.objects.create(name='Laboratorio')
+        self.freezer = Location.objects.create(name='Congelador')
+        create_pipes(['J1', 'J2'])
+
+    def test_csv_ingestion_with_rejects(self):
+        body = (
+            'pipe,destination,date,description\n'
+            'J1,Laboratorio,2020-09-01T08:00:00,recepción\n'
+            'J1,{},2020-09-01T09:00:00,\n'
+            'J2,Laboratorio,2020-09-01T08:30:00,\n'
+            'J9,Laboratorio,,\n'
+            'J2,Bodega,,\n'
+            'J2,Laboratorio,ayer,\n'
+        ).format(self.freezer.pk)
+        response = self.client.post(
+            reverse('movement-ingest'), body, content_type='text/csv')
+
+        data = response.json()
+        self.assertEqual(data['accepted'], 3)
+        self.assertEqual([row['line'] for row in data['rejected']], [5, 6, 7])
+
+        pipe = CovidPipe.objects.get(name='J1')
+        self.assertEqual(pipe.current_location, self.freezer)
+        self.assertEqual(pipe.current_origin, self.lab)
+        self.assertEqual(pipe.last_movement.description, '')
+        self.assertEqual(daily_report()[0]['movements'], 3)
+
+    def test_ndjson_ingestion(self):
+        body = (
+            '{"pipe": "J2", "destination": "Congelador"}\n'
+            'not json\n'
+        )
+        response = self.client.post(
+            reverse('movement-ingest'), body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual(response.json()['rejected'], [{'line': 2, 'error': 'JSON inválido'}])
+        self.assertEqual(CovidPipe.objects.get(name='J2').current_location, self.freezer)
+
+    def test_destinations_missing_from_the_cache(self):
+        self.assertEqual(len(location_choices()), 2)
+        # Bypasses the signals, as a location created by another worker would
+        Location.objects.bulk_create([Location(name='Bodega')])
+        cellar = Location.objects.get(name='Bodega')
+        self.assertEqual(len(location_choices()), 2)
+        body = (
+            'pipe,destination,date,description\n'
+            'J1,Bodega,,\n'
+            'J2,{},,\n'
+        ).format(cellar.pk + 100)
+        response = self.client.post(
+            reverse('movement-ingest'), body, content_type='text/csv')
+
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual(response.json()['rejected'], [
+            {'line': 3, 'error': 'Destino no existe: {}'.format(cellar.pk + 100)}])
+        self.assertEqual(CovidPipe.objects.get(name='J1').current_location.name, 'Bodega')
+
+    def test_body_is_required(self):
+        url = reverse('movement-ingest')
+        response = self.client.post(url, '', content_type='text/csv', CONTENT_LENGTH='0')
+        self.assertEqual(response.status_code, 400)
+
+        # A chunked upload has no Content-Length
+        response = self.client.post(
+            url, 'pipe,destination\nJ1,Laboratorio\n', content_type='text/csv',
+            CONTENT_LENGTH='')
+        self.assertEqual(response.status_code, 411)
+        self.assertFalse(Movement.objects.exists())
@@ -0,0 +1,75 @@
+from calendar import timegm
+from collections import namedtuple
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from entities.aliases import resolve_alias
+from entities.models import Movement
+
+TIMELINE_COLUMNS = (
+    'id', 'date', 'origin', 'destination', 'state', 'date_created', 'date_sent',
+    'description',
+)
+
+TimelineRow = namedtuple('TimelineRow', TIMELINE_COLUMNS)
+Transition = namedtuple('Transition', ['date', 'from_state', 'to_state'])
+Timeline = namedtuple('Timeline', ['pipe', 'aliases', 'movements', 'transitions'])
+
+
+def pipe_timeline(pipe):
+    """Return the movements of ``pipe``, oldest first, with its alias chain.
+
+    The movements are read as plain rows with one query on the
+    ``(pipe, date)`` index; ``transitions`` lists the points where the
+    state of consecutive movements changes.
+    """
+    movements = [
+        TimelineRow(*row) for row in Movement.objects.filter(pipe=pipe).order_by(
+            'date', 'id').values_list(
+                'id', 'date', 'origin__name', 'destination__name', 'state',
+                'date_created', 'date_sent', 'description')]
+
+    transitions = []
+    previous = None
+    for row in movements:
+        if row.state != previous:
+            transitions.append(Transition(row.date, previous, row.state))
+            previous = row.state
+
+    return Timeline(pipe, resolve_alias(pipe).chain, movements, transitions)
+
+
+def timeline_data(timeline):
+    """Return ``timeline`` as compact JSON-ready rows under a column header."""
+    return {
+        'pipe': {'id': timeline.pipe.pk, 'name': timeline.pipe.name},
+        'aliases': [{'id': pk, 'name': name} for pk, name in timeline.aliases],
+        'columns': TIMELINE_COLUMNS,
+        'movements': [list(row) for row in timeline.movements],
+        'transitions': [transition._asdict() for transition in timeline.transitions],
+    }
+
+
+def timeline_etag(pipe):
+    # ``updated`` moves with every write that touches the pipe's movements
+    return '"{}-{}-{}"'.format(
+        pipe.pk, pipe.last_movement_id or 0, int(pipe.updated.timestamp() * 1000000))
+
+
+def conditional_timeline(request, pipe, render):
+    """Answer a GET for the timeline of ``pipe``, or 304 if the client is current.
+
+    ``render`` builds the full response; it is only called when the
+    client's ETag/Last-Modified validators are stale.
+    """
+    etag = timeline_etag(pipe)
+    last_modified = timegm(pipe.updated.utctimetuple())
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render()
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
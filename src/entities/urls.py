@@ -1,8 +1,23 @@
-from django.urls import path
-from entities.views import PipeCreate, PipeDelete, PipeUpdate
+from django.urls import include, path
+from rest_framework.routers import DefaultRouter
+from entities.views import (
+    MovementIngestView, PipeCreate, PipeDelete, PipeUpdate, ScanBatchView, ScanView,
+    cache_stats, pipe_search)
+from entities.viewsets import LocationViewSet, MovementViewSet, PipeViewSet
+
+router = DefaultRouter()
+router.register('locations', LocationViewSet)
+router.register('pipes', PipeViewSet)
+router.register('movements', MovementViewSet)
 
 urlpatterns = [
+    path('api/movements/ingest/', MovementIngestView.as_view(), name='movement-ingest'),
+    path('api/scan/', ScanView.as_view(), name='scan'),
+    path('api/scan/batch/', ScanBatchView.as_view(), name='scan-batch'),
+    path('api/', include(router.urls)),
     path('pipe/add/', PipeCreate.as_view(), name='pipe-add'),
+    path('pipe/search/', pipe_search, name='pipe-search'),
+    path('cache/stats/', cache_stats, name='cache-stats'),
     path('pipe/<int:pk>/', PipeUpdate.as_view(), name='pipe-update'),
     path('pipe/<int:pk>/delete/', PipeDelete.as_view(), name='pipe-delete'),
 ]
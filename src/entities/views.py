@@ -1,6 +1,24 @@
+import os
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
 from django.urls import reverse_lazy
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
-from entities.models import CovidPipe
+from rest_framework import status
+from rest_framework.permissions import DjangoModelPermissions, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from entities.cache import cache_stats as local_cache_stats
+from entities.ingest import ingest
+from entities.models import CovidPipe, Movement
+from entities.scans import InvalidDestination, record_scans
+
+PIPE_SEARCH_LIMIT = 20
+PIPE_SEARCH_MAX_LIMIT = 100
+
+# A rack is 96 tubes; anything far larger belongs to ingestion or the admin
+SCAN_BATCH_MAX = 500
+
 
 class PipeCreate(CreateView):
     model = CovidPipe
@@ -13,3 +31,126 @@ class PipeUpdate(UpdateView):
 class PipeDelete(DeleteView):
     model = CovidPipe
     success_url = reverse_lazy('pipe-list')
+
+
+@staff_member_required
+def pipe_search(request):
+    """Prefix search over pipe names, paginated by name with ``after``."""
+    try:
+        limit = int(request.GET.get('limit', PIPE_SEARCH_LIMIT))
+    except ValueError:
+        limit = PIPE_SEARCH_LIMIT
+    limit = max(1, min(limit, PIPE_SEARCH_MAX_LIMIT))
+
+    pipes = CovidPipe.objects.filter(name__startswith=request.GET.get('q', ''))
+    after = request.GET.get('after')
+    if after:
+        pipes = pipes.filter(name__gt=after)
+    results = list(pipes.order_by('name').values('id', 'name')[:limit + 1])
+
+    return JsonResponse({
+        'results': results[:limit],
+        'next': results[limit - 1]['name'] if len(results) > limit else None,
+    })
+
+
+@staff_member_required
+def cache_stats(request):
+    """Hit and miss counts of the lookup caches of the worker answering."""
+    return JsonResponse({'pid': os.getpid(), 'caches': local_cache_stats()})
+
+
+class MovementIngestView(APIView):
+    """Record a streamed batch of scans as movements.
+
+    The body is CSV with a ``pipe,destination,date,description`` header,
+    or NDJSON (``application/x-ndjson``) with the same keys. It is read
+    incrementally, so uploads of any size use constant memory. It needs a
+    ``Content-Length``; chunked uploads are refused.
+    """
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+    queryset = Movement.objects.none()
+
+    def post(self, request):
+        # DRF leaves the stream unset for an empty body or a missing length
+        if request.stream is None:
+            if not request.META.get('CONTENT_LENGTH'):
+                return Response({'detail': 'Se requiere Content-Length'},
+                                status=status.HTTP_411_LENGTH_REQUIRED)
+            return Response({'detail': 'Cuerpo vacío'}, status=status.HTTP_400_BAD_REQUEST)
+        result = ingest(request.stream, request.content_type)
+        return Response({
+            'accepted': result.accepted,
+            'rejected_count': result.rejected_count,
+            'rejected': result.rejected,
+        })
+
+
+def _flag(value):
+    """Parse an optional boolean sent as JSON or as a form value."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('1', 'true', 'on', 'yes')
+
+
+class ScanView(APIView):
+    """Move one scanned pipe: ``{"pipe": "A001", "destination": 3}``.
+
+    ``destination`` is a location id or name; ``description`` and
+    ``con_muestra`` are optional, and the pipe keeps its flag if the
+    latter is left out.
+    """
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+    queryset = Movement.objects.none()
+    names_field = 'pipe'
+
+    def get_names(self, data):
+        name = str(data.get('pipe') or '').strip()
+        return [name] if name else []
+
+    def post(self, request):
+        data = request.data
+        names = self.get_names(data)
+        if not names:
+            return Response({self.names_field: 'Requerido'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(names) > SCAN_BATCH_MAX:
+            return Response(
+                {self.names_field: 'Máximo {} pipes por lote'.format(SCAN_BATCH_MAX)},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            location, result = record_scans(
+                names, data.get('destination'),
+                description=str(data.get('description') or '').strip(),
+                con_muestra=_flag(data.get('con_muestra')))
+        except InvalidDestination as e:
+            return Response({'destination': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.respond(location, result)
+
+    def respond(self, location, result):
+        if result.missing:
+            return Response(
+                {'pipe': 'No existe: {}'.format(result.missing[0])},
+                status=status.HTTP_404_NOT_FOUND)
+        return Response(
+            {'destination': location.name, 'moved': result.moved, 'skipped': result.skipped},
+            status=status.HTTP_201_CREATED if result.moved else status.HTTP_200_OK)
+
+
+class ScanBatchView(ScanView):
+    """Move a rack of scanned pipes: ``{"pipes": [...], "destination": 3}``."""
+    names_field = 'pipes'
+
+    def get_names(self, data):
+        pipes = data.getlist('pipes') if hasattr(data, 'getlist') else data.get('pipes')
+        if isinstance(pipes, str):
+            pipes = pipes.split()
+        return [str(name).strip() for name in pipes or [] if str(name).strip()]
+
+    def respond(self, location, result):
+        return Response({
+            'destination': location.name, 'moved': result.moved,
+            'skipped': result.skipped, 'missing': result.missing,
+        })
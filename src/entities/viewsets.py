@@ -0,0 +1,157 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import DjangoModelPermissions, IsAuthenticated
+from rest_framework.response import Response
+
+from entities.aliases import equivalent_pipes, resolve_alias
+from entities.export import pipe_csv_response
+from entities.inventory import inventory_report
+from entities.models import CovidPipe, Location, Movement
+from entities.rollups import day_range
+from entities.serializers import LocationSerializer, MovementSerializer, PipeSerializer
+from entities.timeline import conditional_timeline, pipe_timeline, timeline_data
+
+
+class NameCursorPagination(CursorPagination):
+    ordering = 'name'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class IdCursorPagination(NameCursorPagination):
+    ordering = '-id'
+
+
+class DjangoModelViewPermissions(DjangoModelPermissions):
+    """``DjangoModelPermissions`` that also require the view permission to read."""
+    perms_map = dict(
+        DjangoModelPermissions.perms_map,
+        GET=['%(app_label)s.view_%(model_name)s'],
+        HEAD=['%(app_label)s.view_%(model_name)s'])
+
+
+def _int_param(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: 'Debe ser un número entero'})
+
+
+def _filter_date_range(queryset, request, field):
+    """Apply the ``date_from``/``date_to`` parameters, inclusive local days."""
+    for name, lookup, bound in (('date_from', 'gte', 0), ('date_to', 'lt', 1)):
+        value = request.query_params.get(name)
+        if not value:
+            continue
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: 'Use el formato AAAA-MM-DD'})
+        queryset = queryset.filter(
+            **{'{}__{}'.format(field, lookup): day_range(day)[bound]})
+    return queryset
+
+
+class LocationViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Location.objects.all()
+    serializer_class = LocationSerializer
+    pagination_class = NameCursorPagination
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+
+    @action(detail=False)
+    def inventory(self, request):
+        """Pipes currently at each location, with and without sample."""
+        return Response(inventory_report())
+
+
+class PipeViewSet(viewsets.ReadOnlyModelViewSet):
+    """Pipes with their current location and state.
+
+    Filters: ``name`` (prefix), ``alias`` (pipes sharing an alias chain
+    with a name), ``location`` (id or ``empty``), ``state``,
+    ``con_muestra``, ``date_from``/``date_to`` (last movement).
+    """
+    queryset = CovidPipe.objects.select_related('current_location', 'current_origin')
+    serializer_class = PipeSerializer
+    pagination_class = NameCursorPagination
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+
+    def get_queryset(self):
+        queryset = super(PipeViewSet, self).get_queryset()
+        params = self.request.query_params
+
+        if params.get('name'):
+            queryset = queryset.filter(name__startswith=params['name'])
+        if params.get('alias'):
+            queryset = queryset.filter(
+                pk__in=list(equivalent_pipes(
+                    names=[params['alias']]).values_list('pk', flat=True)))
+        if params.get('location') == 'empty':
+            queryset = queryset.filter(current_location__isnull=True)
+        elif params.get('location'):
+            queryset = queryset.filter(
+                current_location_id=_int_param(self.request, 'location'))
+        if params.get('state'):
+            queryset = queryset.filter(current_state=_int_param(self.request, 'state'))
+        if params.get('con_muestra') in ('true', 'false'):
+            queryset = queryset.filter(con_muestra=params['con_muestra'] == 'true')
+
+        return _filter_date_range(queryset, self.request, 'last_moved_at')
+
+    @action(detail=False, url_path='export',
+            permission_classes=(IsAuthenticated, DjangoModelViewPermissions))
+    def export(self, request):
+        """Stream every pipe matching the list filters as CSV."""
+        return pipe_csv_response(self.filter_queryset(self.get_queryset()))
+
+    @action(detail=True)
+    def aliases(self, request, pk=None):
+        """Canonical pipe of an alias chain and every equivalent name."""
+        resolution = resolve_alias(self.get_object())
+        return Response({
+            'canonical': dict(zip(('id', 'name'), resolution.canonical)),
+            'chain': [{'id': pk, 'name': name} for pk, name in resolution.chain],
+            'equivalent': [{'id': pk, 'name': name} for pk, name in resolution.equivalent],
+        })
+
+    @action(detail=True)
+    def timeline(self, request, pk=None):
+        """Movements, aliases and state transitions of one pipe, oldest first.
+
+        Answers 304 while the client's ETag or Last-Modified is current.
+        """
+        pipe = self.get_object()
+        return conditional_timeline(
+            request, pipe, lambda: Response(timeline_data(pipe_timeline(pipe))))
+
+
+class MovementViewSet(viewsets.ReadOnlyModelViewSet):
+    """Movements, newest first.
+
+    Filters: ``pipe``, ``origin``, ``destination``, ``location`` (either
+    end), ``state``, ``date_from``/``date_to``.
+    """
+    queryset = Movement.objects.select_related('pipe')
+    serializer_class = MovementSerializer
+    pagination_class = IdCursorPagination
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+
+    def get_queryset(self):
+        queryset = super(MovementViewSet, self).get_queryset()
+
+        for name in ('pipe', 'origin', 'destination', 'state'):
+            value = _int_param(self.request, name)
+            if value is not None:
+                queryset = queryset.filter(**{name: value})
+        location = _int_param(self.request, 'location')
+        if location is not None:
+            queryset = queryset.filter(Q(destination=location) | Q(origin=location))
+
+        return _filter_date_range(queryset, self.request, 'date')
@@ -0,0 +1,181 @@
+"""In-process database connection pool used by ``helpers.pooled_postgresql``.
+
+Connections are handed out newest first, so a quiet worker keeps reusing
+the same few and lets the rest reach their lifetime. A connection is
+checked on checkout: past ``max_lifetime`` it is closed, idle for longer
+than ``ping_after`` it must answer a ping first. On release it is reset,
+or closed if it can't be. A forked process starts with an empty pool
+instead of sharing its parent's sockets.
+"""
+import os
+import threading
+import time
+from collections import Counter, deque
+
+from helpers.metrics import register_collector
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_MAX_LIFETIME = 1800
+DEFAULT_PING_AFTER = 30
+DEFAULT_TIMEOUT = 10.0
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, max_lifetime=DEFAULT_MAX_LIFETIME,
+                 ping_after=DEFAULT_PING_AFTER, timeout=DEFAULT_TIMEOUT):
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        self.pid = os.getpid()
+        self.idle = deque()
+        self.born = {}
+        self.in_use = 0
+        self.events = Counter()
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # The parent's sockets: forget them, closing would end its sessions
+            self._reset_state()
+
+    def _expired(self, connection, now):
+        return now - self.born[id(connection)] > self.max_lifetime
+
+    def _discard(self, connection, reason):
+        self.born.pop(id(connection), None)
+        self.events["discarded_" + reason] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, connect, ping):
+        """Return a healthy connection, opening one with ``connect`` if none is idle.
+
+        ``ping`` returns whether a connection that sat idle still works.
+        Waits up to ``timeout`` seconds for a release when ``max_size``
+        connections are out, then raises ``PoolExhausted``.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.condition:
+                self._check_fork()
+                connection = returned = None
+                while connection is None:
+                    now = time.monotonic()
+                    while self.idle:
+                        candidate, returned = self.idle.pop()
+                        if self._expired(candidate, now):
+                            self._discard(candidate, "lifetime")
+                            continue
+                        connection = candidate
+                        break
+                    if connection is not None or self.in_use + len(self.idle) < self.max_size:
+                        break
+                    if now >= deadline:
+                        self.events["timeouts"] += 1
+                        raise PoolExhausted(
+                            "No database connection free after {}s".format(self.timeout))
+                    self.events["waits"] += 1
+                    self.condition.wait(deadline - now)
+                self.in_use += 1
+
+            if connection is None:
+                try:
+                    connection = connect()
+                except Exception:
+                    self._give_back()
+                    raise
+                with self.condition:
+                    self.born[id(connection)] = time.monotonic()
+                    self.events["connects"] += 1
+                return connection
+
+            if time.monotonic() - returned <= self.ping_after or ping(connection):
+                with self.condition:
+                    self.events["reused"] += 1
+                return connection
+            with self.condition:
+                self._discard(connection, "unhealthy")
+            self._give_back()
+
+    def _give_back(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def release(self, connection, reset):
+        """Return ``connection`` to the pool if ``reset`` can make it reusable."""
+        with self.condition:
+            if self.pid != os.getpid():
+                # Checked out before a fork; the parent still owns the socket
+                return
+            known = id(connection) in self.born
+            expired = known and self._expired(connection, time.monotonic())
+        usable = known and not expired and reset(connection)
+        with self.condition:
+            if not known:
+                self.events["discarded_foreign"] += 1
+                connection.close()
+                return
+            self.in_use -= 1
+            if usable:
+                self.idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection, "lifetime" if expired else "broken")
+            self.condition.notify()
+
+    def discard(self, connection):
+        """Close a checked out connection instead of returning it."""
+        with self.condition:
+            if self.pid == os.getpid() and id(connection) in self.born:
+                self.in_use -= 1
+                self.condition.notify()
+            self._discard(connection, "closed")
+
+    def stats(self):
+        with self.condition:
+            self._check_fork()
+            return dict(
+                self.events, max_size=self.max_size, idle=len(self.idle),
+                in_use=self.in_use)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    """Return the pool of database ``alias``, created from its ``POOL`` options."""
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(
+                max_size=options.get("MAX_SIZE", DEFAULT_MAX_SIZE),
+                max_lifetime=options.get("MAX_LIFETIME", DEFAULT_MAX_LIFETIME),
+                ping_after=options.get("PING_AFTER", DEFAULT_PING_AFTER),
+                timeout=options.get("TIMEOUT", DEFAULT_TIMEOUT))
+        return _pools[alias]
+
+
+def pool_stats():
+    return {alias: pool.stats() for alias, pool in list(_pools.items())}
+
+
+def _pool_metrics():
+    for alias, stats in pool_stats().items():
+        for state in ("idle", "in_use"):
+            yield "db_pool_connections", {"alias": alias, "state": state}, stats[state]
+        for event, count in stats.items():
+            if event not in ("idle", "in_use", "max_size"):
+                yield "db_pool_events_total", {"alias": alias, "event": event}, count
+
+
+register_collector(_pool_metrics)
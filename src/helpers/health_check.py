@@ -1,12 +1,41 @@
+import time
+
+from django.db import DatabaseError, connection
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
+from helpers.db_pool import pool_stats
+
+
+def _database_latency():
+    """Return the milliseconds taken to connect, if needed, and run ``SELECT 1``."""
+    start = time.perf_counter()
+    connection.ensure_connection()
+    connected = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+    end = time.perf_counter()
+    return {
+        "connect_ms": round((connected - start) * 1000, 2),
+        "round_trip_ms": round((end - connected) * 1000, 2),
+    }
+
 
 @csrf_exempt
 @api_view(("GET",))
 @permission_classes((AllowAny,))
-def health_check(_request):
-    return Response(status=status.HTTP_200_OK)
+def health_check(request):
+    """Return 200, or with ``?deep=1`` also check the database and report its
+    latency and the connection pool statistics."""
+    if not request.query_params.get("deep"):
+        return Response(status=status.HTTP_200_OK)
+    try:
+        database = _database_latency()
+    except DatabaseError as e:
+        return Response(
+            {"database": {"error": str(e)}}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({"database": database, "pools": pool_stats()}, status=status.HTTP_200_OK)
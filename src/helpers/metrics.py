@@ -0,0 +1,265 @@
+"""Prometheus metrics aggregated over every process of the service.
+
+Each process keeps its samples in memory and writes them, at most every
+``METRICS_FLUSH_INTERVAL`` seconds, to ``<METRICS_DIR>/<pid>.json``. The
+metrics view sums the files of all processes, so any gunicorn worker can
+answer the scrape. Counters and histograms of processes that exited are
+kept; gauges only count live processes.
+"""
+import functools
+import hmac
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from helpers.query_stats import QueryRecorder
+
+COUNTER, GAUGE, HISTOGRAM = "counter", "gauge", "histogram"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS = {
+    "http_request_duration_seconds": (
+        HISTOGRAM, "Request latency by view", LATENCY_BUCKETS),
+    "http_request_db_seconds": (
+        HISTOGRAM, "SQL time spent by each request, by view", LATENCY_BUCKETS),
+    "http_requests_in_flight": (
+        GAUGE, "Requests being served by each worker process", None),
+    "pipes_processed_total": (
+        COUNTER, "Pipes handled by bulk actions", None),
+    "action_duration_seconds": (
+        HISTOGRAM, "Duration of bulk actions", LATENCY_BUCKETS),
+    "cache_hits_total": (COUNTER, "Lookups served by the process caches", None),
+    "cache_misses_total": (COUNTER, "Lookups the process caches sent to the database", None),
+    "db_pool_connections": (GAUGE, "Pooled database connections by state", None),
+    "db_pool_events_total": (
+        COUNTER, "Connections opened, reused and discarded by the pool, and waits for one", None),
+}
+
+_lock = threading.Lock()
+_values = {}
+_histograms = {}
+_collectors = []
+_last_flush = 0.0
+_timer = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _values[key] = _values.get(key, 0) + amount
+    maybe_flush()
+
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    with _lock:
+        key = _key(name, labels)
+        counts = _histograms.setdefault(key, [0] * len(buckets) + [0, 0.0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+    maybe_flush()
+
+
+def register_collector(collect):
+    """Add a function returning ``(name, labels, value)`` of counters kept elsewhere.
+
+    It is called on each flush and its values replace the previous ones.
+    """
+    _collectors.append(collect)
+
+
+def _snapshot():
+    with _lock:
+        values = dict(_values)
+        histograms = {key: list(counts) for key, counts in _histograms.items()}
+    for collect in _collectors:
+        for name, labels, value in collect():
+            values[_key(name, labels)] = value
+    return {
+        "pid": os.getpid(),
+        "values": [[name, list(labels), value] for (name, labels), value in values.items()],
+        "histograms": [[name, list(labels), counts] for (name, labels), counts in histograms.items()],
+    }
+
+
+def flush():
+    """Write this process's samples to its file in ``METRICS_DIR``."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    path = os.path.join(settings.METRICS_DIR, "{}.json".format(os.getpid()))
+    temporary = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(temporary, "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(temporary, path)
+
+
+def _flush_later():
+    global _timer
+    with _lock:
+        _timer = None
+    flush()
+
+
+def maybe_flush():
+    """Flush now if the last flush is old enough, or else schedule one."""
+    global _timer
+    delay = settings.METRICS_FLUSH_INTERVAL - (time.monotonic() - _last_flush)
+    if delay <= 0:
+        flush()
+        return
+    with _lock:
+        if _timer is None:
+            _timer = threading.Timer(delay, _flush_later)
+            _timer.daemon = True
+            _timer.start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_files():
+    try:
+        names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, name)) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            # Removed or being replaced by its process
+            continue
+
+
+def collect():
+    """Return the samples of every process, summed per metric and labels.
+
+    Gauges are labelled with the ``pid`` of their live process instead.
+    """
+    flush()
+    values = defaultdict(float)
+    histograms = {}
+    for snapshot in _read_files():
+        live = _alive(snapshot["pid"])
+        for name, labels, value in snapshot["values"]:
+            labels = [tuple(label) for label in labels]
+            if METRICS.get(name, (None,))[0] == GAUGE:
+                if not live:
+                    continue
+                labels = labels + [("pid", str(snapshot["pid"]))]
+            values[name, tuple(labels)] += value
+        for name, labels, counts in snapshot["histograms"]:
+            key = name, tuple(tuple(label) for label in labels)
+            total = histograms.setdefault(key, [0] * len(counts))
+            histograms[key] = [a + b for a, b in zip(total, counts)]
+    return values, histograms
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels))
+
+
+def _format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    values, histograms = collect()
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines += ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind)]
+        if kind == HISTOGRAM:
+            for (metric, labels), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(buckets + (math.inf,), counts[:-2] + [counts[-2]]):
+                    lines.append("{}_bucket{} {}".format(
+                        name, _format_labels(labels + (("le", _format_value(float(bound))),)), count))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), counts[-2]))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(counts[-1])))
+        else:
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def track_action(action, count):
+    """Decorate a bulk operation to record its duration and the pipes it handled.
+
+    ``count`` returns the number of pipes from the operation's result.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            observe("action_duration_seconds", time.perf_counter() - start, action=action)
+            inc("pipes_processed_total", count(result), action=action)
+            return result
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Record the latency, SQL time and in-flight count of every request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inc("http_requests_in_flight")
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        try:
+            with recorder.record():
+                response = self.get_response(request)
+        finally:
+            inc("http_requests_in_flight", -1)
+
+        match = request.resolver_match
+        view = match.view_name if match else "<unresolved>"
+        observe("http_request_duration_seconds", time.perf_counter() - start,
+                view=view, method=request.method)
+        observe("http_request_db_seconds", recorder.duration, view=view)
+        return response
+
+
+def metrics(request):
+    """Expose the metrics of every process to Prometheus."""
+    token = settings.METRICS_TOKEN
+    if token and not hmac.compare_digest(
+            request.META.get("HTTP_AUTHORIZATION", ""), "Bearer {}".format(token)):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
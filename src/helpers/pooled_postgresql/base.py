@@ -0,0 +1,60 @@
+"""PostgreSQL backend taking its connections from ``helpers.db_pool``.
+
+Set ``ENGINE`` to ``helpers.pooled_postgresql`` and the pool options in
+the database's ``POOL`` dict. Closing the connection, which Django does
+after each request when ``CONN_MAX_AGE`` is 0, returns it to the pool.
+"""
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from helpers.db_pool import PoolExhausted, get_pool
+
+
+def _ping(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except base.Database.Error:
+        return False
+
+
+def _reset(connection):
+    """Leave ``connection`` outside any transaction; False if it is broken."""
+    if connection.closed:
+        return False
+    status = connection.get_transaction_status()
+    if status == extensions.TRANSACTION_STATUS_IDLE:
+        return True
+    if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    try:
+        connection.rollback()
+    except base.Database.Error:
+        return False
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict.get("POOL", {}))
+
+    def get_new_connection(self, conn_params):
+        def connect():
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+
+        try:
+            return self.pool.acquire(connect, _ping)
+        except PoolExhausted as e:
+            raise base.Database.OperationalError(str(e))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # Django keeps using the connection until the block exits
+                self.pool.discard(self.connection)
+            else:
+                self.pool.release(self.connection, _reset)
@@ -0,0 +1,115 @@
+import heapq
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("query_stats")
+
+# Statements are cut to this length in logs and budget reports
+MAX_SQL_LENGTH = 500
+
+
+class QueryRecorder:
+    """Database ``execute_wrapper`` counting statements and their time.
+
+    Keeps the ``slowest`` statements, and every statement when ``capture``
+    is set. Unlike ``connection.queries`` it works with ``DEBUG`` off.
+    """
+
+    def __init__(self, slowest=0, capture=False):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest_size = slowest
+        self.heap = []
+        self.queries = [] if capture else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            sql = sql[:MAX_SQL_LENGTH]
+            if self.queries is not None:
+                self.queries.append(sql)
+            if self.slowest_size:
+                push = heapq.heappush if len(self.heap) < self.slowest_size else heapq.heappushpop
+                push(self.heap, (duration, sql))
+
+    @contextmanager
+    def record(self):
+        """Record the statements run on every connection of this thread."""
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    def slowest(self):
+        """Return ``(milliseconds, sql)`` of the slowest statements, slowest first."""
+        return [(round(duration * 1000, 2), sql) for duration, sql in sorted(self.heap, reverse=True)]
+
+
+class QueryStatsMiddleware:
+    """Log the query count, SQL time and slowest statements of sampled requests.
+
+    ``QUERY_STATS_SAMPLE_RATE`` of the requests are recorded; their
+    responses carry ``X-DB-Queries`` and ``X-DB-Time`` (ms) headers and a
+    JSON line is written to the ``query_stats`` logger. Statements run
+    while a streaming response is consumed are not counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.QUERY_STATS_SAMPLE_RATE:
+            return self.get_response(request)
+
+        recorder = QueryRecorder(slowest=settings.QUERY_STATS_SLOWEST)
+        start = time.perf_counter()
+        with recorder.record():
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        response["X-DB-Queries"] = str(recorder.count)
+        response["X-DB-Time"] = "{:.1f}".format(recorder.duration * 1000)
+
+        match = request.resolver_match
+        stats = {
+            "method": request.method,
+            "path": request.path,
+            "view": match.view_name if match else None,
+            "status": response.status_code,
+            "queries": recorder.count,
+            "db_ms": round(recorder.duration * 1000, 1),
+            "total_ms": round(elapsed * 1000, 1),
+            "slowest": recorder.slowest(),
+        }
+        if request.method == "POST" and request.POST.get("action"):
+            stats["action"] = request.POST["action"]
+        logger.info(json.dumps(stats), extra={"query_stats": stats})
+        return response
+
+
+@contextmanager
+def query_budget(limit):
+    """Fail if the block runs more than ``limit`` statements.
+
+    For tests: ``with query_budget(10): client.get(url)``. The statements
+    are listed in the failure message.
+    """
+    recorder = QueryRecorder(capture=True)
+    with recorder.record():
+        yield recorder
+    if recorder.count > limit:
+        raise AssertionError(
+            "{} queries over a budget of {}:\n{}".format(
+                recorder.count, limit,
+                "\n".join("{}. {}".format(i, sql) for i, sql in enumerate(recorder.queries, 1))))
@@ -0,0 +1,160 @@
+"""Startup timing and the checks behind the entrypoint's fast path.
+
+``python -m helpers.startup`` sets Django up in a fresh interpreter and
+prints, as JSON, the time each installed app spent importing its module,
+its models and in ``AppConfig.ready``. ``startup_profile`` runs it and
+formats the result.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+STATIC_STAMP = ".static-fingerprint"
+
+
+def _timed(timings, label, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[label] = timings.get(label, 0) + time.perf_counter() - start
+    return wrapper
+
+
+def profile():
+    """Set Django up, timing every phase of each app, and return the timings in ms."""
+    from django.apps.config import AppConfig
+
+    start = time.perf_counter()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "app.settings")
+    import django
+    from django.conf import settings
+
+    settings.INSTALLED_APPS  # Imports the settings module
+    phases = {"settings": time.perf_counter() - start}
+    apps = {}
+
+    create = AppConfig.create.__func__
+
+    def timed_create(cls, entry):
+        timings = apps.setdefault(entry, {})
+        config = _timed(timings, "import", create)(cls, entry)
+        config.import_models = _timed(timings, "models", config.import_models)
+        config.ready = _timed(timings, "ready", config.ready)
+        return config
+
+    AppConfig.create = classmethod(timed_create)
+    try:
+        start = time.perf_counter()
+        django.setup()
+        phases["setup"] = time.perf_counter() - start
+    finally:
+        AppConfig.create = classmethod(create)
+
+    start = time.perf_counter()
+    from django.core.wsgi import get_wsgi_application
+    from django.urls import get_resolver
+
+    get_wsgi_application()
+    get_resolver().url_patterns  # Imports the URLconf, as the first request would
+    phases["wsgi"] = time.perf_counter() - start
+
+    def ms(seconds):
+        return round(seconds * 1000, 2)
+
+    return {
+        "phases": {name: ms(value) for name, value in phases.items()},
+        "apps": {
+            entry: {phase: ms(timings.get(phase, 0)) for phase in ("import", "models", "ready")}
+            for entry, timings in apps.items()
+        },
+        "modules": len(sys.modules),
+    }
+
+
+def profile_runs(runs=1, env=None):
+    """Profile ``runs`` fresh interpreters and keep the fastest time of each phase.
+
+    ``env`` overrides environment variables, e.g. ``APP_PROFILE``.
+    """
+    from django.conf import settings
+
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "helpers.startup"], cwd=settings.BASE_DIR,
+            env=dict(os.environ, **(env or {})), stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(output.stdout.decode()))
+
+    fastest = results[0]
+    for result in results[1:]:
+        for name, value in result["phases"].items():
+            fastest["phases"][name] = min(fastest["phases"].get(name, value), value)
+        for entry, timings in result["apps"].items():
+            best = fastest["apps"].setdefault(entry, timings)
+            for phase, value in timings.items():
+                best[phase] = min(best[phase], value)
+    return fastest
+
+
+def pending_migrations(database="default"):
+    """Return the migrations not applied to ``database`` yet."""
+    from django.db import connections
+    from django.db.migrations.executor import MigrationExecutor
+
+    executor = MigrationExecutor(connections[database])
+    return [
+        migration
+        for migration, backwards in executor.migration_plan(executor.loader.graph.leaf_nodes())
+    ]
+
+
+def static_fingerprint():
+    """Hash the path and contents of every file collectstatic would copy."""
+    from django.contrib.staticfiles.finders import get_finders
+
+    digest = hashlib.sha256()
+    files = {}
+    for finder in get_finders():
+        for path, storage in finder.list([]):
+            # The first finder to list a path wins, as in collectstatic
+            files.setdefault(path, storage)
+    for path in sorted(files):
+        digest.update(path.encode())
+        with files[path].open(path) as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp_path():
+    from django.conf import settings
+
+    return os.path.join(settings.STATIC_ROOT, STATIC_STAMP)
+
+
+def static_is_current(fingerprint):
+    """Whether STATIC_ROOT was collected from files with ``fingerprint``."""
+    from django.contrib.staticfiles.storage import staticfiles_storage
+
+    manifest = getattr(staticfiles_storage, "manifest_name", None)
+    if manifest and not staticfiles_storage.exists(manifest):
+        return False
+    try:
+        with open(_stamp_path()) as f:
+            return f.read().strip() == fingerprint
+    except FileNotFoundError:
+        return False
+
+
+def write_static_stamp(fingerprint):
+    with open(_stamp_path(), "w") as f:
+        f.write(fingerprint)
+
+
+if __name__ == "__main__":
+    json.dump(profile(), sys.stdout)